@@ -0,0 +1,211 @@
+#
+# Copyright (C) 2014 pytest-multihost contributors. See COPYING for license
+#
+
+"""Asyncio interface for communicating with remote hosts
+
+Commands started here are read from the running event loop: their channels
+(or ``ssh`` pipes) are registered with ``loop.add_reader``, so any number of
+concurrent commands needs no extra threads.
+File operations are delegated to the wrapped (blocking) Transport in the
+loop's default executor.
+
+This module requires Python 3.5+.
+"""
+
+import asyncio
+import functools
+import time
+
+from pytest_multihost.transport import (
+    Command, SSHCallWrapper, DEFAULT, READ_SIZE, _get_output_readers,
+    _get_line_logger)
+
+
+class AsyncTransport(object):
+    """Asyncio interface to a Transport
+
+    Usually obtained as ``host.async_transport``.
+    """
+    def __init__(self, transport):
+        self.transport = transport
+        self.log = transport.log
+
+    def start_shell(self, argv, log_stdout=True, encoding='utf-8'):
+        """Start a shell, returning an AsyncCommand
+
+        Like Transport.start_shell, but the output is read by the running
+        event loop. Use ``await command.wait()`` to let the command finish.
+        """
+        logger_name = self.transport.get_next_command_logger_name()
+        ssh = self.transport.open_shell_channel()
+        self.log.info('RUN %s', argv)
+        return AsyncCommand(ssh, argv, logger_name, log_stdout=log_stdout,
+                            get_logger=self.transport.host.config.get_logger,
+                            encoding=encoding)
+
+    def _run_in_executor(self, function, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(
+            None, functools.partial(function, *args, **kwargs))
+
+    async def get_file_contents(self, filename, encoding=None):
+        """Read the named remote file and return the contents"""
+        return await self._run_in_executor(
+            self.transport.get_file_contents, filename, encoding=encoding)
+
+    async def put_file_contents(self, filename, contents, encoding='utf-8'):
+        """Write the given string (or bytestring) to the named remote file"""
+        return await self._run_in_executor(
+            self.transport.put_file_contents, filename, contents,
+            encoding=encoding)
+
+    async def file_exists(self, filename):
+        """Return true if the named remote file exists"""
+        return await self._run_in_executor(
+            self.transport.file_exists, filename)
+
+
+class AsyncCommand(Command):
+    """Command whose output is read by the asyncio event loop
+
+    Unlike other Commands, ``wait()`` is a coroutine, and the command
+    is used with ``async with`` rather than ``with``.
+    """
+    def __init__(self, ssh, argv, logger_name, log_stdout=True,
+                 encoding='utf-8', get_logger=None):
+        super(AsyncCommand, self).__init__(argv, logger_name,
+                                           log_stdout=log_stdout,
+                                           get_logger=get_logger,
+                                           encoding=encoding)
+        self._ssh = ssh
+        self._loop = asyncio.get_event_loop()
+        self._output = {'stdout': [], 'stderr': []}
+        self._line_loggers = {
+            'stdout': _get_line_logger(self.log, log_stdout),
+            'stderr': _get_line_logger(self.log),
+        }
+        self._open_streams = set(self._output)
+        self._first_byte_time = None
+        self._output_done = self._loop.create_future()
+
+        self.log.debug('RUN %s', argv)
+
+        self._ssh.invoke_shell()
+        self.stdin = self._ssh.makefile('wb')
+
+        for fd, read in _get_output_readers(ssh):
+            self._loop.add_reader(fd, self._on_readable, fd, read)
+
+    def _on_readable(self, fd, read):
+        eof = False
+        for name, data in read():
+            if name not in self._open_streams:
+                continue
+            line_logger = self._line_loggers[name]
+            if data:
+                if self._first_byte_time is None:
+                    self._first_byte_time = time.time()
+                    self._on_first_output()
+                self._output[name].append(bytes(data))
+                if line_logger:
+                    line_logger.write(data)
+            else:
+                eof = True
+                self._open_streams.discard(name)
+                if line_logger:
+                    line_logger.flush()
+        if eof:
+            self._loop.remove_reader(fd)
+            if not self._open_streams:
+                self._output_done.set_result(None)
+
+    async def wait(self, raiseonerr=DEFAULT):
+        """Wait for the remote process to exit
+
+        Coroutine version of Command.wait
+        """
+        if raiseonerr is DEFAULT:
+            raiseonerr = self.raiseonerr
+
+        if self._done:
+            return self.returncode
+
+        await self._end_process_async()
+        self._run_done_callbacks()
+
+        return self._check_returncode(raiseonerr)
+
+    async def _end_process_async(self):
+        """Wait until the process exits and output is received, close channel
+        """
+        self.stdin.close()
+
+        await self._output_done
+
+        self.stdout_bytes = b''.join(self._output['stdout'])
+        self.stderr_bytes = b''.join(self._output['stderr'])
+
+        ssh = self._ssh
+        if isinstance(ssh, SSHCallWrapper):
+            exited = ssh.command.poll() is not None
+        else:
+            exited = ssh.exit_status_ready()
+        if exited:
+            self.returncode = ssh.recv_exit_status()
+        else:
+            self.returncode = await self._loop.run_in_executor(
+                None, ssh.recv_exit_status)
+        ssh.close()
+
+    @property
+    def first_byte_time(self):
+        return self._first_byte_time
+
+    @property
+    def output_size(self):
+        return sum(len(chunk) for chunks in self._output.values()
+                   for chunk in chunks)
+
+    def _end_process(self):
+        raise TypeError('AsyncCommand.wait() must be awaited')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.wait(raiseonerr=self.raiseonerr)
+
+    def __enter__(self):
+        raise TypeError('Use "async with" with AsyncCommand')
+
+
+async def run_command(host, argv, set_env=True, stdin_text=None,
+                      log_stdout=True, raiseonerr=True,
+                      cwd=None, bg=False, encoding='utf-8'):
+    """Run the given command on the host, see BaseHost.run_command_async"""
+    cwd_script, env_script, script = host._get_command_script(
+        argv, set_env=set_env, stdin_text=stdin_text, cwd=cwd,
+        encoding=encoding)
+    script = cwd_script + env_script + script + b'\nexit\n'
+    bytes_out = len(script)
+
+    command = host.async_transport.start_shell(
+        argv, log_stdout=log_stdout, encoding=encoding)
+
+    def write_script():
+        command.stdin.write(script)
+        command.stdin.flush()
+
+    if len(script) > READ_SIZE:
+        # Writing could block until the remote side reads the input,
+        # which needs the event loop to be running
+        await command._loop.run_in_executor(None, write_script)
+    else:
+        write_script()
+
+    host._notify_command(command, bytes_out)
+    command.raiseonerr = raiseonerr
+    if not bg:
+        await command.wait()
+    return command
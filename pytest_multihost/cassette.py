@@ -0,0 +1,143 @@
+#
+# Copyright (C) 2014 pytest-multihost contributors. See COPYING for license
+#
+
+"""Cassettes: recorded results of remote commands and file operations
+
+A cassette is written by RecordingTransport and read by ReplayTransport
+(see pytest_multihost.transport).
+It is a file with one JSON object per line, each describing one operation
+on one host::
+
+    {"host": "master.ipa.test", "op": "command", "key": [...],
+     "argv": "echo hello", "stdout": {"text": "hello\\n"}, ...}
+
+Operations are matched on the host, the kind of operation (``op``) and
+a ``key`` (e.g. the remote filename, or the SHA-256 of the script sent to
+a shell). Operations with the same key are replayed in the order they
+were recorded.
+Bytestrings are stored as ``{"text": ...}`` if they are valid UTF-8,
+otherwise as ``{"base64": ...}``.
+"""
+
+import base64
+import collections
+import json
+import os
+import threading
+
+# Standard input of commands larger than this is not stored in the
+# cassette (only its SHA-256 is used for matching)
+MAX_STORED_STDIN = 64 * 1024
+
+
+def pack(value):
+    """Convert bytestrings (also in lists and tuples) to JSON-compatible form
+    """
+    if isinstance(value, bytes):
+        try:
+            return {'text': value.decode('utf-8')}
+        except UnicodeDecodeError:
+            return {'base64': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, (list, tuple)):
+        return [pack(item) for item in value]
+    return value
+
+
+def unpack(value):
+    """Reverse pack(); lists are returned as tuples"""
+    if isinstance(value, dict):
+        if 'base64' in value:
+            return base64.b64decode(value['base64'].encode('ascii'))
+        return value['text'].encode('utf-8')
+    if isinstance(value, list):
+        return tuple(unpack(item) for item in value)
+    return value
+
+
+class Cassette(object):
+    """Operations recorded in (or replayed from) a cassette file
+
+    Use get_cassette() to get a cassette shared by all hosts and threads.
+
+    :param filename: Name of the cassette file
+    :param mode: ``'record'`` to start a new file, or ``'replay'`` to read
+                 an existing one
+    """
+    def __init__(self, filename, mode):
+        self.filename = filename
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._entries = collections.defaultdict(collections.deque)
+        if mode == 'record':
+            directory = os.path.dirname(os.path.abspath(filename))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(filename, 'w'):
+                pass
+        elif mode == 'replay':
+            with open(filename) as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._entries[self._key(entry)].append(entry)
+        else:
+            raise ValueError('Unknown cassette mode: %r' % (mode,))
+
+    @staticmethod
+    def _key(entry):
+        return entry['host'], entry['op'], json.dumps(entry['key'])
+
+    def record(self, host, op, key, **data):
+        """Append an operation to the cassette file
+
+        :param host: Host the operation ran on
+        :param op: Kind of the operation (e.g. ``'command'``, or the name
+                   of a Transport method)
+        :param key: List of strings that identifies the operation
+        :param data: Details, such as the result; bytestrings are allowed
+        """
+        entry = collections.OrderedDict([
+            ('host', host.hostname), ('op', op), ('key', key)])
+        for name, value in sorted(data.items()):
+            entry[name] = pack(value)
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            with open(self.filename, 'a') as f:
+                f.write(line)
+
+    def replay(self, host, op, key):
+        """Return the next recorded entry for the given operation
+
+        Bytestrings in the entry are not unpacked (see unpack()).
+        Raises LookupError if there is no such entry left.
+        """
+        entry_key = host.hostname, op, json.dumps(key)
+        with self._lock:
+            try:
+                return self._entries[entry_key].popleft()
+            except IndexError:
+                raise LookupError('%s not recorded in %s for %s: %s' % (
+                    op, self.filename, host.hostname, ' '.join(key)))
+
+
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+
+def get_cassette(filename, mode):
+    """Return the Cassette for the given file, creating it if needed
+
+    A cassette file is only truncated (for recording) or read (for replay)
+    once per process, so hosts of all Configs share it.
+    """
+    if not filename:
+        raise ValueError('No cassette file given for %s mode (use the '
+                         '"cassette" config key, or --multihost-%s)' %
+                         (mode, mode))
+    filename = os.path.abspath(filename)
+    with _cassettes_lock:
+        cassette = _cassettes.get(filename)
+        if cassette is None or cassette.mode != mode:
+            cassette = _cassettes[filename] = Cassette(filename, mode)
+        return cassette
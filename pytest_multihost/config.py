@@ -7,15 +7,52 @@
 """Utilities for configuration of multi-master tests"""
 
 import collections
+import hashlib
 import logging
+import subprocess
+import time
 
-from pytest_multihost.util import check_config_dict_empty
+from pytest_multihost.util import (check_config_dict_empty, check_ssh_tuning,
+                                   run_in_parallel)
 
 
 class FilterError(ValueError):
     """Raised when domains description could not be satisfied"""
 
 
+class MultihostError(Exception):
+    """Raised when an operation failed on some of several hosts
+
+    :attr results: Ordered dict mapping each host to the operation's result
+                   (None for hosts where the operation raised an exception)
+    :attr errors: Ordered dict mapping hosts where the operation failed
+                  to the exception raised
+
+    If an exception has a ``stderr`` attribute (like the CalledProcessError
+    of Config.run_on_hosts), the error output is included in the message.
+    """
+    def __init__(self, operation, results, errors):
+        self.results = results
+        self.errors = errors
+        message = '%s failed on %s of %s hosts:\n%s' % (
+            operation, len(errors), len(results),
+            '\n'.join('  %s: %s' % (host, _describe_error(e))
+                      for host, e in errors.items()))
+        super(MultihostError, self).__init__(message)
+
+
+def _describe_error(exception):
+    """Describe an exception for MultihostError, with any error output"""
+    description = '%s: %s' % (type(exception).__name__, exception)
+    stderr = getattr(exception, 'stderr', None)
+    if stderr:
+        if isinstance(stderr, bytes):
+            stderr = stderr.decode('utf-8', 'replace')
+        description += ''.join('\n    ' + line
+                               for line in stderr.rstrip().splitlines())
+    return description
+
+
 init_args = [
     'test_dir',
     'ssh_key_filename',
@@ -23,6 +60,18 @@ init_args = [
     'ssh_username',
     'domains',
     'ipv6',
+    'persistent_shell',
+    'sftp_pipelining',
+    'sftp_chunk_size',
+    'sftp_max_requests',
+    'ssh_tuning',
+]
+
+# Accepted by from_dict, but not saved by to_dict: a process that loads
+# the saved config must not record into (and truncate) this one's cassette
+unsaved_init_args = [
+    'cassette',
+    'cassette_mode',
 ]
 
 
@@ -33,6 +82,9 @@ class Config(object):
     """
     extra_init_args = ()
 
+    # Default maximum number of hosts to operate on in parallel
+    max_workers = 16
+
     def __init__(self, **kwargs):
         self.log = self.get_logger('%s.%s' % (__name__, type(self).__name__))
 
@@ -45,7 +97,22 @@ class Config(object):
         self.ssh_password = kwargs.get('ssh_password')
         self.ssh_username = kwargs.get('ssh_username', 'root')
         self.ipv6 = bool(kwargs.get('ipv6', False))
-        self.windows_test_dir = kwargs.get('windows_test_dir', '/home/Administrator')
+        self.persistent_shell = bool(kwargs.get('persistent_shell', False))
+        self.sftp_pipelining = bool(kwargs.get('sftp_pipelining', True))
+        self.sftp_chunk_size = int(kwargs.get('sftp_chunk_size', 32768))
+        self.sftp_max_requests = kwargs.get('sftp_max_requests')
+        self.ssh_tuning = check_ssh_tuning(kwargs.get('ssh_tuning'), 'config')
+        self.windows_test_dir = kwargs.get('windows_test_dir',
+                                           '/home/Administrator')
+        self.cassette = kwargs.get('cassette')
+        self.cassette_mode = kwargs.get('cassette_mode')
+        if self.cassette_mode not in (None, 'record', 'replay'):
+            raise ValueError('cassette_mode must be "record" or "replay", '
+                             'not %r' % (self.cassette_mode,))
+        if self.cassette_mode and not self.cassette:
+            raise ValueError('cassette_mode needs a cassette file')
+
+        self.listeners = []
 
         if not self.ssh_password and not self.ssh_key_filename:
             self.ssh_key_filename = '~/.ssh/id_rsa'
@@ -53,11 +120,54 @@ class Config(object):
         self.domains = []
         domain_class = self.get_domain_class()
         for domain_dict in kwargs.pop('domains'):
-            self.domains.append(domain_class.from_dict(dict(domain_dict), self))
+            self.domains.append(
+                domain_class.from_dict(dict(domain_dict), self))
 
     def get_domain_class(self):
         return Domain
 
+    def add_listener(self, listener):
+        """Register a listener for events on all hosts of this config
+
+        The listener is an object with any of the following methods,
+        which are called when the corresponding event happens
+        (possibly from other threads, so they should not block):
+
+        ``on_connect(host, transport, duration)``:
+            A connection to the host was made (the transport was created)
+        ``on_command_start(host, command)``:
+            A command was started by run_command
+            (``command.start_time`` is the time.time() it started)
+        ``on_command_output(host, command, time_to_first_byte)``:
+            The first output of the command was received
+        ``on_command_end(host, command, duration, bytes_in, bytes_out)``:
+            The command finished; bytes_in is the size of its output
+            and bytes_out the size of the script sent to the host
+        ``on_transfer_start(host, kind, name, path)``:
+            A file transfer started; kind is 'get' or 'put', name is the
+            Transport method (such as 'put_file'), path the remote path
+        ``on_transfer_end(host, kind, name, path, duration, size)``:
+            The file transfer finished successfully
+        """
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """Unregister a listener"""
+        self.listeners.remove(listener)
+
+    def notify(self, event, *args):
+        """Call the ``on_<event>`` method of all listeners that have it
+
+        Errors in listeners are logged, not raised.
+        """
+        for listener in self.listeners:
+            method = getattr(listener, 'on_' + event, None)
+            if method is not None:
+                try:
+                    method(*args)
+                except Exception:
+                    self.log.exception('Error in listener for %s', event)
+
     def get_logger(self, name):
         """Get a logger of the given name
 
@@ -84,7 +194,8 @@ class Config(object):
         if 'windows_test_dir' in dct:
             dct['windows_test_dir'] = dct.pop('windows_test_dir')
 
-        all_init_args = set(init_args) | set(cls.extra_init_args)
+        all_init_args = (set(init_args) | set(unsaved_init_args) |
+                         set(cls.extra_init_args))
         extra_args = set(dct) - all_init_args
         if extra_args:
             ValueError('Extra keys in confuguration for config: %s' %
@@ -102,6 +213,8 @@ class Config(object):
             Values are taken from attributes of the same name.
             Usually this is a subset of the class' extra_init_args
         """
+        # The dicts include IP addresses; look them up all at once
+        self.resolve_ips()
         dct = {'domains': [d.to_dict() for d in self.domains]}
 
         autosave = (set(init_args) | set(_autosave_names)) - set(['domains'])
@@ -125,6 +238,172 @@ class Config(object):
                 pass
         raise LookupError(name)
 
+    def get_all_hosts(self):
+        """Return a list of all hosts in all domains"""
+        return [host for domain in self.domains for host in domain.hosts]
+
+    def run_in_parallel(self, operation, function, hosts=None,
+                        max_workers=None):
+        """Call ``function(host)`` for each of the given hosts in parallel
+
+        :param operation: Name of the operation, used for logging and errors
+        :param function: The function to call
+        :param hosts: The hosts to operate on (default: all hosts)
+        :param max_workers: Maximum number of hosts to operate on at the same
+                            time (default: the ``max_workers`` attribute)
+
+        Returns an ordered dict mapping each host to the function's result.
+        If the function raises for any of the hosts, MultihostError is raised
+        after all the calls finish.
+        """
+        if hosts is None:
+            hosts = self.get_all_hosts()
+        hosts = list(hosts)
+        if max_workers is None:
+            max_workers = self.max_workers
+        self.log.info('%s on %s hosts', operation, len(hosts))
+        outcomes = run_in_parallel(function, hosts, max_workers)
+        results = collections.OrderedDict()
+        errors = collections.OrderedDict()
+        for host, (result, exception) in zip(hosts, outcomes):
+            results[host] = result
+            if exception is not None:
+                self.log.error('%s failed on %s: %s', operation, host,
+                               exception)
+                errors[host] = exception
+        if errors:
+            raise MultihostError(operation, results, errors)
+        return results
+
+    def run_on_hosts(self, argv, hosts=None, max_workers=None, **kwargs):
+        """Run the given command on several hosts in parallel
+
+        :param argv: Command to run (see BaseHost.run_command)
+        :param hosts: The hosts to run on (default: all hosts)
+        :param max_workers: Maximum number of commands to run at the same time
+                            (default: the ``max_workers`` attribute)
+
+        Other keyword arguments are passed to BaseHost.run_command.
+
+        Returns an ordered dict mapping each host to its finished Command.
+        If the command fails on any host (or if it cannot be run there),
+        MultihostError is raised after all the commands finish.
+        Its ``results`` include the Commands of all hosts where the command
+        ran, including the failed ones, and its message includes their
+        exit codes and error output.
+        With ``raiseonerr=False``, only hosts where the command could not be
+        run are errors.
+        """
+        raiseonerr = kwargs.pop('raiseonerr', True)
+        operation = 'RUN %s' % (argv, )
+
+        def run(host):
+            return host.run_command(argv, raiseonerr=False, **kwargs)
+
+        try:
+            results = self.run_in_parallel(operation, run, hosts=hosts,
+                                           max_workers=max_workers)
+            errors = {}
+        except MultihostError as e:
+            results, errors = e.results, e.errors
+        failures = collections.OrderedDict()
+        for host, command in results.items():
+            if host in errors:
+                failures[host] = errors[host]
+            elif raiseonerr and command.returncode:
+                error = subprocess.CalledProcessError(command.returncode,
+                                                      command.argv)
+                error.stderr = getattr(command, 'stderr_bytes', None)
+                self.log.error('%s failed on %s: %s', operation, host, error)
+                failures[host] = error
+        if failures:
+            raise MultihostError(operation, results, failures)
+        return results
+
+    def put_file_to_hosts(self, localpath, remotepath, hosts=None,
+                          max_workers=None):
+        """Copy a local file to several hosts in parallel
+
+        :param localpath: The local file to copy
+        :param remotepath: Destination filename on each host
+        :param hosts: The hosts to copy to (default: all hosts)
+        :param max_workers: Maximum number of uploads to run at the same time
+                            (default: the ``max_workers`` attribute)
+
+        The local file is read only once. Before uploading, the SHA-256
+        checksum of the remote file is checked, and hosts that already have
+        identical contents are skipped.
+
+        Returns an ordered dict mapping each host to True if the file was
+        uploaded, or False if it was skipped.
+        If the upload fails on any host, MultihostError is raised after all
+        uploads finish.
+        """
+        with open(localpath, 'rb') as f:
+            contents = f.read()
+        sha256 = hashlib.sha256(contents).hexdigest()
+
+        def put(host):
+            transport = host.transport
+            if transport.is_file_unchanged(remotepath, sha256):
+                self.log.debug('%s already has %s', host, remotepath)
+                return False
+            transport.put_file_contents(remotepath, contents, encoding=None)
+            return True
+
+        return self.run_in_parallel('PUT %s' % remotepath, put, hosts=hosts,
+                                    max_workers=max_workers)
+
+    def resolve_ips(self, hosts=None, max_workers=None):
+        """Look up IP addresses of the given hosts in parallel
+
+        :param hosts: The hosts to look up (default: all hosts)
+        :param max_workers: Maximum number of lookups to do at the same time
+                            (default: the ``max_workers`` attribute)
+
+        Hosts look up their IP address when it is first needed; this does
+        all the lookups at once. Hosts whose address is already known are
+        skipped.
+
+        Returns an ordered dict mapping each host to its IP address.
+        If any lookup fails, MultihostError is raised after all of them
+        finish.
+        """
+        if hosts is None:
+            hosts = self.get_all_hosts()
+        hosts = list(hosts)
+        unknown = [host for host in hosts if not host.ip_known]
+        if unknown:
+            self.run_in_parallel('RESOLVE', lambda host: host.ip,
+                                 hosts=unknown, max_workers=max_workers)
+        return collections.OrderedDict((host, host.ip) for host in hosts)
+
+    def connect_all(self, hosts=None, max_workers=None):
+        """Connect to the given hosts in parallel
+
+        :param hosts: The hosts to connect to (default: all hosts)
+        :param max_workers: Maximum number of connections to open at the same
+                            time (default: the ``max_workers`` attribute)
+
+        Normally, a host's transport connects when it is first used.
+        This opens all the connections up front, so the handshakes
+        are not done one after another.
+
+        Returns an ordered dict mapping each host to the time, in seconds,
+        it took to connect.
+        If any connection fails, MultihostError is raised after all
+        connection attempts finish.
+        """
+        def connect(host):
+            start = time.time()
+            host.transport
+            elapsed = time.time() - start
+            self.log.info('Connected to %s in %.3f s', host, elapsed)
+            return elapsed
+
+        return self.run_in_parallel('CONNECT', connect, hosts=hosts,
+                                    max_workers=max_workers)
+
     def filter(self, descriptions):
         """Destructively filters hosts and orders domains to fit description
 
@@ -173,7 +452,7 @@ class Domain(object):
 
     See README for an overview of the core classes.
     """
-    def __init__(self, config, name, domain_type):
+    def __init__(self, config, name, domain_type, ssh_tuning=None):
         self.log = config.get_logger('%s.%s' % (__name__, type(self).__name__))
         self.type = str(domain_type)
 
@@ -181,6 +460,9 @@ class Domain(object):
         self.name = str(name)
         self.hosts = []
 
+        # Overrides of config.ssh_tuning for hosts in this domain
+        self.ssh_tuning = check_ssh_tuning(ssh_tuning, 'domain %s' % name)
+
     def get_host_class(self, host_dict):
         host_type = host_dict.get('host_type', 'default')
         return self.host_classes[host_type]
@@ -218,7 +500,8 @@ class Domain(object):
         """
         domain_type = dct.pop('type', 'default')
         domain_name = dct.pop('name')
-        self = cls(config, domain_name, domain_type)
+        ssh_tuning = dct.pop('ssh_tuning', None)
+        self = cls(config, domain_name, domain_type, ssh_tuning=ssh_tuning)
 
         for host_dict in dct.pop('hosts'):
             host_class = self.get_host_class(host_dict)
@@ -232,11 +515,14 @@ class Domain(object):
     def to_dict(self):
         """Export this Domain from a dict
         """
-        return {
+        result = {
             'type': self.type,
             'name': self.name,
             'hosts': [h.to_dict() for h in self.hosts],
         }
+        if self.ssh_tuning:
+            result['ssh_tuning'] = dict(self.ssh_tuning)
+        return result
 
     def host_by_role(self, role):
         """Return the first host of the given role"""
@@ -250,6 +536,30 @@ class Domain(object):
         """Return all hosts of the given role"""
         return [h for h in self.hosts if h.role == role]
 
+    def run_on_hosts(self, argv, hosts=None, max_workers=None, **kwargs):
+        """Run the given command on several hosts in parallel
+
+        Like Config.run_on_hosts, but ``hosts`` defaults to all hosts
+        of this domain.
+        """
+        if hosts is None:
+            hosts = self.hosts
+        return self.config.run_on_hosts(argv, hosts=hosts,
+                                        max_workers=max_workers, **kwargs)
+
+    def put_file_to_hosts(self, localpath, remotepath, hosts=None,
+                          max_workers=None):
+        """Copy a local file to several hosts in parallel
+
+        Like Config.put_file_to_hosts, but ``hosts`` defaults to all hosts
+        of this domain.
+        """
+        if hosts is None:
+            hosts = self.hosts
+        return self.config.put_file_to_hosts(localpath, remotepath,
+                                             hosts=hosts,
+                                             max_workers=max_workers)
+
     def host_by_name(self, name):
         """Return a host with the given name
 
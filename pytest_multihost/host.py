@@ -9,15 +9,58 @@
 import os
 import socket
 import subprocess
+import threading
+import time
 
 from pytest_multihost import transport
-from pytest_multihost.util import check_config_dict_empty, shell_quote
+from pytest_multihost.transport import DEFAULT
+from pytest_multihost.util import (check_config_dict_empty, check_ssh_tuning,
+                                   shell_quote)
 
 try:
     basestring
 except NameError:
     basestring = str
 
+# Number of seconds looked-up IP addresses are remembered (see resolve_ip)
+IP_CACHE_TTL = 300
+
+# Maps (hostname, ipv6) to (IP address, expiration time)
+_ip_cache = {}
+_ip_cache_lock = threading.Lock()
+
+
+def resolve_ip(hostname, ipv6=False):
+    """Look up the IP address of the given hostname
+
+    Uses ``dig`` for IPv6 addresses.
+    Results are cached for the whole process for IP_CACHE_TTL seconds.
+    Raises RuntimeError if the address cannot be determined.
+    """
+    key = hostname, bool(ipv6)
+    now = time.time()
+    with _ip_cache_lock:
+        cached = _ip_cache.get(key)
+    if cached and cached[1] > now:
+        return cached[0]
+    if ipv6:
+        # $(dig +short $M $rrtype|tail -1)
+        dig = subprocess.Popen(['dig', '+short', hostname, 'AAAA'],
+                               stdout=subprocess.PIPE)
+        stdout, stderr = dig.communicate()
+        lines = stdout.decode('utf-8', 'replace').split()
+        ip = lines[-1].strip() if lines else None
+    else:
+        try:
+            ip = socket.gethostbyname(hostname)
+        except socket.gaierror:
+            ip = None
+    if not ip:
+        raise RuntimeError('Could not determine IP address of %s' % hostname)
+    with _ip_cache_lock:
+        _ip_cache[key] = ip, now + IP_CACHE_TTL
+    return ip
+
 
 class BaseHost(object):
     """Representation of a remote host
@@ -25,11 +68,17 @@ class BaseHost(object):
     See README for an overview of the core classes.
     """
     transport_class = transport.SSHTransport
+    # Transport used by RecordingTransport to do the recorded operations
+    recorded_transport_class = transport.SSHTransport
     command_prelude = b''
+    # True if remote commands run in a POSIX shell, so transports can
+    # combine file operations into shell scripts (see Transport.batch)
+    posix_shell = False
 
     def __init__(self, domain, hostname, role, ip=None,
                  external_hostname=None, username=None, password=None,
-                 test_dir=None, host_type=None):
+                 test_dir=None, host_type=None, persistent_shell=None,
+                 ssh_tuning=None, transport_type=None):
         self.host_type = host_type
         self.domain = domain
         self.role = str(role)
@@ -63,24 +112,33 @@ class BaseHost(object):
             self.__module__, type(self).__name__, shortname)
         self.log = self.config.get_logger(self.logger_name)
 
-        if ip:
-            self.ip = str(ip)
-        else:
-            if self.config.ipv6:
-                # $(dig +short $M $rrtype|tail -1)
-                dig = subprocess.Popen(
-                    ['dig', '+short', self.external_hostname, 'AAAA'])
-                stdout, stderr = dig.communicate()
-                self.ip = stdout.splitlines()[-1].strip()
-            else:
-                try:
-                    self.ip = socket.gethostbyname(self.external_hostname)
-                except socket.gaierror:
-                    self.ip = None
+        # If not given, the IP address is looked up when first needed
+        self.ip = str(ip) if ip else None
 
-            if not self.ip:
-                raise RuntimeError('Could not determine IP address of %s' %
-                                   self.external_hostname)
+        if persistent_shell is None:
+            self.persistent_shell = self.config.persistent_shell
+        else:
+            self.persistent_shell = bool(persistent_shell)
+
+        # Name of the transport from the "transport" config key, if given
+        self.transport_type = transport_type
+        if transport_type is not None:
+            try:
+                self.transport_class = transport.transport_classes[
+                    transport_type]
+            except KeyError:
+                raise ValueError('Unknown transport for host %s: %s' %
+                                 (hostname, transport_type))
+
+        # Record or replay the host's operations, if configured
+        if self.config.cassette_mode == 'record':
+            self.recorded_transport_class = self.transport_class
+            self.transport_class = transport.RecordingTransport
+        elif self.config.cassette_mode == 'replay':
+            self.transport_class = transport.ReplayTransport
+
+        # Overrides of the domain's and config's ssh_tuning for this host
+        self.ssh_tuning = check_ssh_tuning(ssh_tuning, 'host %s' % hostname)
 
         self.host_key = None
         self.ssh_port = 22
@@ -126,6 +184,9 @@ class BaseHost(object):
         username = dct.pop('username', None)
         password = dct.pop('password', None)
         host_type = dct.pop('host_type', 'default')
+        persistent_shell = dct.pop('persistent_shell', None)
+        ssh_tuning = dct.pop('ssh_tuning', None)
+        transport_type = dct.pop('transport', None)
 
         check_config_dict_empty(dct, 'host %s' % hostname)
 
@@ -134,7 +195,10 @@ class BaseHost(object):
                    external_hostname=external_hostname,
                    username=username,
                    password=password,
-                   host_type=host_type)
+                   host_type=host_type,
+                   persistent_shell=persistent_shell,
+                   ssh_tuning=ssh_tuning,
+                   transport_type=transport_type)
 
     def to_dict(self):
         """Export info about this Host to a dict"""
@@ -146,6 +210,35 @@ class BaseHost(object):
         }
         if self.host_type != 'default':
             result['host_type'] = self.host_type
+        if self.persistent_shell != self.config.persistent_shell:
+            result['persistent_shell'] = self.persistent_shell
+        if self.ssh_tuning:
+            result['ssh_tuning'] = dict(self.ssh_tuning)
+        if self.transport_type is not None:
+            result['transport'] = self.transport_type
+        return result
+
+    @property
+    def effective_ssh_tuning(self):
+        """SSH tuning options for this host
+
+        Combines the ``ssh_tuning`` dicts of the Config, the Domain and
+        this Host; more specific settings take precedence.
+        The known keys are:
+
+        ``compression``: true to compress the SSH connection
+        ``window_size``: SSH channel window size, in bytes
+        ``max_packet_size``: maximum SSH packet size, in bytes
+        ``ciphers``: list of ciphers to allow, in order of preference
+        ``options``: dict of OpenSSH ``-o`` options (OpenSSH transport only)
+        """
+        result = {}
+        for tuning in (self.config.ssh_tuning, self.domain.ssh_tuning,
+                       self.ssh_tuning):
+            for key, value in tuning.items():
+                if key == 'options':
+                    value = dict(result.get('options', {}), **value)
+                result[key] = value
         return result
 
     @property
@@ -153,6 +246,27 @@ class BaseHost(object):
         """The Config that this Host is a part of"""
         return self.domain.config
 
+    @property
+    def ip(self):
+        """The IP address
+
+        If it was not configured, it is looked up (see resolve_ip) on first
+        access. Use Config.resolve_ips to look up addresses of many hosts
+        in parallel.
+        """
+        if self._ip is None:
+            self._ip = resolve_ip(self.external_hostname, self.config.ipv6)
+        return self._ip
+
+    @ip.setter
+    def ip(self, ip):
+        self._ip = ip
+
+    @property
+    def ip_known(self):
+        """True if the IP address was configured or already looked up"""
+        return self._ip is not None
+
     @property
     def transport(self):
         """Provides means to manipulate files & run processs on the remote host
@@ -168,7 +282,11 @@ class BaseHost(object):
                 # transport_class is None in the base class and must be
                 # set in subclasses.
                 # Pylint reports that calling None will fail
+                start = time.time()
                 self._transport = cls(self)  # pylint: disable=E1102
+                if self.config.listeners:
+                    self.config.notify('connect', self, self._transport,
+                                       time.time() - start)
             else:
                 raise NotImplementedError('transport class not available')
             return self._transport
@@ -182,17 +300,35 @@ class BaseHost(object):
         on the Host.
         """
         try:
-            del self._transport
-        except:
-            pass
+            transport = self._transport
+        except AttributeError:
+            return
+        transport.close_persistent_shell()
+        del self._transport
 
     def get_file_contents(self, filename, encoding=None):
         """Shortcut for transport.get_file_contents"""
         return self.transport.get_file_contents(filename, encoding=encoding)
 
-    def put_file_contents(self, filename, contents, encoding='utf-8'):
+    def put_file_contents(self, filename, contents, encoding='utf-8',
+                          verify=False, skip_if_same=False):
         """Shortcut for transport.put_file_contents"""
-        self.transport.put_file_contents(filename, contents, encoding=encoding)
+        self.transport.put_file_contents(filename, contents, encoding=encoding,
+                                         verify=verify,
+                                         skip_if_same=skip_if_same)
+
+    def put_dir(self, localpath, remotepath, compress=False):
+        """Shortcut for transport.put_dir"""
+        self.transport.put_dir(localpath, remotepath, compress=compress)
+
+    def get_dir(self, remotepath, localpath, compress=False):
+        """Shortcut for transport.get_dir"""
+        self.transport.get_dir(remotepath, localpath, compress=compress)
+
+    def sync_dir(self, localpath, remotepath, delete=False, cache_file=None):
+        """Shortcut for transport.sync_dir"""
+        return self.transport.sync_dir(localpath, remotepath, delete=delete,
+                                       cache_file=cache_file)
 
     def collect_log(self, filename):
         """Call all registered log collectors on the given filename"""
@@ -201,13 +337,19 @@ class BaseHost(object):
 
     def run_command(self, argv, set_env=True, stdin_text=None,
                     log_stdout=True, raiseonerr=True,
-                    cwd=None, bg=False, encoding='utf-8'):
+                    cwd=None, bg=False, encoding='utf-8',
+                    stream=False, max_output=None, spill_size=DEFAULT):
         """Run the given command on this host
 
         Returns a Command instance. The command will have already run in the
         shell when this method returns, so its stdout_text, stderr_text, and
         returncode attributes will be available.
 
+        If the ``persistent_shell`` attribute is true, the command is run in
+        the transport's PersistentShell rather than in a new shell.
+        In that case, env.sh is only sourced once, when the shell starts.
+        Commands with ``set_env=False`` or ``bg=True`` always use a new shell.
+
         :param argv: Command to run, as either a Popen-style list, or a string
                      containing a shell script
         :param set_env: If true, env.sh exporting configuration variables will
@@ -226,6 +368,89 @@ class BaseHost(object):
                          ``stdout_text`` and ``stderr_text``, and for
                          ``stdin_text``, ``argv``, etc. if they are not
                          bytestrings already.
+        :param stream: If true, the standard output can be iterated over
+                       while the command runs, using the Command's
+                       ``iter_stdout()`` or ``iter_stdout_lines()``.
+                       Requires ``bg=True``.
+        :param max_output: Maximum number of bytes of standard output and
+                           of standard error to keep in memory.
+                           If the command produces more, only the last
+                           ``max_output`` bytes are available as
+                           ``stdout_bytes``/``stderr_bytes``.
+                           Use 0 to keep no output at all (for example,
+                           when it is only streamed).
+                           The default, None, keeps all output.
+        :param spill_size: Number of bytes of each output stream to keep in
+                           memory; any more output is moved to a temporary
+                           file (see Transport.start_shell).
+        """
+        if stream and not bg:
+            raise ValueError('stream=True requires bg=True')
+
+        cwd_script, env_script, script = self._get_command_script(
+            argv, set_env=set_env, stdin_text=stdin_text, cwd=cwd,
+            encoding=encoding)
+
+        if self.persistent_shell and set_env and not bg:
+            # The environment is only set up once, when the shell starts
+            shell = self.transport.get_persistent_shell(
+                init_script=env_script)
+            script = cwd_script + script
+
+            def on_start(command):
+                self._notify_command(command, len(script))
+
+            command = shell.run(script, argv,
+                                log_stdout=log_stdout, encoding=encoding,
+                                max_output=max_output, spill_size=spill_size,
+                                on_start=on_start)
+            command.raiseonerr = raiseonerr
+            command.wait()
+            return command
+
+        command = self.transport.start_shell(argv, log_stdout=log_stdout,
+                                             encoding=encoding, stream=stream,
+                                             max_output=max_output,
+                                             spill_size=spill_size)
+        command.stdin.write(cwd_script)
+        command.stdin.write(env_script)
+        command.stdin.write(script)
+        command.stdin.write(b'\nexit\n')
+        command.stdin.flush()
+        self._notify_command(
+            command, len(cwd_script) + len(env_script) + len(script))
+        command.raiseonerr = raiseonerr
+        if not bg:
+            command.wait()
+        return command
+
+    def _notify_command(self, command, bytes_out):
+        """Send the command's events to the config's listeners
+
+        :param bytes_out: Size of the script sent to the host
+        """
+        config = self.config
+        if not config.listeners:
+            return
+        config.notify('command_start', self, command)
+
+        def on_output(command):
+            config.notify('command_output', self, command,
+                          command.first_byte_time - command.start_time)
+
+        def on_done(command):
+            config.notify('command_end', self, command,
+                          command.end_time - command.start_time,
+                          command.output_size, bytes_out)
+
+        command.add_first_output_callback(on_output)
+        command.add_done_callback(on_done)
+
+    def _get_command_script(self, argv, set_env, stdin_text, cwd, encoding):
+        """Return the shell script for run_command
+
+        The script is returned in three parts: changing the working
+        directory, setting the environment, and running the command itself.
         """
         def encode(string):
             if not isinstance(string, bytes):
@@ -233,43 +458,78 @@ class BaseHost(object):
             else:
                 return string
 
-        command = self.transport.start_shell(argv, log_stdout=log_stdout,
-                                             encoding=encoding)
         # Set working directory
         if cwd is None:
             cwd = self.test_dir
-        command.stdin.write(b'cd %s\n' % shell_quote(encode(cwd)))
+        cwd_script = b'cd %s\n' % shell_quote(encode(cwd))
 
         # Set the environment
         if set_env:
             quoted = shell_quote(encode(self.env_sh_path))
-            command.stdin.write(b'. %s\n' % quoted)
+            env_script = b'. %s\n' % quoted
+        else:
+            env_script = b''
 
+        script = []
         if self.command_prelude:
-            command.stdin.write(encode(self.command_prelude))
+            script.append(encode(self.command_prelude))
 
         if stdin_text:
-            command.stdin.write(b"echo -en ")
-            command.stdin.write(_echo_quote(encode(stdin_text)))
-            command.stdin.write(b" | ")
+            script.append(b"echo -en ")
+            script.append(_echo_quote(encode(stdin_text)))
+            script.append(b" | ")
 
         if isinstance(argv, basestring):
             # Run a shell command given as a string
-            command.stdin.write(b'(')
-            command.stdin.write(encode(argv))
-            command.stdin.write(b')')
+            script.append(b'(')
+            script.append(encode(argv))
+            script.append(b')')
         else:
             # Run a command given as a popen-style list (no shell expansion)
             for arg in argv:
-                command.stdin.write(shell_quote(encode(arg)))
-                command.stdin.write(b' ')
+                script.append(shell_quote(encode(arg)))
+                script.append(b' ')
+        script = b''.join(script)
+        return cwd_script, env_script, script
+
+    def run_command_async(self, argv, set_env=True, stdin_text=None,
+                          log_stdout=True, raiseonerr=True,
+                          cwd=None, bg=False, encoding='utf-8'):
+        """Asyncio version of run_command
+
+        Returns a coroutine that runs the command and returns an AsyncCommand
+        (see pytest_multihost.async_transport).
+        The arguments are the same as for run_command.
+        With ``bg=True``, the AsyncCommand's ``wait()`` must be awaited.
+
+        The command's output is read in the running event loop, without
+        any additional threads. The persistent shell is not used.
+        """
+        from pytest_multihost import async_transport
+        return async_transport.run_command(
+            self, argv, set_env=set_env, stdin_text=stdin_text,
+            log_stdout=log_stdout, raiseonerr=raiseonerr, cwd=cwd, bg=bg,
+            encoding=encoding)
 
-        command.stdin.write(b'\nexit\n')
-        command.stdin.flush()
-        command.raiseonerr = raiseonerr
-        if not bg:
-            command.wait()
-        return command
+    @property
+    def async_transport(self):
+        """AsyncTransport wrapping this host's transport"""
+        from pytest_multihost import async_transport
+        current = getattr(self, '_async_transport', None)
+        if current is None or current.transport is not self.transport:
+            current = async_transport.AsyncTransport(self.transport)
+            self._async_transport = current
+        return current
+
+    def get_file_contents_async(self, filename, encoding=None):
+        """Shortcut for async_transport.get_file_contents"""
+        return self.async_transport.get_file_contents(filename,
+                                                      encoding=encoding)
+
+    def put_file_contents_async(self, filename, contents, encoding='utf-8'):
+        """Shortcut for async_transport.put_file_contents"""
+        return self.async_transport.put_file_contents(filename, contents,
+                                                      encoding=encoding)
 
 
 def _echo_quote(bytestring):
@@ -284,6 +544,7 @@ def _echo_quote(bytestring):
 class Host(BaseHost):
     """A Unix host"""
     command_prelude = b'set -e\n'
+    posix_shell = True
 
 
 class WinHost(BaseHost):
@@ -0,0 +1,159 @@
+#
+# Copyright (C) 2014 pytest-multihost contributors. See COPYING for license
+#
+
+"""Optional logging setup: a background logging queue and per-host log files
+
+Output of remote commands is logged line by line at DEBUG level, from the
+threads that read it. Handlers that write to slow files or terminals can
+then stall the reading (and so the remote commands).
+A LogQueue moves the handling of log records to a background thread,
+so emitting a log record only puts it in a queue.
+
+add_host_log_file writes everything logged for a host (including output
+of its commands) to a file of its own.
+
+Both only work with loggers from the ``logging`` module, i.e. when
+Config.get_logger is not overridden.
+"""
+
+import logging
+import os
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Format of lines in per-host log files
+HOST_LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+
+class _QueueHandler(logging.Handler):
+    """Handler that puts records, unformatted, into a LogQueue's queue"""
+    def __init__(self, queue, logger):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.logger = logger
+
+    def emit(self, record):
+        self.queue.put((self.logger, record))
+
+
+class LogQueue(object):
+    """Handles log records in a background thread
+
+    Use add_logger to select loggers whose records (including records of
+    their children) are queued. Such loggers do not propagate records
+    directly; instead, the background thread passes them to the handlers
+    added with add_handler, and then to the handlers of the logger's
+    ancestors (as propagation would).
+
+    Note that records are handled some time after they are emitted.
+    For example, pytest may show them in the report of a later test.
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.handlers = []
+        self._lock = threading.Lock()
+        # Maps names of queued loggers to (logger, handler, propagate)
+        self._loggers = {}
+        self._thread = None
+
+    def add_handler(self, handler):
+        """Add a handler called from the background thread"""
+        self.handlers.append(handler)
+
+    def remove_handler(self, handler):
+        self.handlers.remove(handler)
+
+    def add_logger(self, name):
+        """Queue the records of the named logger and its children"""
+        with self._lock:
+            if name in self._loggers:
+                return
+            logger = logging.getLogger(name)
+            handler = _QueueHandler(self.queue, logger)
+            self._loggers[name] = logger, handler, logger.propagate
+            logger.propagate = False
+            logger.addHandler(handler)
+
+    def start(self):
+        """Start the background thread"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run,
+                                        name='pytest-multihost-logging')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop queueing, and wait until all queued records are handled"""
+        with self._lock:
+            loggers, self._loggers = self._loggers, {}
+        for logger, handler, propagate in loggers.values():
+            logger.removeHandler(handler)
+            logger.propagate = propagate
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self.handle(*item)
+
+    def _propagates(self, logger):
+        with self._lock:
+            entry = self._loggers.get(logger.name)
+        if entry is None:
+            return logger.propagate
+        return entry[2]
+
+    def handle(self, logger, record):
+        """Pass a record that was emitted through the given (queued) logger
+        to the handlers; called in the background thread
+        """
+        for handler in list(self.handlers):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+        while self._propagates(logger) and logger.parent is not None:
+            logger = logger.parent
+            for handler in logger.handlers:
+                if isinstance(handler, _QueueHandler):
+                    continue
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+
+def add_host_log_file(host, filename, log_queue=None):
+    """Write all log records of the given host to a file
+
+    :param host: The Host; its logger and all loggers below it (such as
+                 those of its transport and commands) are written
+    :param filename: Name of the log file (it is appended to)
+    :param log_queue: If given, the file is written from the LogQueue's
+                      background thread
+
+    The host's logger is set to the DEBUG level, if it was less verbose.
+    Returns the handler; remove it from the logger (or LogQueue)
+    to stop writing to the file.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    handler = logging.FileHandler(filename)
+    handler.setFormatter(logging.Formatter(HOST_LOG_FORMAT))
+    handler.addFilter(logging.Filter(host.logger_name))
+    logger = logging.getLogger(host.logger_name)
+    if logger.getEffectiveLevel() > logging.DEBUG:
+        logger.setLevel(logging.DEBUG)
+    if log_queue is not None:
+        log_queue.add_handler(handler)
+    else:
+        logger.addHandler(handler)
+    return handler
@@ -0,0 +1,165 @@
+#
+# Copyright (C) 2014 pytest-multihost contributors. See COPYING for license
+#
+
+"""Manifests of local directory trees, used by Transport.sync_dir
+
+A manifest maps relative paths (with ``/`` as separator) of all regular
+files in a tree to ``(size, mtime, sha256)`` tuples.
+Computing the SHA-256 of large trees is slow, so digests are kept in
+a HashCache file between sessions, and only recomputed for files whose
+size or mtime changed.
+The HashCache also holds digests of remote files (see
+Transport.get_remote_manifest).
+"""
+
+import os
+import json
+import hashlib
+import threading
+import tempfile
+from stat import S_ISREG
+
+from pytest_multihost import util
+
+# Number of bytes hashed at once
+READ_SIZE = 1024 * 1024
+
+
+def get_default_cache_file():
+    """Return the default filename of the HashCache"""
+    return os.path.join(util.get_cache_dir(), 'sha256.json')
+
+
+def file_sha256(path):
+    """Return the hex SHA-256 digest of the named local file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def get_mtime_ns(stat):
+    """Return the mtime from a stat result, as integer nanoseconds"""
+    mtime_ns = getattr(stat, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(stat.st_mtime * 10 ** 9)
+    return mtime_ns
+
+
+def parse_mtime(text):
+    """Convert a mtime like ``'1700000000.1234567890'`` to nanoseconds
+
+    This is the format of ``find -printf %T@``; whole seconds are allowed.
+    """
+    seconds, _, fraction = text.partition('.')
+    return int(seconds) * 10 ** 9 + int((fraction + '0' * 9)[:9])
+
+
+def format_mtime(mtime_ns):
+    """Format a mtime in nanoseconds for ``touch -d @...``"""
+    return '%d.%09d' % divmod(mtime_ns, 10 ** 9)
+
+
+class HashCache(object):
+    """SHA-256 digests of files, stored in a JSON file
+
+    Entries are keyed by absolute path (for remote files, by
+    ``hostname:path``), and only valid while the file's size and mtime
+    stay the same.
+
+    Use get_hash_cache() to get a cache shared by all threads.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._changed = False
+        try:
+            with open(filename) as f:
+                self._entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            self._entries = {}
+
+    def get_sha256(self, path, stat=None):
+        """Return the digest of the named local file, computing it if needed
+        """
+        path = os.path.abspath(path)
+        if stat is None:
+            stat = os.stat(path)
+        sha256 = self.lookup(path, stat.st_size, stat.st_mtime)
+        if sha256 is None:
+            sha256 = file_sha256(path)
+            self.store(path, stat.st_size, stat.st_mtime, sha256)
+        return sha256
+
+    def lookup(self, key, size, mtime):
+        """Return the cached digest, or None if it is missing or outdated"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry[0] == size and entry[1] == mtime:
+            return entry[2]
+        return None
+
+    def store(self, key, size, mtime, sha256):
+        """Remember the digest of a file with the given size and mtime"""
+        with self._lock:
+            self._entries[key] = [size, mtime, sha256]
+            self._changed = True
+
+    def save(self):
+        """Write the cache file, if anything changed"""
+        with self._lock:
+            if not self._changed:
+                return
+            data = json.dumps(self._entries)
+            self._changed = False
+        directory = os.path.dirname(self.filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp_name = tempfile.mkstemp(dir=directory, prefix='.sha256.')
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.rename(tmp_name, self.filename)
+
+
+_hash_caches = {}
+_hash_caches_lock = threading.Lock()
+
+
+def get_hash_cache(filename=None):
+    """Return the HashCache for the given file (default: per-user cache)"""
+    if filename is None:
+        filename = get_default_cache_file()
+    with _hash_caches_lock:
+        try:
+            return _hash_caches[filename]
+        except KeyError:
+            cache = _hash_caches[filename] = HashCache(filename)
+            return cache
+
+
+def get_local_manifest(root, hash_cache):
+    """Return the manifest of the local directory tree at ``root``
+
+    Only regular files are included. Symlinks to files are followed;
+    symlinked directories are not.
+    """
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Broken symlink
+                continue
+            if not S_ISREG(stat.st_mode):
+                continue
+            relpath = os.path.relpath(path, root).replace(os.sep, '/')
+            manifest[relpath] = (stat.st_size, stat.st_mtime,
+                                 hash_cache.get_sha256(path, stat))
+    return manifest
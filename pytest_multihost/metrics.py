@@ -0,0 +1,229 @@
+#
+# Copyright (C) 2014 pytest-multihost contributors. See COPYING for license
+#
+
+"""Timing metrics of commands, file transfers and connections
+
+A Metrics object is a Config listener (see Config.add_listener):
+when added to a Config (the plugin does this for the ``--multihost-metrics``
+option), it records every command, file transfer and connection.
+Records are aggregated per host, kind of operation, and name
+(such as the command's executable); each aggregate has a latency histogram.
+Optionally, the slowest individual operations are also kept
+(used for the ``--multihost-durations`` option).
+"""
+
+import collections
+import csv
+import heapq
+import itertools
+import json
+import threading
+
+# Upper bounds (in seconds) of the latency histogram buckets.
+# A last bucket collects everything slower.
+HISTOGRAM_BOUNDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+
+class Aggregate(object):
+    """Statistics of one kind of operation on one host"""
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.min_time = None
+        self.max_time = None
+        self.first_byte_count = 0
+        self.first_byte_total = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.histogram = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+
+    def add(self, duration, first_byte=None, bytes_in=0, bytes_out=0):
+        self.count += 1
+        self.total_time += duration
+        if self.min_time is None or duration < self.min_time:
+            self.min_time = duration
+        if self.max_time is None or duration > self.max_time:
+            self.max_time = duration
+        if first_byte is not None:
+            self.first_byte_count += 1
+            self.first_byte_total += first_byte
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        for i, bound in enumerate(HISTOGRAM_BOUNDS):
+            if duration <= bound:
+                self.histogram[i] += 1
+                break
+        else:
+            self.histogram[-1] += 1
+
+    def to_dict(self):
+        result = collections.OrderedDict([
+            ('count', self.count),
+            ('total_time', self.total_time),
+            ('mean_time', self.total_time / self.count if self.count else 0),
+            ('min_time', self.min_time),
+            ('max_time', self.max_time),
+            ('mean_time_to_first_byte', (
+                self.first_byte_total / self.first_byte_count
+                if self.first_byte_count else None)),
+            ('bytes_in', self.bytes_in),
+            ('bytes_out', self.bytes_out),
+        ])
+        result['histogram'] = collections.OrderedDict(
+            zip(_histogram_labels(), self.histogram))
+        return result
+
+
+def _histogram_labels():
+    return ['<=%s' % bound for bound in HISTOGRAM_BOUNDS] + [
+        '>%s' % HISTOGRAM_BOUNDS[-1]]
+
+
+# One of the slowest operations kept by Metrics
+Operation = collections.namedtuple(
+    'Operation', 'duration host kind name detail context')
+
+
+class Metrics(object):
+    """Collects timings; safe to use from several threads
+
+    :param keep_slowest: Number of the slowest individual operations to keep
+                         (see ``slowest``)
+
+    The ``context`` attribute (for example, the ID of the running test)
+    is stored with each of the slowest operations.
+    """
+    def __init__(self, keep_slowest=0):
+        self._lock = threading.Lock()
+        self._aggregates = {}
+        self.keep_slowest = keep_slowest
+        self._slowest = []
+        self._counter = itertools.count()
+        self.context = None
+
+    @property
+    def slowest(self):
+        """List of the slowest operations, as Operation tuples, slowest first
+        """
+        with self._lock:
+            return [entry[-1] for entry in sorted(self._slowest, reverse=True)]
+
+    def record(self, host, kind, name, duration, first_byte=None,
+               bytes_in=0, bytes_out=0, detail=None):
+        """Record one operation
+
+        :param host: The host the operation ran on (a Host, or a name)
+        :param kind: Kind of operation: 'connect', 'command', 'get' or 'put'
+        :param name: Name of the operation, e.g. the command's executable
+        :param duration: Total time, in seconds
+        :param first_byte: Time until the first byte of output was received
+                           (for commands)
+        :param bytes_in: Number of bytes received from the host
+        :param bytes_out: Number of bytes sent to the host
+        :param detail: Description of this particular operation (e.g. the
+                       full command), kept with the slowest operations
+        """
+        key = getattr(host, 'hostname', host), kind, name
+        with self._lock:
+            aggregate = self._aggregates.get(key)
+            if aggregate is None:
+                aggregate = self._aggregates[key] = Aggregate()
+            aggregate.add(duration, first_byte=first_byte,
+                          bytes_in=bytes_in, bytes_out=bytes_out)
+            if self.keep_slowest:
+                operation = Operation(duration, key[0], kind, name,
+                                      detail or name, self.context)
+                entry = duration, next(self._counter), operation
+                if len(self._slowest) < self.keep_slowest:
+                    heapq.heappush(self._slowest, entry)
+                elif entry > self._slowest[0]:
+                    heapq.heapreplace(self._slowest, entry)
+
+    def on_connect(self, host, transport, duration):
+        self.record(host, 'connect', type(transport).__name__, duration)
+
+    def on_command_end(self, host, command, duration, bytes_in, bytes_out):
+        first_byte = command.first_byte_time
+        if first_byte is not None:
+            first_byte -= command.start_time
+        self.record(host, 'command', command_name(command.argv), duration,
+                    first_byte=first_byte, bytes_in=bytes_in,
+                    bytes_out=bytes_out, detail=describe_argv(command.argv))
+
+    def on_transfer_end(self, host, kind, name, path, duration, size):
+        if kind == 'get':
+            sizes = {'bytes_in': size}
+        else:
+            sizes = {'bytes_out': size}
+        self.record(host, kind, name, duration,
+                    detail='%s %s' % (name, path), **sizes)
+
+    def to_dict(self):
+        """Return the aggregated metrics as a JSON-compatible dict
+
+        The "operations" list has one entry per host, kind and name;
+        "hosts" has totals for each host.
+        """
+        with self._lock:
+            items = sorted(self._aggregates.items())
+            operations = []
+            hosts = collections.OrderedDict()
+            for (host, kind, name), aggregate in items:
+                entry = collections.OrderedDict([
+                    ('host', host), ('kind', kind), ('name', name)])
+                entry.update(aggregate.to_dict())
+                operations.append(entry)
+                totals = hosts.setdefault(host, collections.OrderedDict([
+                    ('count', 0), ('total_time', 0.0),
+                    ('bytes_in', 0), ('bytes_out', 0)]))
+                totals['count'] += aggregate.count
+                totals['total_time'] += aggregate.total_time
+                totals['bytes_in'] += aggregate.bytes_in
+                totals['bytes_out'] += aggregate.bytes_out
+        return {'hosts': hosts, 'operations': operations}
+
+    def write(self, filename):
+        """Write the metrics to a file
+
+        If the filename ends with ``.csv``, one CSV row is written for each
+        host, kind and name. Otherwise, the output is JSON (see to_dict).
+        """
+        data = self.to_dict()
+        if filename.endswith('.csv'):
+            with open(filename, 'w') as f:
+                writer = csv.writer(f)
+                header = None
+                for entry in data['operations']:
+                    histogram = entry.pop('histogram')
+                    if header is None:
+                        header = list(entry) + list(histogram)
+                        writer.writerow(header)
+                    writer.writerow(list(entry.values()) +
+                                    list(histogram.values()))
+        else:
+            with open(filename, 'w') as f:
+                json.dump(data, f, indent=2)
+
+
+def command_name(argv):
+    """Return the name of a command (its first word), for aggregation"""
+    if isinstance(argv, (list, tuple)):
+        name = argv[0] if argv else ''
+    else:
+        name = argv.split(None, 1)[0] if argv.strip() else ''
+    if isinstance(name, bytes):
+        name = name.decode('utf-8', 'replace')
+    return name
+
+
+def describe_argv(argv):
+    """Return a one-line description of a command, for reports"""
+    if isinstance(argv, bytes):
+        argv = argv.decode('utf-8', 'replace')
+    if isinstance(argv, (list, tuple)):
+        argv = ' '.join(
+            arg.decode('utf-8', 'replace') if isinstance(arg, bytes)
+            else str(arg)
+            for arg in argv)
+    return ' '.join(argv.split())
@@ -2,24 +2,58 @@
 # Copyright (C) 2014 pytest-multihost contributors. See COPYING for license
 #
 
+import hashlib
 import json
+import logging
 import os
-import traceback
+import tempfile
+import time
 
 import pytest
 
-from pytest_multihost.config import Config, FilterError
+from pytest_multihost import util
 
-try:
-    import yaml
-except ImportError:
-    yaml = None
+# The rest of pytest_multihost, and PyYAML, are only imported when needed,
+# so pytest runs that do not use multihost tests start quickly
 
 
 def pytest_addoption(parser):
     parser.addoption(
         '--multihost-config', dest="multihost_config",
         help="Site configuration for multihost tests")
+    parser.addoption(
+        '--multihost-connect-all', dest="multihost_connect_all",
+        action='store_true', default=False,
+        help="Connect to all hosts of a multihost fixture in parallel "
+             "when the fixture is set up")
+    parser.addoption(
+        '--multihost-metrics', dest="multihost_metrics", metavar='FILE',
+        help="Record timings of commands, file transfers and connections, "
+             "and write them to FILE (CSV if it ends in .csv, otherwise "
+             "JSON) at the end of the session")
+    parser.addoption(
+        '--multihost-durations', dest="multihost_durations", type=int,
+        metavar='N',
+        help="Show the N slowest remote commands and file transfers "
+             "in the terminal summary")
+    parser.addoption(
+        '--multihost-log-queue', dest="multihost_log_queue",
+        action='store_true', default=False,
+        help="Handle log messages of hosts in a background thread, so "
+             "that logging never slows down reading of command output")
+    parser.addoption(
+        '--multihost-log-dir', dest="multihost_log_dir", metavar='DIR',
+        help="Write all log messages of each host, including output of "
+             "commands, to DIR/<hostname>.log")
+    parser.addoption(
+        '--multihost-record', dest="multihost_record", metavar='FILE',
+        help="Record results of all remote commands and file operations "
+             "in the cassette FILE")
+    parser.addoption(
+        '--multihost-replay', dest="multihost_replay", metavar='FILE',
+        help="Do not connect to any host; replay results of remote "
+             "commands and file operations from the cassette FILE "
+             "(made with --multihost-record)")
 
 
 @pytest.mark.tryfirst
@@ -27,35 +61,253 @@ def pytest_load_initial_conftests(args, early_config, parser):
     ns = early_config.known_args_namespace
     if ns.multihost_config:
         try:
-            conffile = open(ns.multihost_config)
+            confdict = load_config_file(ns.multihost_config)
         except IOError as e:
             raise exit('Unable to open multihost configuration file %s: %s\n'
                        'Please check path of configuration file and retry.'
                        % (ns.multihost_config, e.args[1]))
-        with conffile:
-            if yaml:
-                confdict = yaml.safe_load(conffile)
-            else:
-                try:
-                    confdict = json.load(conffile)
-                except Exception:
-                    traceback.print_exc()
-                    raise exit(
-                        'Could not load %s. If it is a YAML file, you need '
-                        'PyYAML installed.' % ns.multihost_config)
-        plugin = MultihostPlugin(confdict)
+        except ValueError as e:
+            raise exit('Could not load multihost configuration file %s: %s'
+                       % (ns.multihost_config, e))
+        if ns.multihost_record and ns.multihost_replay:
+            raise exit('--multihost-record and --multihost-replay '
+                       'cannot be used together')
+        if ns.multihost_record:
+            confdict['cassette'] = ns.multihost_record
+            confdict['cassette_mode'] = 'record'
+        elif ns.multihost_replay:
+            confdict['cassette'] = ns.multihost_replay
+            confdict['cassette_mode'] = 'replay'
+        plugin = MultihostPlugin(
+            confdict, connect_all=ns.multihost_connect_all,
+            metrics_file=ns.multihost_metrics,
+            durations=ns.multihost_durations,
+            log_queue=ns.multihost_log_queue,
+            log_dir=ns.multihost_log_dir)
         pluginmanager = early_config.pluginmanager.register(
             plugin, 'MultihostPlugin')
 
 
+# Keys of configuration values that are not written to the config cache:
+# passwords and paths of private keys. Configurations with any of these
+# are parsed each time.
+CREDENTIAL_KEYS = frozenset([
+    'ssh_password', 'ssh_key_filename', 'root_password',
+    'root_ssh_key_filename', 'admin_password', 'password',
+])
+
+# Cached configurations written longer ago than this (in seconds) are
+# removed when another configuration is cached
+CONFIG_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
+
+def get_config_cache_file(filename):
+    """Return the name of the cache file for the named configuration file
+    """
+    path = os.path.abspath(filename).encode('utf-8')
+    return os.path.join(util.get_cache_dir(), 'config-%s.json' %
+                        hashlib.sha256(path).hexdigest()[:16])
+
+
+def parse_config(contents):
+    """Parse the contents of a configuration file (a bytestring)
+
+    YAML is used if PyYAML is installed (with the C-accelerated loader,
+    if available); otherwise the contents must be JSON.
+    Raises ValueError if the contents cannot be parsed.
+    """
+    try:
+        import yaml
+    except ImportError:
+        try:
+            return json.loads(contents.decode('utf-8')), 'json'
+        except ValueError as e:
+            raise ValueError('%s (PyYAML is not installed, so the file '
+                             'was parsed as JSON)' % e)
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    try:
+        return yaml.load(contents, Loader=loader), 'yaml'
+    except yaml.YAMLError as e:
+        raise ValueError(e)
+
+
+def load_config_file(filename, cache_file=None):
+    """Load a configuration file, using a cache of parsed configurations
+
+    Parsing YAML is slow, so the parsed configuration is cached (as JSON) in
+    ``cache_file`` (by default, in the per-user pytest-multihost cache
+    directory), together with the file's mtime and SHA-256.
+    If both still match, the cached configuration is used.
+
+    Configurations that contain credentials (see CREDENTIAL_KEYS) are not
+    cached. When a configuration is cached, old cache files (see
+    CONFIG_CACHE_MAX_AGE) are removed.
+    """
+    with open(filename, 'rb') as f:
+        mtime = os.fstat(f.fileno()).st_mtime
+        contents = f.read()
+    sha256 = hashlib.sha256(contents).hexdigest()
+    if cache_file is None:
+        cache_file = get_config_cache_file(filename)
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+    except (IOError, OSError, ValueError):
+        cached = None
+    if (isinstance(cached, dict) and cached.get('mtime') == mtime and
+            cached.get('sha256') == sha256):
+        return cached['confdict']
+
+    confdict, parser = parse_config(contents)
+    if _has_credentials(confdict):
+        _remove_file(cache_file)
+        return confdict
+    try:
+        data = json.dumps({'mtime': mtime, 'sha256': sha256,
+                           'parser': parser, 'confdict': confdict})
+    except (TypeError, ValueError):
+        # Not representable in JSON (e.g. YAML dates); don't cache
+        return confdict
+    if json.loads(data)['confdict'] != confdict:
+        return confdict
+    try:
+        directory = os.path.dirname(cache_file)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp_name = tempfile.mkstemp(dir=directory, prefix='.config.')
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.rename(tmp_name, cache_file)
+    except (IOError, OSError):
+        pass
+    else:
+        _remove_old_cache_files(directory)
+    return confdict
+
+
+def _has_credentials(value):
+    """Return true if a parsed configuration has any CREDENTIAL_KEYS set"""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key in CREDENTIAL_KEYS and item:
+                return True
+            if _has_credentials(item):
+                return True
+    elif isinstance(value, list):
+        return any(_has_credentials(item) for item in value)
+    return False
+
+
+def _remove_file(filename):
+    """Remove a file if it exists, ignoring errors"""
+    try:
+        os.unlink(filename)
+    except (IOError, OSError):
+        pass
+
+
+def _remove_old_cache_files(directory):
+    """Remove cached configurations older than CONFIG_CACHE_MAX_AGE"""
+    limit = time.time() - CONFIG_CACHE_MAX_AGE
+    try:
+        names = os.listdir(directory)
+    except (IOError, OSError):
+        return
+    for name in names:
+        if name.startswith('config-') and name.endswith('.json'):
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.unlink(path)
+            except (IOError, OSError):
+                pass
+
+
 class MultihostPlugin(object):
     """The Multihost plugin
 
     The plugin is available as pluginmanager.getplugin('MultihostPlugin'),
     and its presence indicates that multihost testing has been configured.
+
+    If ``connect_all`` is true, make_multihost_fixture connects to all hosts
+    of the fixture in parallel (see Config.connect_all).
+
+    If ``metrics_file`` or ``durations`` is given, timings are collected in
+    ``metrics`` (added as a listener to every fixture's Config).
+    They are written to ``metrics_file`` at the end of the session,
+    and the ``durations`` slowest operations are shown in the terminal
+    summary.
+
+    If ``log_queue`` is true, log records of hosts are handled in
+    a background thread (see pytest_multihost.logs.LogQueue).
+    If ``log_dir`` is given, each host's log is written to a file in it.
     """
-    def __init__(self, confdict):
+    def __init__(self, confdict, connect_all=False, metrics_file=None,
+                 durations=None, log_queue=False, log_dir=None):
         self.confdict = confdict
+        self.connect_all = connect_all
+        self.metrics_file = metrics_file
+        self.durations = durations
+        if metrics_file or durations:
+            from pytest_multihost.metrics import Metrics
+            self.metrics = Metrics(keep_slowest=durations or 0)
+        else:
+            self.metrics = None
+        self.log_dir = log_dir
+        # Maps host logger names to their log file handlers
+        self._host_log_handlers = {}
+        if log_queue:
+            from pytest_multihost.logs import LogQueue
+            self.log_queue = LogQueue()
+            self.log_queue.add_logger('pytest_multihost')
+            self.log_queue.start()
+        else:
+            self.log_queue = None
+
+    def set_up_logging(self, config):
+        """Set up the log queue and log files for hosts of the given Config
+        """
+        from pytest_multihost.logs import add_host_log_file
+        for host in config.get_all_hosts():
+            if self.log_queue is not None:
+                self.log_queue.add_logger(host.logger_name)
+            name = host.logger_name
+            if self.log_dir and name not in self._host_log_handlers:
+                filename = os.path.join(self.log_dir, host.hostname + '.log')
+                self._host_log_handlers[name] = add_host_log_file(
+                    host, filename, log_queue=self.log_queue)
+
+    def pytest_unconfigure(self, config):
+        if self.log_queue is not None:
+            self.log_queue.stop()
+        for name, handler in self._host_log_handlers.items():
+            logging.getLogger(name).removeHandler(handler)
+            handler.close()
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_protocol(self, item, nextitem):
+        if self.metrics is not None:
+            self.metrics.context = item.nodeid
+        yield
+        if self.metrics is not None:
+            self.metrics.context = None
+
+    def pytest_sessionfinish(self, session):
+        if self.metrics is not None and self.metrics_file:
+            self.metrics.write(self.metrics_file)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if not self.durations:
+            return
+        slowest = self.metrics.slowest
+        terminalreporter.write_sep(
+            '=', 'slowest %s multihost operations' % self.durations)
+        if not slowest:
+            terminalreporter.write_line('(no remote operations)')
+        for operation in slowest:
+            terminalreporter.write_line('%.2fs %-7s %s: %s (%s)' % (
+                operation.duration, operation.kind, operation.host,
+                operation.detail, operation.context or 'outside of tests'))
 
 
 class MultihostFixture(object):
@@ -81,7 +333,7 @@ class MultihostFixture(object):
         return self
 
 
-def make_multihost_fixture(request, descriptions, config_class=Config,
+def make_multihost_fixture(request, descriptions, config_class=None,
                            _config=None):
     """Create a MultihostFixture, or skip the test
 
@@ -89,14 +341,21 @@ def make_multihost_fixture(request, descriptions, config_class=Config,
     :param descriptions:
         Descriptions of wanted domains (see README or Domain.filter)
     :param config_class: Custom Config class to use
+                         (default: pytest_multihost.config.Config)
     :param _config:
         Config to be used directly.
         Intended mostly for testing the plugin itself.
 
     Skips the test if there are not enough resources configured.
+
+    If the ``--multihost-connect-all`` option was given, connects to all
+    the hosts in parallel before returning.
     """
+    from pytest_multihost.config import Config, FilterError
+    if config_class is None:
+        config_class = Config
+    plugin = request.config.pluginmanager.getplugin('MultihostPlugin')
     if _config is None:
-        plugin = request.config.pluginmanager.getplugin('MultihostPlugin')
         if not plugin:
             pytest.skip('Multihost tests not configured')
         confdict = plugin.confdict
@@ -105,4 +364,10 @@ def make_multihost_fixture(request, descriptions, config_class=Config,
         _config.filter(descriptions)
     except FilterError as e:
         pytest.skip('Not enough resources configured: %s' % e)
+    if plugin and plugin.metrics is not None:
+        _config.add_listener(plugin.metrics)
+    if plugin:
+        plugin.set_up_logging(_config)
+    if plugin and plugin.connect_all:
+        _config.connect_all()
     return MultihostFixture(_config, request)
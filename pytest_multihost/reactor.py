@@ -0,0 +1,141 @@
+#
+# Copyright (C) 2014 pytest-multihost contributors. See COPYING for license
+#
+
+"""A single thread that reads output of all running Commands
+
+Reading output with a pair of threads per command gets expensive when many
+commands run at once. The Reactor watches all the file descriptors
+(paramiko channels or ``ssh`` pipes) with a selector, and calls a callback
+when one of them becomes readable.
+
+The selectors module is needed (Python 3.4+); if it is not available,
+``have_selectors`` is false and Commands fall back to reader threads.
+"""
+
+import os
+import threading
+import logging
+
+try:
+    import selectors
+    have_selectors = True
+except ImportError:
+    have_selectors = False
+
+
+class Reactor(object):
+    """Calls callbacks when file descriptors become readable
+
+    All callbacks are called from the reactor's thread, which is started
+    on first use. They must not block.
+    """
+    def __init__(self):
+        self.log = logging.getLogger('%s.%s' % (__name__,
+                                                type(self).__name__))
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._pending = []
+        self._thread = None
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ)
+
+    def add_reader(self, fd, callback, on_error=None):
+        """Call ``callback()`` whenever ``fd`` is readable
+
+        If ``fd`` cannot be watched, or ``callback`` raises an exception,
+        ``fd`` is no longer watched, and ``on_error(exception)`` is called
+        (from the reactor's thread) so the owner can clean up.
+
+        May be called from any thread.
+        """
+        with self._lock:
+            self._pending.append((fd, callback, on_error))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='multihost-reactor')
+                self._thread.daemon = True
+                self._thread.start()
+        os.write(self._wakeup_write, b'x')
+
+    def remove_reader(self, fd):
+        """Stop watching ``fd``
+
+        Must be called from a callback (i.e. from the reactor's thread).
+        """
+        self._selector.unregister(fd)
+
+    def _run(self):
+        while True:
+            try:
+                ready = self._selector.select()
+            except Exception as e:
+                # Probably a watched fd was closed; drop the bad ones
+                self.log.exception('Error waiting for output')
+                self._drop_bad_fds(e)
+                continue
+            for key, events in ready:
+                if key.fd == self._wakeup_read:
+                    os.read(self._wakeup_read, 4096)
+                    with self._lock:
+                        pending, self._pending = self._pending, []
+                    for fd, callback, on_error in pending:
+                        try:
+                            self._selector.register(fd, selectors.EVENT_READ,
+                                                    (callback, on_error))
+                        except Exception as e:
+                            self.log.exception('Cannot watch fd %s', fd)
+                            self._call_on_error(on_error, e)
+                else:
+                    callback, on_error = key.data
+                    try:
+                        callback()
+                    except Exception as e:
+                        self.log.exception('Error reading from fd %s', key.fd)
+                        self._fail(key.fd, on_error, e)
+
+    def _fail(self, fd, on_error, exception):
+        """Stop watching ``fd`` and tell its owner about the error"""
+        try:
+            self._selector.unregister(fd)
+        except (KeyError, ValueError, OSError):
+            # Already unregistered (e.g. by the callback itself)
+            pass
+        self._call_on_error(on_error, exception)
+
+    def _call_on_error(self, on_error, exception):
+        if on_error is not None:
+            try:
+                on_error(exception)
+            except Exception:
+                self.log.exception('Error in error handler')
+
+    def _drop_bad_fds(self, exception):
+        """Stop watching closed fds, after select() failed
+
+        If no fd looks closed, all of them are dropped, so that the
+        reactor doesn't keep failing.
+        """
+        keys = [key for key in list(self._selector.get_map().values())
+                if key.fd != self._wakeup_read]
+        bad_keys = []
+        for key in keys:
+            try:
+                os.fstat(key.fd)
+            except OSError:
+                bad_keys.append(key)
+        for key in bad_keys or keys:
+            self._fail(key.fd, key.data[1], exception)
+
+
+_reactor = None
+_reactor_lock = threading.Lock()
+
+
+def get_reactor():
+    """Return the process-wide Reactor"""
+    global _reactor
+    with _reactor_lock:
+        if _reactor is None:
+            _reactor = Reactor()
+        return _reactor
@@ -9,29 +9,169 @@
 This class defines "SSHTransport" as ParamikoTransport (by default), or as
 OpenSSHTransport (if Paramiko is not importable, or the
 PYTESTMULTIHOST_SSH_TRANSPORT environment variable is set to "openssh").
+
+LocalTransport runs everything on the local machine, without SSH.
+RecordingTransport and ReplayTransport record the operations of another
+transport in a cassette, and serve them later without any connection.
 """
 
 import os
 import socket
+import collections
 import threading
 import subprocess
 from contextlib import contextmanager
 import errno
+import hashlib
 import logging
 import io
 import sys
+import uuid
+import mmap
+import tempfile
+import tarfile
+import shutil
+import time
+import functools
+from stat import S_IMODE
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from pytest_multihost import util
+from pytest_multihost import reactor
+from pytest_multihost import manifest
+from pytest_multihost import cassette
+from pytest_multihost.metrics import describe_argv
+
+# Paramiko takes a while to import, so it is only imported when
+# a ParamikoTransport is created (see _import_paramiko)
+paramiko = None
+
+
+def _find_paramiko():
+    """Return true if Paramiko is installed, without importing it"""
+    try:
+        from importlib.util import find_spec
+    except ImportError:
+        import imp
+        try:
+            imp.find_module('paramiko')
+        except ImportError:
+            return False
+        return True
+    return find_spec('paramiko') is not None
 
-try:
+
+def _import_paramiko():
+    """Import Paramiko, and return the module"""
+    global paramiko
     import paramiko
-    have_paramiko = True
-except ImportError:
-    have_paramiko = False
+    return paramiko
+
+
+have_paramiko = _find_paramiko()
 
 
 DEFAULT = object()
 
+# Maximum number of output chunks waiting to be consumed from a streamed
+# Command. When reached, reading from the remote process is paused.
+STREAM_QUEUE_SIZE = 64
+
+# Maximum number of bytes read from a channel or pipe at once
+READ_SIZE = 64 * 1024
+
+# Default number of bytes of a Command's output stream kept in memory.
+# Any more output is written to a temporary file.
+SPILL_SIZE = 32 * 1024 * 1024
+
+# Per-thread state of _timed_transfer
+_transfer_timing = threading.local()
+
+
+def _timed_transfer(kind, path_arg, get_size):
+    """Decorator that reports a Transport method to the config's listeners
+
+    :param kind: Kind of the transfer: 'get' or 'put'
+    :param path_arg: ``(index, name)`` of the method's remote path argument
+    :param get_size: Function called with ``(args, kwargs, result)`` of the
+                     method that returns the number of bytes transferred
+
+    The ``transfer_start`` and ``transfer_end`` events are sent
+    (see Config.add_listener).
+    Transfers made while another one is being reported in the same thread
+    (e.g. put_file implemented using put_file_contents) are not reported.
+    """
+    def decorator(function):
+        name = function.__name__
+
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            config = self.host.config
+            if (not config.listeners or
+                    getattr(_transfer_timing, 'active', False)):
+                return function(self, *args, **kwargs)
+            path = _arg(args, kwargs, *path_arg)
+            config.notify('transfer_start', self.host, kind, name, path)
+            _transfer_timing.active = True
+            start = time.time()
+            try:
+                result = function(self, *args, **kwargs)
+            finally:
+                _transfer_timing.active = False
+            config.notify('transfer_end', self.host, kind, name, path,
+                          time.time() - start,
+                          get_size(args, kwargs, result))
+            return result
+        return wrapper
+    return decorator
+
+
+def _arg(args, kwargs, index, name):
+    if len(args) > index:
+        return args[index]
+    return kwargs[name]
+
+
+_timed_get_file_contents = _timed_transfer(
+    'get', (0, 'filename'), lambda args, kwargs, result: len(result))
+_timed_put_file_contents = _timed_transfer(
+    'put', (0, 'filename'),
+    lambda args, kwargs, result: len(_arg(args, kwargs, 1, 'contents')))
+_timed_get_file = _timed_transfer(
+    'get', (0, 'remotepath'), lambda args, kwargs, result: os.path.getsize(
+        _arg(args, kwargs, 1, 'localpath')))
+_timed_put_file = _timed_transfer(
+    'put', (1, 'remotepath'), lambda args, kwargs, result: os.path.getsize(
+        _arg(args, kwargs, 0, 'localpath')))
+_timed_get_dir = _timed_transfer(
+    'get', (0, 'remotepath'), lambda args, kwargs, result: 0)
+_timed_put_dir = _timed_transfer(
+    'put', (1, 'remotepath'), lambda args, kwargs, result: 0)
+
+
+def _get_upload_mtime():
+    """Return the mtime to give files uploaded with skip_if_same
+
+    The transport remembers it (see Transport._remember_upload), so it is
+    in whole seconds, like the mtimes from get_file_signature.
+    """
+    return int(time.time())
+
+
+def _as_bytes(data):
+    """Return a copy of a bytes-like object (e.g. a memoryview) as bytes
+
+    On Python 2, ``bytes(memoryview)`` would give the view's repr.
+    """
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return bytes(data)
+
+
 class Transport(object):
     """Mechanism for communicating with remote hosts
 
@@ -44,6 +184,9 @@ class Transport(object):
         self.logger_name = '%s.%s' % (host.logger_name, type(self).__name__)
         self.log = host.config.get_logger(self.logger_name)
         self._command_index = 0
+        # Maps remote filenames to (sha256, signature) of files uploaded
+        # with skip_if_same
+        self._uploaded_files = {}
 
     def get_file_contents(self, filename, encoding=None):
         """Read the named remote file and return the contents
@@ -53,14 +196,96 @@ class Transport(object):
         """
         raise NotImplementedError('Transport.get_file_contents')
 
-    def put_file_contents(self, filename, contents, encoding='utf-8'):
+    def put_file_contents(self, filename, contents, encoding='utf-8',
+                          verify=False, skip_if_same=False):
         """Write the given string (or bytestring) to the named remote file
 
         The contents string will be encoded using the given encoding
         (default: ``'utf-8'``), unless aleady a bytestring.
+
+        If ``verify`` is true, the SHA-256 checksum of the remote file is
+        checked after writing (see verify_file_contents).
+
+        If ``skip_if_same`` is true, nothing is written if the remote file
+        already has the same contents (see is_file_unchanged).
         """
         raise NotImplementedError('Transport.put_file_contents')
 
+    def get_file_signature(self, filename):
+        """Return the ``(size, mtime)`` of the named remote file
+
+        Returns None if the file does not exist.
+        The mtime is in whole seconds.
+        """
+        self.log.debug('STAT %s', filename)
+        cmd = self.start_shell(['stat', filename], log_stdout=False)
+        quoted = util.shell_quote(filename.encode('utf-8'))
+        cmd.stdin.write(b"stat -L -c '%%s %%Y' -- %s\nexit\n" % quoted)
+        cmd.stdin.flush()
+        cmd.wait(raiseonerr=False)
+        if cmd.returncode != 0:
+            return None
+        size, mtime = cmd.stdout_text.split()
+        return int(size), int(mtime)
+
+    def is_file_unchanged(self, filename, sha256):
+        """Return true if the remote file has the given SHA-256 digest
+
+        Used for ``skip_if_same`` uploads. If the file was uploaded by this
+        transport with the same contents, and its size and mtime did not
+        change since, only a stat is done. Otherwise the remote file's
+        checksum is computed.
+        """
+        signature = None
+        cached = self._uploaded_files.get(filename)
+        if cached and cached[0] == sha256:
+            signature = self.get_file_signature(filename)
+            if signature == cached[1]:
+                self.log.debug('UNCHANGED %s', filename)
+                return True
+        if self.get_file_sha256(filename) == sha256:
+            self.log.debug('UNCHANGED %s', filename)
+            if signature is None:
+                signature = self.get_file_signature(filename)
+            self._remember_upload(filename, sha256, signature)
+            return True
+        return False
+
+    def _remember_upload(self, filename, sha256, signature):
+        """Remember the digest and ``(size, mtime)`` of an uploaded file
+
+        Uploads should know the signature without asking the remote host,
+        typically by setting the mtime as part of the upload
+        (see _get_upload_mtime).
+        """
+        self._uploaded_files[filename] = (sha256, signature)
+
+    def get_file_sha256(self, filename):
+        """Return the hex SHA-256 digest of the named remote file
+
+        Returns None if the file does not exist (or cannot be read).
+        Uses ``sha256sum`` on the remote host.
+        """
+        self.log.debug('SHA256 %s', filename)
+        cmd = self.start_shell(['sha256sum', filename], log_stdout=False)
+        quoted = util.shell_quote(filename.encode('utf-8'))
+        cmd.stdin.write(b'sha256sum %s\nexit\n' % quoted)
+        cmd.stdin.flush()
+        cmd.wait(raiseonerr=False)
+        if cmd.returncode != 0:
+            return None
+        return cmd.stdout_text.split(' ', 1)[0]
+
+    def verify_file_contents(self, filename, contents):
+        """Raise IOError unless the remote file has the given contents
+
+        Only the SHA-256 checksums are transferred and compared.
+        """
+        expected = hashlib.sha256(contents).hexdigest()
+        if self.get_file_sha256(filename) != expected:
+            raise IOError('Checksum of %r does not match uploaded contents' %
+                          filename)
+
     def file_exists(self, filename):
         """Return true if the named remote file exists"""
         raise NotImplementedError('Transport.file_exists')
@@ -69,7 +294,8 @@ class Transport(object):
         """Make the named directory"""
         raise NotImplementedError('Transport.mkdir')
 
-    def start_shell(self, argv, log_stdout=True, encoding=None):
+    def start_shell(self, argv, log_stdout=True, encoding=None,
+                    stream=False, max_output=None, spill_size=DEFAULT):
         """Start a Shell
 
         :param argv: The command this shell is intended to run (used for
@@ -78,6 +304,15 @@ class Transport(object):
                            binary output is expected)
         :param encoding: Encoding for the resulting Command's ``stdout_text``
                          and ``stderr_text``.
+        :param stream: If true, standard output can be iterated over while
+                       the command runs (see Command.iter_stdout)
+        :param max_output: Maximum number of bytes of each output stream to
+                           keep in memory (None for no limit).
+                           Older output is discarded.
+        :param spill_size: Number of bytes of each output stream to keep in
+                           memory before moving it to a temporary file
+                           (default: the module's SPILL_SIZE; None to never
+                           use a file). Not used if max_output is given.
 
         Given a `shell` from this method, the caller can then use
         ``shell.stdin.write()`` to input any command(s), call ``shell.wait()``
@@ -89,24 +324,304 @@ class Transport(object):
         raise NotImplementedError('Transport.start_shell')
 
     def mkdir_recursive(self, path):
-        """`mkdir -p` on the remote host"""
-        if not self.file_exists(path):
+        """`mkdir -p` on the remote host
+
+        If the host has a POSIX shell (see BaseHost.posix_shell), this is
+        a single ``mkdir -p`` command. Otherwise, each missing directory is
+        checked and made separately with file_exists and mkdir (which
+        need no shell with ParamikoTransport).
+        """
+        if self.host.posix_shell:
+            with self.batch() as batch:
+                batch.mkdir(path, parents=True)
+        elif not self.file_exists(path):
             parent_path = os.path.dirname(path)
             if path != parent_path:
                 self.mkdir_recursive(parent_path)
             self.mkdir(path)
 
+    def batch(self):
+        """Return a FileBatch for queueing several file operations
+
+        Use as a context manager; the queued operations are run in a single
+        remote shell when the block ends::
+
+            with transport.batch() as batch:
+                batch.mkdir('/tmp/a/b', parents=True)
+                batch.chmod('/tmp/a/b', 0o700)
+                exists = batch.file_exists('/tmp/c')
+            print(exists.value)
+        """
+        return FileBatch(self)
+
+    @_timed_get_file
     def get_file(self, remotepath, localpath):
         """Copy a file from the remote host to a local file"""
         contents = self.get_file_contents(remotepath, encoding=None)
         with open(localpath, 'wb') as local_file:
             local_file.write(contents)
 
-    def put_file(self, localpath, remotepath):
-        """Copy a local file to the remote host"""
+    @_timed_put_file
+    def put_file(self, localpath, remotepath, skip_if_same=False):
+        """Copy a local file to the remote host
+
+        If ``skip_if_same`` is true, nothing is written if the remote file
+        already has the same contents (see is_file_unchanged).
+        """
         with open(localpath, 'rb') as local_file:
             contents = local_file.read()
-        self.put_file_contents(remotepath, contents, encoding=None)
+        self.put_file_contents(remotepath, contents, encoding=None,
+                               skip_if_same=skip_if_same)
+
+    @_timed_put_dir
+    def put_dir(self, localpath, remotepath, compress=False):
+        """Copy a local directory tree to the remote host
+
+        The tree is sent as a tar archive over a single shell, so the number
+        of round trips does not depend on the number of files.
+        Symlinks are copied as symlinks, and file modes are preserved.
+        The remote directory is created if needed; existing files in it are
+        overwritten.
+
+        :param compress: If true, the archive is compressed with gzip
+        """
+        self.log.info('PUT DIR %s', remotepath)
+        quoted = util.shell_quote(remotepath.encode('utf-8'))
+        tar = b'tar -x -p --no-same-owner'
+        if compress:
+            tar += b' -z'
+        cmd = self.start_shell(['tar', '-x', '-C', remotepath],
+                               log_stdout=False)
+        # The archive follows the script on stdin; the shell is replaced
+        # by tar so it doesn't try to read the archive as commands
+        cmd.stdin.write(b'mkdir -p %s && exec %s -C %s -f - || exit\n' %
+                        (quoted, tar, quoted))
+        mode = 'w|gz' if compress else 'w|'
+        with tarfile.open(fileobj=cmd.stdin, mode=mode) as archive:
+            archive.add(localpath, arcname='.')
+        cmd.wait(raiseonerr=False)
+        if cmd.returncode != 0:
+            raise IOError('Directory %r could not be written: %s' %
+                          (remotepath, cmd.stderr_text.strip()))
+
+    @_timed_get_dir
+    def get_dir(self, remotepath, localpath, compress=False):
+        """Copy a remote directory tree to a local directory
+
+        The counterpart of put_dir; the archive is streamed from a remote
+        ``tar`` and extracted as it is received.
+        The local directory is created if needed.
+
+        :param compress: If true, the archive is compressed with gzip
+        """
+        self.log.info('GET DIR %s', remotepath)
+        quoted = util.shell_quote(remotepath.encode('utf-8'))
+        tar = b'tar -c'
+        if compress:
+            tar += b' -z'
+        cmd = self.start_shell(['tar', '-c', '-C', remotepath],
+                               log_stdout=False, stream=True)
+        cmd.stdin.write(b'exec %s -C %s -f - .\n' % (tar, quoted))
+        cmd.stdin.flush()
+        if not os.path.isdir(localpath):
+            os.makedirs(localpath)
+        mode = 'r|gz' if compress else 'r|'
+        kwargs = {}
+        if hasattr(tarfile, 'tar_filter'):
+            kwargs['filter'] = 'tar'
+        try:
+            with tarfile.open(fileobj=_ChunkReader(cmd.iter_stdout()),
+                              mode=mode) as archive:
+                archive.extractall(localpath, **kwargs)
+        except tarfile.TarError as e:
+            error = e
+        else:
+            error = None
+        cmd.wait(raiseonerr=False)
+        if cmd.returncode != 0 or error:
+            raise IOError('Directory %r could not be read: %s' %
+                          (remotepath, cmd.stderr_text.strip() or error))
+
+    def get_remote_manifest(self, path, hash_cache=None):
+        """Return SHA-256 digests of all regular files under a remote directory
+
+        The result maps relative paths (with ``/`` as separator) to hex
+        digests.
+        If the directory does not exist, the result is empty.
+
+        :param hash_cache: A manifest.HashCache. If given, the remote files
+                           are listed with their size and mtime first, and
+                           only files not in the cache are read and hashed.
+                           Otherwise all files are hashed by a single
+                           remote command.
+        """
+        self.log.debug('MANIFEST %s', path)
+        if hash_cache is None:
+            return self._get_remote_sha256s(path)
+        stats = self.get_remote_file_stats(path)
+        result = {}
+        for relpath, (size, mtime) in stats.items():
+            sha256 = hash_cache.lookup(self._cache_key(path, relpath),
+                                       size, mtime)
+            if sha256 is not None:
+                result[relpath] = sha256
+        missing = sorted(set(stats) - set(result))
+        if missing:
+            hashed = self._get_remote_sha256s(path, missing)
+            for relpath, sha256 in hashed.items():
+                if relpath in stats:
+                    size, mtime = stats[relpath]
+                    hash_cache.store(self._cache_key(path, relpath),
+                                     size, mtime, sha256)
+                    result[relpath] = sha256
+        return result
+
+    def get_remote_file_stats(self, path):
+        """Return sizes and mtimes of regular files under a remote directory
+
+        The result maps relative paths (with ``/`` as separator) to
+        ``(size, mtime)``, with the mtime in nanoseconds.
+        No file contents are read. Uses GNU ``find`` on the remote host.
+        """
+        quoted = util.shell_quote(path.encode('utf-8'))
+        cmd = self.start_shell(['find', path, '-type', 'f', '-printf'],
+                               log_stdout=False)
+        cmd.stdin.write(b'cd %s 2>/dev/null || exit 0\n' % quoted)
+        cmd.stdin.write(b"find . -type f -printf '%s %T@ %P\\0'\n")
+        cmd.stdin.write(b'exit\n')
+        cmd.stdin.flush()
+        cmd.wait()
+        result = {}
+        for entry in cmd.stdout_bytes.split(b'\0'):
+            if entry:
+                size, mtime, relpath = entry.decode('utf-8').split(' ', 2)
+                result[relpath] = int(size), manifest.parse_mtime(mtime)
+        return result
+
+    def _get_remote_sha256s(self, path, relpaths=None):
+        """Hash the given files (default: all regular files) under ``path``
+
+        Returns a dict like get_remote_manifest.
+        """
+        quoted = util.shell_quote(path.encode('utf-8'))
+        if relpaths is None:
+            cmd = self.start_shell(
+                ['find', path, '-type', 'f', '-exec', 'sha256sum'],
+                log_stdout=False)
+            cmd.stdin.write(b'cd %s 2>/dev/null || exit 0\n' % quoted)
+            cmd.stdin.write(
+                b'find . -type f -print0 | xargs -0 -r sha256sum --\n')
+            cmd.stdin.write(b'exit\n')
+            prefix = './'
+        else:
+            cmd = self.start_shell(
+                ['sha256sum', '--'] + [os.path.join(path, relpath)
+                                       for relpath in relpaths],
+                log_stdout=False)
+            # The shell is replaced by xargs, which reads the rest of stdin
+            cmd.stdin.write(b'cd %s 2>/dev/null && '
+                            b'exec xargs -0 -r sha256sum -- || exit 0\n' %
+                            quoted)
+            cmd.stdin.write(b''.join(relpath.encode('utf-8') + b'\0'
+                                     for relpath in relpaths))
+            prefix = ''
+        cmd.stdin.flush()
+        cmd.wait(raiseonerr=relpaths is None)
+        result = {}
+        for line in cmd.stdout_bytes.decode('utf-8').splitlines():
+            if line.startswith('\\'):
+                # sha256sum escapes unusual filenames; treat them as missing
+                continue
+            sha256, filename = line.split('  ', 1)
+            result[filename[len(prefix):]] = sha256
+        return result
+
+    def _cache_key(self, path, relpath):
+        """Key of a remote file in a manifest.HashCache"""
+        return '%s:%s' % (self.host.hostname,
+                          os.path.normpath(os.path.join(path, relpath)))
+
+    def sync_dir(self, localpath, remotepath, delete=False, cache_file=None):
+        """Make a remote directory tree match a local one, rsync-style
+
+        Only files whose SHA-256 differs from the remote file are copied.
+        Digests of local and remote files are cached between sessions in
+        ``cache_file`` (default: ``~/.cache/pytest-multihost/sha256.json``)
+        and only recomputed when a file's size or mtime changes.
+        Copied files get the mode and mtime of the local file.
+
+        The remote host needs GNU ``find``, ``touch`` and ``sha256sum``.
+
+        :param delete: If true, remote files that do not exist locally
+                       are removed
+        :return: Sorted list of the relative paths of copied files
+        """
+        self.log.info('SYNC DIR %s', remotepath)
+        hash_cache = manifest.get_hash_cache(cache_file)
+        local_manifest = manifest.get_local_manifest(localpath, hash_cache)
+        remote_manifest = self.get_remote_manifest(remotepath, hash_cache)
+
+        changed = sorted(
+            relpath for relpath, (size, mtime, sha256)
+            in local_manifest.items()
+            if remote_manifest.get(relpath) != sha256)
+        directories = set(os.path.dirname(relpath) for relpath in changed)
+        with self.batch() as batch:
+            for directory in sorted(directories):
+                batch.mkdir(
+                    os.path.normpath(os.path.join(remotepath, directory)),
+                    parents=True)
+        uploaded = []
+        for relpath in changed:
+            local_file = os.path.join(localpath, relpath)
+            stat = os.stat(local_file)
+            self.put_file(local_file, os.path.join(remotepath, relpath))
+            uploaded.append((relpath, stat))
+        with self.batch() as batch:
+            for relpath, stat in uploaded:
+                remote_file = os.path.join(remotepath, relpath)
+                batch.chmod(remote_file, S_IMODE(stat.st_mode))
+                batch.set_mtime(remote_file, manifest.format_mtime(
+                    manifest.get_mtime_ns(stat)))
+            if delete:
+                for relpath in sorted(set(remote_manifest) -
+                                      set(local_manifest)):
+                    batch.remove_file(os.path.join(remotepath, relpath))
+        # The copies now have known sizes and mtimes, so they need not be
+        # hashed again in the next sync
+        for relpath, stat in uploaded:
+            hash_cache.store(self._cache_key(remotepath, relpath),
+                             stat.st_size, manifest.get_mtime_ns(stat),
+                             local_manifest[relpath][2])
+        hash_cache.save()
+        return changed
+
+    def open_shell_channel(self):
+        """Open a channel for running a remote shell
+
+        The result follows the subset of the ``paramiko.Channel`` interface
+        that SSHCommand uses (see SSHCallWrapper).
+        """
+        raise NotImplementedError('Transport.open_shell_channel')
+
+    def get_persistent_shell(self, init_script=b''):
+        """Return the PersistentShell of this transport, starting it if needed
+
+        :param init_script: Script to run once when a new shell is started
+                            (for example, to source env.sh)
+        """
+        shell = getattr(self, '_persistent_shell', None)
+        if shell is None or shell.closed:
+            shell = PersistentShell(self, init_script=init_script)
+            self._persistent_shell = shell
+        return shell
+
+    def close_persistent_shell(self):
+        """Stop the PersistentShell of this transport, if it is running"""
+        shell = getattr(self, '_persistent_shell', None)
+        if shell is not None:
+            shell.close()
+            del self._persistent_shell
 
     def get_next_command_logger_name(self):
         self._command_index += 1
@@ -125,6 +640,112 @@ class Transport(object):
         raise NotImplementedError('Transport.remove_file')
 
 
+class FileBatch(object):
+    """Queue of file operations run in one remote shell
+
+    Obtained from Transport.batch(). The operations run in the order they
+    were queued when run() is called (or the ``with`` block ends).
+    If an operation fails, the rest is skipped and IOError is raised.
+    """
+    def __init__(self, transport):
+        self.transport = transport
+        self._lines = []
+        self._results = []
+
+    def _add(self, log_message, argv, result=None):
+        self.transport.log.info(*log_message)
+        self._lines.append(b' '.join(util.shell_quote(arg.encode('utf-8'))
+                                     for arg in argv))
+        self._results.append(result)
+
+    def mkdir(self, path, parents=False):
+        """Make the named directory (with ``parents``, like `mkdir -p`)"""
+        if parents:
+            self._add(('MKDIR -P %s', path), ['mkdir', '-p', '--', path])
+        else:
+            self._add(('MKDIR %s', path), ['mkdir', '--', path])
+
+    def rmdir(self, path):
+        """Remove the named (empty) directory"""
+        self._add(('RMDIR %s', path), ['rmdir', '--', path])
+
+    def remove_file(self, filepath):
+        """Remove the named file"""
+        self._add(('REMOVE FILE %s', filepath), ['rm', '--', filepath])
+
+    def rename_file(self, oldpath, newpath):
+        """Rename a file"""
+        self._add(('RENAME %s TO %s', oldpath, newpath),
+                  ['mv', '--', oldpath, newpath])
+
+    def chmod(self, path, mode):
+        """Change the mode of the named file (mode is an integer)"""
+        self._add(('CHMOD %o %s', mode, path),
+                  ['chmod', '%o' % mode, '--', path])
+
+    def set_mtime(self, path, mtime):
+        """Set the modification time of the named file
+
+        ``mtime`` is in seconds since the epoch; it may be a string with
+        more precision than a float has (see manifest.format_mtime).
+        Uses GNU ``touch``.
+        """
+        self._add(('SET MTIME %s %s', mtime, path),
+                  ['touch', '-m', '-d', '@%s' % (mtime,), '--', path])
+
+    def file_exists(self, path):
+        """Check whether the named file exists
+
+        Returns a FileBatchResult whose ``value`` is set when the batch runs.
+        """
+        result = FileBatchResult()
+        self._add(('STAT %s', path), ['test', '-e', path], result)
+        return result
+
+    def run(self):
+        """Run the queued operations"""
+        lines, self._lines = self._lines, []
+        results, self._results = self._results, []
+        if not lines:
+            return
+        script = []
+        for line, result in zip(lines, results):
+            if result is None:
+                script.append(line + b' || exit')
+            else:
+                script.append(line + b'; echo $?')
+        cmd = self.transport.start_shell(['batch'] + [line.decode('utf-8')
+                                                      for line in lines],
+                                         log_stdout=False)
+        cmd.stdin.write(b'\n'.join(script) + b'\nexit\n')
+        cmd.stdin.flush()
+        cmd.wait(raiseonerr=False)
+        statuses = iter(cmd.stdout_bytes.split())
+        for result in results:
+            if result is not None:
+                status = next(statuses, None)
+                if status is not None:
+                    result.value = (status == b'0')
+        if cmd.returncode != 0:
+            raise IOError('File operation failed: %s' %
+                          cmd.stderr_text.strip())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.run()
+
+
+class FileBatchResult(object):
+    """Result of a query in a FileBatch
+
+    ``value`` is None until the batch runs.
+    """
+    value = None
+
+
 class _decoded_output_property(object):
     """Descriptor for on-demand decoding of a Command's output stream
     """
@@ -146,6 +767,24 @@ class _decoded_output_property(object):
             return decoded
 
 
+class _output_bytes_property(object):
+    """Descriptor for a Command's output stream stored in an OutputBuffer
+
+    Used when the output was not set directly, e.g. because it was moved
+    to a temporary file. The output is read on first access.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        output = instance._get_output_buffer(self.name)
+        bytestring = output.getvalue()
+        setattr(instance, self.name + '_bytes', bytestring)
+        return bytestring
+
+
 class Command(object):
     """A Popen-style object representing a remote command
 
@@ -155,11 +794,20 @@ class Command(object):
     The standard error and output are handled by this class. They're not
     available for file-like reading, and are logged by default.
     To make sure reading doesn't stall after one buffer fills up, they are read
-    in parallel using threads.
+    in parallel, either by the process-wide Reactor (see
+    pytest_multihost.reactor) or, for streamed commands, using threads.
+    If the command was started with ``stream=True``, the standard output
+    can be iterated over while the command runs, using ``iter_stdout()``
+    or ``iter_stdout_lines()``.
 
     After calling wait(), ``stdout_bytes`` and ``stderr_bytes`` attributes will
     be bytestrings containing the output, and ``returncode`` will contain the
     exit code.
+    Large output is kept in a temporary file rather than in memory
+    (see the ``spill_size`` argument of Transport.start_shell); it is only
+    read into memory when ``stdout_bytes``/``stderr_bytes`` is accessed.
+    The ``stdout_file`` and ``stderr_file`` properties give read-only
+    file-like access to the output without reading it all at once.
 
     The ``stdout_text`` and ``stdout_text`` will be the corresponding output
     decoded using the given ``encoding`` (default: ``'utf-8'``).
@@ -187,10 +835,131 @@ class Command(object):
         self.log = get_logger(self.logger_name)
         self.encoding = encoding
         self.raiseonerr = True
-
+        self.start_time = time.time()
+        self.end_time = None
+        self._done_callbacks = []
+        self._first_output_callbacks = []
+        self._callback_lock = threading.Lock()
+
+    stdout_bytes = _output_bytes_property('stdout')
+    stderr_bytes = _output_bytes_property('stderr')
     stdout_text = _decoded_output_property('stdout')
     stderr_text = _decoded_output_property('stderr')
 
+    def _get_output_buffer(self, name):
+        """Return the OutputBuffer for the given stream of a finished command
+        """
+        output = self.__dict__.get('_' + name)
+        if not self._done or output is None:
+            raise AttributeError('%s_bytes' % name)
+        return output
+
+    @property
+    def stdout_file(self):
+        """Read-only file-like object with the standard output
+
+        Available after wait(). Each access returns a new object.
+        """
+        if 'stdout_bytes' in self.__dict__:
+            return io.BytesIO(self.stdout_bytes)
+        return self._get_output_buffer('stdout').open()
+
+    @property
+    def stderr_file(self):
+        """Read-only file-like object with the standard error output
+
+        Available after wait(). Each access returns a new object.
+        """
+        if 'stderr_bytes' in self.__dict__:
+            return io.BytesIO(self.stderr_bytes)
+        return self._get_output_buffer('stderr').open()
+
+    @property
+    def first_byte_time(self):
+        """Time (as from time.time()) the first output was received, or None
+        """
+        times = [output.first_write_time
+                 for output in (self.__dict__.get('_stdout'),
+                                self.__dict__.get('_stderr'))
+                 if output is not None and output.first_write_time]
+        return min(times) if times else None
+
+    @property
+    def output_size(self):
+        """Total number of bytes of output received (including discarded)"""
+        return sum(output.total_size
+                   for output in (self.__dict__.get('_stdout'),
+                                  self.__dict__.get('_stderr'))
+                   if output is not None)
+
+    def add_first_output_callback(self, callback):
+        """Call ``callback(command)`` when the first output is received
+
+        If some output was already received, the callback is called
+        immediately. Otherwise it is called from the thread that reads
+        the output, so it must not block.
+        """
+        with self._callback_lock:
+            if self.first_byte_time is None:
+                self._first_output_callbacks.append(callback)
+                return
+        callback(self)
+
+    def _on_first_output(self):
+        """Called (once for each output stream) when output starts"""
+        with self._callback_lock:
+            callbacks = self._first_output_callbacks
+            self._first_output_callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """Call ``callback(command)`` when the command finishes
+
+        The callback is called from wait(), after the process ends and before
+        the exit code is checked.
+        """
+        self._done_callbacks.append(callback)
+
+    def _run_done_callbacks(self):
+        self.end_time = time.time()
+        for callback in self._done_callbacks:
+            callback(self)
+
+    # Queue of streamed stdout chunks (None if not streaming)
+    _stdout_queue = None
+    _stream_done = False
+
+    def iter_stdout(self):
+        """Iterate over chunks of standard output as they are received
+
+        Only available if the command was started with ``stream=True``.
+        The output can only be iterated over once.
+        """
+        if self._stdout_queue is None:
+            raise ValueError('Command was not started with stream=True')
+        while not self._stream_done:
+            chunk = self._stdout_queue.get()
+            if chunk is None:
+                self._stream_done = True
+            else:
+                yield chunk
+
+    def iter_stdout_lines(self):
+        """Iterate over lines (bytestrings) of standard output
+
+        Only available if the command was started with ``stream=True``.
+        The lines include the trailing newline, if any.
+        """
+        partial = b''
+        for chunk in self.iter_stdout():
+            lines = (partial + chunk).split(b'\n')
+            partial = lines.pop()
+            for line in lines:
+                yield line + b'\n'
+        if partial:
+            yield partial
+
     def wait(self, raiseonerr=DEFAULT):
         """Wait for the remote process to exit
 
@@ -207,7 +976,15 @@ class Command(object):
             return self.returncode
 
         self._end_process()
+        self._run_done_callbacks()
+
+        return self._check_returncode(raiseonerr)
+
+    def _check_returncode(self, raiseonerr):
+        """Mark the command as done and log (or raise on) the exit code
 
+        Called from wait() after the process has ended
+        """
         self._done = True
 
         if raiseonerr and self.returncode:
@@ -235,9 +1012,25 @@ class ParamikoTransport(Transport):
     """Transport that uses the Paramiko SSH2 library"""
     def __init__(self, host):
         super(ParamikoTransport, self).__init__(host)
+        _import_paramiko()
         sock = socket.create_connection((host.external_hostname,
                                          host.ssh_port))
-        self._transport = transport = paramiko.Transport(sock)
+        tuning = host.effective_ssh_tuning
+        transport_kwargs = {}
+        if tuning.get('window_size'):
+            transport_kwargs['default_window_size'] = tuning['window_size']
+        if tuning.get('max_packet_size'):
+            transport_kwargs['default_max_packet_size'] = (
+                tuning['max_packet_size'])
+        self._transport = transport = paramiko.Transport(sock,
+                                                         **transport_kwargs)
+        if tuning.get('compression'):
+            transport.use_compression(True)
+        if tuning.get('ciphers'):
+            transport.get_security_options().ciphers = tuple(
+                tuning['ciphers'])
+        if tuning.get('options'):
+            self.log.debug('Ignoring OpenSSH options: %s', tuning['options'])
         transport.connect(hostkey=host.host_key)
         if host.ssh_key_filename:
             filename = os.path.expanduser(host.ssh_key_filename)
@@ -279,22 +1072,89 @@ class ParamikoTransport(Transport):
             self._sftp = paramiko.SFTPClient.from_transport(transport)
             return self._sftp
 
+    @contextmanager
+    def _sftp_open_tuned(self, filename, mode):
+        """Like sftp_open, but set up according to the sftp_* config options
+
+        If ``sftp_pipelining`` is on, reads are prefetched and writes are
+        pipelined, so many requests are in flight at once instead of
+        waiting a round trip for each.
+        ``sftp_chunk_size`` sets the size of each read/write request, and
+        ``sftp_max_requests`` limits the number of outstanding reads.
+        """
+        config = self.host.config
+        with self.sftp_open(filename, mode) as f:
+            f.MAX_REQUEST_SIZE = config.sftp_chunk_size
+            if config.sftp_pipelining:
+                if 'r' in mode:
+                    size = f.stat().st_size
+                    if config.sftp_max_requests:
+                        try:
+                            f.prefetch(size, config.sftp_max_requests)
+                        except TypeError:
+                            # Paramiko before 3.3 can't limit the requests
+                            f.prefetch(size)
+                    else:
+                        f.prefetch(size)
+                else:
+                    f.set_pipelined(True)
+            yield f
+
+    @_timed_get_file_contents
     def get_file_contents(self, filename, encoding=None):
         """Read the named remote file and return the contents as a string"""
         self.log.debug('READ %s', filename)
-        with self.sftp_open(filename, 'rb') as f:
+        with self._sftp_open_tuned(filename, 'rb') as f:
             result = f.read()
         if encoding:
             result = result.decode(encoding)
         return result
 
-    def put_file_contents(self, filename, contents, encoding=None):
+    @_timed_put_file_contents
+    def put_file_contents(self, filename, contents, encoding=None,
+                          verify=False, skip_if_same=False):
         """Write the given string to the named remote file"""
-        self.log.info('WRITE %s', filename)
         if encoding and not isinstance(contents, bytes):
             contents = contents.encode(encoding)
-        with self.sftp_open(filename, 'wb') as f:
+        if skip_if_same:
+            sha256 = hashlib.sha256(contents).hexdigest()
+            if self.is_file_unchanged(filename, sha256):
+                return
+        self.log.info('WRITE %s', filename)
+        with self._sftp_open_tuned(filename, 'wb') as f:
             f.write(contents)
+            if skip_if_same:
+                signature = self._set_mtime(f, len(contents))
+        if verify:
+            self.verify_file_contents(filename, contents)
+        if skip_if_same:
+            self._remember_upload(filename, sha256, signature)
+
+    def _set_mtime(self, remote_file, size):
+        """Set the mtime of a file being written
+
+        Returns the ``(size, mtime)`` signature of the file, or None if
+        the mtime could not be set (then is_file_unchanged compares
+        checksums instead).
+        """
+        remote_file.flush()
+        mtime = _get_upload_mtime()
+        try:
+            remote_file.utime((mtime, mtime))
+        except IOError as e:
+            self.log.debug('Could not set mtime: %s', e)
+            return None
+        return size, mtime
+
+    def get_file_signature(self, filename):
+        self.log.debug('STAT %s', filename)
+        try:
+            attrs = self.sftp.stat(filename)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        return attrs.st_size, int(attrs.st_mtime)
 
     def file_exists(self, filename):
         """Return true if the named remote file exists"""
@@ -312,22 +1172,53 @@ class ParamikoTransport(Transport):
         self.log.info('MKDIR %s', path)
         self.sftp.mkdir(path)
 
-    def start_shell(self, argv, log_stdout=True, encoding='utf-8'):
+    def open_shell_channel(self):
+        return self._transport.open_channel('session')
+
+    def start_shell(self, argv, log_stdout=True, encoding='utf-8',
+                    stream=False, max_output=None, spill_size=DEFAULT):
         logger_name = self.get_next_command_logger_name()
-        ssh = self._transport.open_channel('session')
+        ssh = self.open_shell_channel()
         self.log.info('RUN %s', argv)
         return SSHCommand(ssh, argv, logger_name=logger_name,
                           log_stdout=log_stdout,
                           get_logger=self.host.config.get_logger,
-                          encoding=encoding)
+                          encoding=encoding, stream=stream,
+                          max_output=max_output, spill_size=spill_size)
 
+    @_timed_get_file
     def get_file(self, remotepath, localpath):
         self.log.debug('GET %s', remotepath)
-        self.sftp.get(remotepath, localpath)
-
-    def put_file(self, localpath, remotepath):
+        chunk_size = self.host.config.sftp_chunk_size
+        with self._sftp_open_tuned(remotepath, 'rb') as remote_file:
+            with open(localpath, 'wb') as local_file:
+                while True:
+                    data = remote_file.read(chunk_size)
+                    if not data:
+                        break
+                    local_file.write(data)
+
+    @_timed_put_file
+    def put_file(self, localpath, remotepath, skip_if_same=False):
+        if skip_if_same:
+            sha256 = manifest.file_sha256(localpath)
+            if self.is_file_unchanged(remotepath, sha256):
+                return
         self.log.info('PUT %s', remotepath)
-        self.sftp.put(localpath, remotepath)
+        chunk_size = self.host.config.sftp_chunk_size
+        size = 0
+        with open(localpath, 'rb') as local_file:
+            with self._sftp_open_tuned(remotepath, 'wb') as remote_file:
+                while True:
+                    data = local_file.read(chunk_size)
+                    if not data:
+                        break
+                    remote_file.write(data)
+                    size += len(data)
+                if skip_if_same:
+                    signature = self._set_mtime(remote_file, size)
+        if skip_if_same:
+            self._remember_upload(remotepath, sha256, signature)
 
     def rmdir(self, path):
         self.log.info('RMDIR %s', path)
@@ -343,12 +1234,20 @@ class ParamikoTransport(Transport):
 
 
 class OpenSSHTransport(Transport):
-    """Transport that uses the `ssh` binary"""
+    """Transport that uses the `ssh` binary
+
+    Files are copied with the `sftp` binary, over the same (multiplexed)
+    connection. Set ``use_sftp`` to false if the remote host has no SFTP
+    subsystem; files will then be piped through `cat`.
+    """
+    use_sftp = True
+
     def __init__(self, host):
         super(OpenSSHTransport, self).__init__(host)
         self.control_dir = util.TempDir()
 
         self.ssh_argv = self._get_ssh_argv()
+        self.sftp_argv = self._get_sftp_argv()
 
         # Run a "control master" process. This serves two purposes:
         # - Establishes a control socket; other SSHs will connect to it
@@ -361,20 +1260,35 @@ class OpenSSHTransport(Transport):
         command = ['-o', 'ControlMaster=yes', '/usr/bin/cat']
         self.control_master = self._run(command, collect_output=False)
 
-    def _get_ssh_argv(self):
-        """Return the path to SSH and options needed for every call"""
+    def _get_ssh_options(self):
+        """Return the options needed for every call of `ssh` or `sftp`
+
+        Options from the host's ssh_tuning come first, so they take
+        precedence over the defaults.
+        """
         control_file = os.path.join(self.control_dir.path, 'control')
         known_hosts_file = os.path.join(self.control_dir.path, 'known_hosts')
 
-        argv = ['ssh',
-                '-l', self.host.ssh_username,
-                '-o', 'ControlPath=%s' % control_file,
-                '-o', 'StrictHostKeyChecking=no',
-                '-o', 'UserKnownHostsFile=%s' % known_hosts_file]
+        options = []
+        tuning = self.host.effective_ssh_tuning
+        for key, value in sorted(tuning.get('options', {}).items()):
+            options.extend(['-o', '%s=%s' % (key, value)])
+        if 'compression' in tuning:
+            options.extend(['-o', 'Compression=%s' % (
+                'yes' if tuning['compression'] else 'no')])
+        if tuning.get('ciphers'):
+            options.extend(['-o', 'Ciphers=%s' % ','.join(tuning['ciphers'])])
+        if tuning.get('window_size') or tuning.get('max_packet_size'):
+            self.log.debug('Window and packet size cannot be set for ssh')
+
+        options.extend(['-o', 'User=%s' % self.host.ssh_username,
+                        '-o', 'ControlPath=%s' % control_file,
+                        '-o', 'StrictHostKeyChecking=no',
+                        '-o', 'UserKnownHostsFile=%s' % known_hosts_file])
 
         if self.host.ssh_key_filename:
             key_filename = os.path.expanduser(self.host.ssh_key_filename)
-            argv.extend(['-i', key_filename])
+            options.extend(['-i', key_filename])
         elif self.host.ssh_password:
             self.log.critical('Password authentication not supported')
             raise RuntimeError('Password authentication not supported')
@@ -382,25 +1296,63 @@ class OpenSSHTransport(Transport):
             self.log.critical('No SSH credentials configured')
             raise RuntimeError('No SSH credentials configured')
 
+        return options
+
+    def _get_ssh_argv(self):
+        """Return the path to SSH and options needed for every call"""
+        argv = ['ssh'] + self._get_ssh_options()
         argv.append(self.host.external_hostname)
         self.log.debug('SSH invocation: %s', argv)
 
         return argv
 
-    def start_shell(self, argv, log_stdout=True, encoding='utf-8'):
+    def _get_sftp_argv(self):
+        """Return the `sftp` invocation that reads a batch from stdin"""
+        argv = ['sftp', '-b', '-'] + self._get_ssh_options()
+        argv.append(self.host.external_hostname)
+        return argv
+
+    def _sftp(self, batch, argv):
+        """Run the given sftp commands; return True if all succeeded
+
+        :param batch: List of sftp batch commands, with arguments already
+                      quoted (see _sftp_quote)
+        :param argv: Operation to log
+        """
+        logger_name = self.get_next_command_logger_name()
+        sftp = SSHCallWrapper(self.sftp_argv)
+        cmd = SSHCommand(sftp, argv, logger_name,
+                         get_logger=self.host.config.get_logger)
+        for line in batch:
+            cmd.stdin.write(line.encode('utf-8') + b'\n')
+        cmd.wait(raiseonerr=False)
+        return cmd.returncode == 0
+
+    def open_shell_channel(self):
+        return SSHCallWrapper(self.ssh_argv + ['bash'])
+
+    def start_shell(self, argv, log_stdout=True, encoding='utf-8',
+                    stream=False, max_output=None, spill_size=DEFAULT):
         self.log.info('RUN %s', argv)
         command = self._run(['bash'], argv=argv, log_stdout=log_stdout,
-                            encoding=encoding)
+                            encoding=encoding, stream=stream,
+                            max_output=max_output, spill_size=spill_size)
         return command
 
     def _run(self, command, log_stdout=True, argv=None, collect_output=True,
-             encoding='utf-8'):
+             encoding='utf-8', stream=False, max_output=None,
+             spill_size=DEFAULT):
         """Run the given command on the remote host
 
         :param command: Command to run (appended to the common SSH invocation)
         :param log_stdout: If false, stdout will not be logged
         :param argv: Command to log (if different from ``command``
         :param collect_output: If false, no output will be collected
+        :param stream: If true, stdout can be iterated over while the command
+                       runs
+        :param max_output: Maximum number of bytes of output to keep
+        :param spill_size: Number of bytes of output to keep in memory before
+                           using a temporary file
         """
         if argv is None:
             argv = command
@@ -409,7 +1361,8 @@ class OpenSSHTransport(Transport):
         return SSHCommand(ssh, argv, logger_name, log_stdout=log_stdout,
                           collect_output=collect_output,
                           get_logger=self.host.config.get_logger,
-                          encoding=encoding)
+                          encoding=encoding, stream=stream,
+                          max_output=max_output, spill_size=spill_size)
 
     def file_exists(self, path):
         self.log.info('STAT %s', path)
@@ -423,15 +1376,56 @@ class OpenSSHTransport(Transport):
         cmd = self._run(['mkdir', path])
         cmd.wait()
 
-    def put_file_contents(self, filename, contents, encoding='utf-8'):
-        self.log.info('PUT %s', filename)
+    @_timed_put_file_contents
+    def put_file_contents(self, filename, contents, encoding='utf-8',
+                          verify=False, skip_if_same=False):
         if encoding and not isinstance(contents, bytes):
             contents = contents.encode(encoding)
-        cmd = self._run(['tee', filename], log_stdout=False)
+        if skip_if_same:
+            sha256 = hashlib.sha256(contents).hexdigest()
+            if self.is_file_unchanged(filename, sha256):
+                return
+        self.log.info('PUT %s', filename)
+        # The contents are only sent one way; use verify to have them checked
+        command = ['cat', '>', filename]
+        if skip_if_same:
+            # Set the mtime in the same command, so it's known without a stat
+            mtime = _get_upload_mtime()
+            command += ['&&', 'touch', '-m', '-d', '@%d' % mtime, '--',
+                        filename]
+        cmd = self._run(command, log_stdout=False)
         cmd.stdin.write(contents)
         cmd.wait()
-        assert cmd.stdout_bytes == contents
+        if verify:
+            self.verify_file_contents(filename, contents)
+        if skip_if_same:
+            self._remember_upload(filename, sha256, (len(contents), mtime))
+
+    @_timed_get_file
+    def get_file(self, remotepath, localpath):
+        if not self.use_sftp:
+            return super(OpenSSHTransport, self).get_file(remotepath,
+                                                          localpath)
+        self.log.info('GET %s', remotepath)
+        batch = ['get %s %s' % (_sftp_quote(remotepath),
+                                _sftp_quote(localpath))]
+        if not self._sftp(batch, ['sftp', 'get', remotepath]):
+            raise IOError('File %r could not be read' % remotepath)
+
+    @_timed_put_file
+    def put_file(self, localpath, remotepath, skip_if_same=False):
+        if not self.use_sftp or skip_if_same:
+            # sftp can't set the mtime that skip_if_same needs to remember,
+            # so such uploads go through put_file_contents
+            return super(OpenSSHTransport, self).put_file(
+                localpath, remotepath, skip_if_same=skip_if_same)
+        self.log.info('PUT %s', remotepath)
+        batch = ['put %s %s' % (_sftp_quote(localpath),
+                                _sftp_quote(remotepath))]
+        if not self._sftp(batch, ['sftp', 'put', remotepath]):
+            raise IOError('File %r could not be written' % remotepath)
 
+    @_timed_get_file_contents
     def get_file_contents(self, filename, encoding=None):
         self.log.info('GET %s', filename)
         cmd = self._run(['cat', filename], log_stdout=False)
@@ -465,6 +1459,446 @@ class OpenSSHTransport(Transport):
                           % (oldpath, newpath))
 
 
+class LocalTransport(Transport):
+    """Transport that runs commands and accesses files on the local machine
+
+    Commands are run in a local ``bash``, as the current user; no SSH
+    connection is made. Selected with ``transport: local`` in a host's
+    configuration.
+    """
+    def open_shell_channel(self):
+        return SSHCallWrapper(['bash'])
+
+    def start_shell(self, argv, log_stdout=True, encoding='utf-8',
+                    stream=False, max_output=None, spill_size=DEFAULT):
+        logger_name = self.get_next_command_logger_name()
+        ssh = self.open_shell_channel()
+        self.log.info('RUN %s', argv)
+        return SSHCommand(ssh, argv, logger_name=logger_name,
+                          log_stdout=log_stdout,
+                          get_logger=self.host.config.get_logger,
+                          encoding=encoding, stream=stream,
+                          max_output=max_output, spill_size=spill_size)
+
+    @_timed_get_file_contents
+    def get_file_contents(self, filename, encoding=None):
+        self.log.debug('READ %s', filename)
+        with open(filename, 'rb') as f:
+            result = f.read()
+        if encoding:
+            result = result.decode(encoding)
+        return result
+
+    @_timed_put_file_contents
+    def put_file_contents(self, filename, contents, encoding='utf-8',
+                          verify=False, skip_if_same=False):
+        if encoding and not isinstance(contents, bytes):
+            contents = contents.encode(encoding)
+        if skip_if_same:
+            sha256 = hashlib.sha256(contents).hexdigest()
+            if self.is_file_unchanged(filename, sha256):
+                return
+        self.log.info('WRITE %s', filename)
+        with open(filename, 'wb') as f:
+            f.write(contents)
+        if verify:
+            self.verify_file_contents(filename, contents)
+        if skip_if_same:
+            # A local stat is cheap
+            self._remember_upload(filename, sha256,
+                                  self.get_file_signature(filename))
+
+    def get_file_sha256(self, filename):
+        self.log.debug('SHA256 %s', filename)
+        try:
+            return manifest.file_sha256(filename)
+        except (IOError, OSError):
+            return None
+
+    def get_file_signature(self, filename):
+        self.log.debug('STAT %s', filename)
+        try:
+            stat = os.stat(filename)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        return stat.st_size, int(stat.st_mtime)
+
+    def file_exists(self, filename):
+        self.log.debug('STAT %s', filename)
+        return os.path.exists(filename)
+
+    def mkdir(self, path):
+        self.log.info('MKDIR %s', path)
+        os.mkdir(path)
+
+    @_timed_get_file
+    def get_file(self, remotepath, localpath):
+        self.log.debug('GET %s', remotepath)
+        shutil.copyfile(remotepath, localpath)
+
+    @_timed_put_file
+    def put_file(self, localpath, remotepath, skip_if_same=False):
+        if skip_if_same:
+            sha256 = manifest.file_sha256(localpath)
+            if self.is_file_unchanged(remotepath, sha256):
+                return
+        self.log.info('PUT %s', remotepath)
+        shutil.copyfile(localpath, remotepath)
+        if skip_if_same:
+            self._remember_upload(remotepath, sha256,
+                                  self.get_file_signature(remotepath))
+
+    def rmdir(self, path):
+        self.log.info('RMDIR %s', path)
+        os.rmdir(path)
+
+    def remove_file(self, filepath):
+        self.log.info('REMOVE FILE %s', filepath)
+        os.remove(filepath)
+
+    def rename_file(self, oldpath, newpath):
+        self.log.info('RENAME %s TO %s', oldpath, newpath)
+        os.rename(oldpath, newpath)
+
+
+class RecordingTransport(Transport):
+    """Transport that records all operations in a cassette
+
+    The operations are done by a real transport (an instance of the host's
+    ``recorded_transport_class``). Their results are appended to the
+    cassette named by the ``cassette`` configuration key, so that
+    ReplayTransport can serve them later without connecting to the host
+    (see pytest_multihost.cassette).
+
+    Commands are recorded with everything written to their standard input
+    (for run_command, this is a script that includes the working directory,
+    the sourcing of env.sh and ``stdin_text``), their output and exit code.
+    Output discarded because of ``max_output`` is not recorded.
+    Transports for asyncio (``host.async_transport``) are not recorded.
+    """
+    def __init__(self, host):
+        super(RecordingTransport, self).__init__(host)
+        self.cassette = cassette.get_cassette(host.config.cassette, 'record')
+        self.recorded_transport = host.recorded_transport_class(host)
+
+    def _record_call(self, op, key, function, *args, **kwargs):
+        """Call the function and record its result (or IOError)"""
+        try:
+            result = function(*args, **kwargs)
+        except (IOError, OSError) as e:
+            self.cassette.record(self.host, op, key,
+                                 error=[e.errno, e.strerror or str(e)])
+            raise
+        self.cassette.record(self.host, op, key, result=result)
+        return result
+
+    def _record_command(self, op, command, stdin):
+        self.cassette.record(
+            self.host, op, [stdin.sha256.hexdigest()],
+            argv=describe_argv(command.argv), stdin=stdin.stored_data,
+            stdout=command._stdout.getvalue(),
+            stderr=command._stderr.getvalue(),
+            returncode=command.returncode)
+
+    def get_file_contents(self, filename, encoding=None):
+        result = self._record_call(
+            'get_file_contents', [filename],
+            self.recorded_transport.get_file_contents, filename)
+        if encoding:
+            result = result.decode(encoding)
+        return result
+
+    def put_file_contents(self, filename, contents, encoding='utf-8',
+                          verify=False, skip_if_same=False):
+        if encoding and not isinstance(contents, bytes):
+            contents = contents.encode(encoding)
+        self._record_call(
+            'put_file_contents',
+            [filename, hashlib.sha256(contents).hexdigest()],
+            self.recorded_transport.put_file_contents, filename, contents,
+            encoding=None, verify=verify, skip_if_same=skip_if_same)
+
+    def get_file_signature(self, filename):
+        return self._record_call(
+            'get_file_signature', [filename],
+            self.recorded_transport.get_file_signature, filename)
+
+    def get_file_sha256(self, filename):
+        return self._record_call(
+            'get_file_sha256', [filename],
+            self.recorded_transport.get_file_sha256, filename)
+
+    def file_exists(self, filename):
+        return self._record_call(
+            'file_exists', [filename],
+            self.recorded_transport.file_exists, filename)
+
+    def mkdir(self, path):
+        self._record_call('mkdir', [path],
+                          self.recorded_transport.mkdir, path)
+
+    def get_file(self, remotepath, localpath):
+        def get_file():
+            self.recorded_transport.get_file(remotepath, localpath)
+            with open(localpath, 'rb') as f:
+                return f.read()
+        self._record_call('get_file', [remotepath], get_file)
+
+    def put_file(self, localpath, remotepath, skip_if_same=False):
+        self._record_call(
+            'put_file', [remotepath, manifest.file_sha256(localpath)],
+            self.recorded_transport.put_file, localpath, remotepath,
+            skip_if_same=skip_if_same)
+
+    def rmdir(self, path):
+        self._record_call('rmdir', [path],
+                          self.recorded_transport.rmdir, path)
+
+    def remove_file(self, filepath):
+        self._record_call('remove_file', [filepath],
+                          self.recorded_transport.remove_file, filepath)
+
+    def rename_file(self, oldpath, newpath):
+        self._record_call('rename_file', [oldpath, newpath],
+                          self.recorded_transport.rename_file,
+                          oldpath, newpath)
+
+    def open_shell_channel(self):
+        return self.recorded_transport.open_shell_channel()
+
+    def start_shell(self, argv, log_stdout=True, encoding='utf-8',
+                    stream=False, max_output=None, spill_size=DEFAULT):
+        command = self.recorded_transport.start_shell(
+            argv, log_stdout=log_stdout, encoding=encoding, stream=stream,
+            max_output=max_output, spill_size=spill_size)
+        stdin = command.stdin = _StdinRecorder(command.stdin)
+        command.add_done_callback(
+            lambda command: self._record_command('command', command, stdin))
+        return command
+
+    def get_persistent_shell(self, init_script=b''):
+        shell = getattr(self, '_persistent_shell', None)
+        if shell is None or shell.closed:
+            shell = _RecordingShell(
+                self, self.recorded_transport.get_persistent_shell(
+                    init_script=init_script))
+            self._persistent_shell = shell
+        return shell
+
+
+class ReplayTransport(Transport):
+    """Transport that serves operations recorded by RecordingTransport
+
+    No connection is made; results of commands and file operations are
+    read from the cassette named by the ``cassette`` configuration key.
+    Each operation must have been recorded (with the same host, arguments,
+    and for commands the same standard input), otherwise LookupError
+    is raised. Identical operations get their results in the order they
+    were recorded.
+
+    Files are not actually written, except local files of get_file.
+    """
+    def __init__(self, host):
+        super(ReplayTransport, self).__init__(host)
+        self.cassette = cassette.get_cassette(host.config.cassette, 'replay')
+
+    def replay(self, op, key):
+        """Return the recorded result of an operation
+
+        If the operation raised IOError when recorded, it is raised again.
+        """
+        entry = self.cassette.replay(self.host, op, key)
+        error = entry.get('error')
+        if error:
+            error_number, message = error
+            if error_number:
+                raise IOError(error_number, message)
+            raise IOError(message)
+        return cassette.unpack(entry.get('result'))
+
+    @_timed_get_file_contents
+    def get_file_contents(self, filename, encoding=None):
+        self.log.debug('READ %s', filename)
+        result = self.replay('get_file_contents', [filename])
+        if encoding:
+            result = result.decode(encoding)
+        return result
+
+    @_timed_put_file_contents
+    def put_file_contents(self, filename, contents, encoding='utf-8',
+                          verify=False, skip_if_same=False):
+        if encoding and not isinstance(contents, bytes):
+            contents = contents.encode(encoding)
+        self.log.info('WRITE %s', filename)
+        self.replay('put_file_contents',
+                    [filename, hashlib.sha256(contents).hexdigest()])
+
+    def get_file_signature(self, filename):
+        self.log.debug('STAT %s', filename)
+        return self.replay('get_file_signature', [filename])
+
+    def get_file_sha256(self, filename):
+        self.log.debug('SHA256 %s', filename)
+        return self.replay('get_file_sha256', [filename])
+
+    def file_exists(self, filename):
+        self.log.debug('STAT %s', filename)
+        return self.replay('file_exists', [filename])
+
+    def mkdir(self, path):
+        self.log.info('MKDIR %s', path)
+        self.replay('mkdir', [path])
+
+    @_timed_get_file
+    def get_file(self, remotepath, localpath):
+        self.log.debug('GET %s', remotepath)
+        contents = self.replay('get_file', [remotepath])
+        with open(localpath, 'wb') as f:
+            f.write(contents)
+
+    @_timed_put_file
+    def put_file(self, localpath, remotepath, skip_if_same=False):
+        self.log.info('PUT %s', remotepath)
+        self.replay('put_file',
+                    [remotepath, manifest.file_sha256(localpath)])
+
+    def rmdir(self, path):
+        self.log.info('RMDIR %s', path)
+        self.replay('rmdir', [path])
+
+    def remove_file(self, filepath):
+        self.log.info('REMOVE FILE %s', filepath)
+        self.replay('remove_file', [filepath])
+
+    def rename_file(self, oldpath, newpath):
+        self.log.info('RENAME %s TO %s', oldpath, newpath)
+        self.replay('rename_file', [oldpath, newpath])
+
+    def open_shell_channel(self):
+        raise NotImplementedError('ReplayTransport.open_shell_channel')
+
+    def start_shell(self, argv, log_stdout=True, encoding='utf-8',
+                    stream=False, max_output=None, spill_size=DEFAULT):
+        logger_name = self.get_next_command_logger_name()
+        self.log.info('RUN %s', argv)
+        return ReplayCommand(self, 'command', argv, logger_name,
+                             log_stdout=log_stdout,
+                             get_logger=self.host.config.get_logger,
+                             encoding=encoding, stream=stream,
+                             max_output=max_output, spill_size=spill_size)
+
+    def get_persistent_shell(self, init_script=b''):
+        shell = getattr(self, '_persistent_shell', None)
+        if shell is None or shell.closed:
+            shell = _ReplayShell(self)
+            self._persistent_shell = shell
+        return shell
+
+
+class _StdinRecorder(object):
+    """Wrapper for a command's stdin that keeps the SHA-256 of the input
+
+    The input itself is also kept, unless it is larger than
+    cassette.MAX_STORED_STDIN.
+    """
+    def __init__(self, stdin=None):
+        self._stdin = stdin
+        self.sha256 = hashlib.sha256()
+        self._chunks = []
+        self._size = 0
+
+    @property
+    def stored_data(self):
+        """The input, or None if it was too large to keep"""
+        if self._chunks is None:
+            return None
+        return b''.join(self._chunks)
+
+    def write(self, data):
+        self.sha256.update(data)
+        self._size += len(data)
+        if self._chunks is not None:
+            if self._size > cassette.MAX_STORED_STDIN:
+                self._chunks = None
+            else:
+                self._chunks.append(_as_bytes(data))
+        if self._stdin is not None:
+            self._stdin.write(data)
+
+    def flush(self):
+        if self._stdin is not None:
+            self._stdin.flush()
+
+    def close(self):
+        if self._stdin is not None:
+            self._stdin.close()
+
+
+class _RecordingShell(object):
+    """PersistentShell wrapper that records commands (see RecordingTransport)
+    """
+    def __init__(self, transport, shell):
+        self.transport = transport
+        self.shell = shell
+
+    @property
+    def closed(self):
+        return self.shell.closed
+
+    def run(self, script, argv, **kwargs):
+        stdin = _StdinRecorder()
+        stdin.write(script)
+        command = self.shell.run(script, argv, **kwargs)
+        self.transport._record_command('persistent_command', command, stdin)
+        return command
+
+    def close(self):
+        self.shell.close()
+
+
+class _ReplayShell(object):
+    """Stand-in for PersistentShell used by ReplayTransport"""
+    def __init__(self, transport):
+        self.transport = transport
+        self.closed = False
+
+    def run(self, script, argv, log_stdout=True, encoding='utf-8',
+            in_subshell=True, max_output=None, spill_size=DEFAULT,
+            on_start=None):
+        if self.closed:
+            raise RuntimeError('Persistent shell is closed')
+        logger_name = self.transport.get_next_command_logger_name()
+        self.transport.log.info('RUN %s', argv)
+        config = self.transport.host.config
+        command = ReplayCommand(self.transport, 'persistent_command', argv,
+                                logger_name, log_stdout=log_stdout,
+                                get_logger=config.get_logger,
+                                encoding=encoding, max_output=max_output,
+                                spill_size=spill_size)
+        if on_start is not None:
+            on_start(command)
+        command.stdin.write(script)
+        return command
+
+    def close(self):
+        self.closed = True
+
+
+def _sftp_quote(path):
+    """Quote a path for a sftp batch file
+
+    All special characters are backslash-escaped, including the glob
+    characters that sftp expands in the paths of commands like ``get`` and
+    ``put``. (Double quotes can't be used: in quotes, sftp escapes glob
+    characters itself, so escaped ones would end up doubly escaped.)
+    """
+    for char in '\\"\' \t*?[':
+        path = path.replace(char, '\\' + char)
+    return path
+
+
 class SSHCallWrapper(object):
     """Adapts a /usr/bin/ssh call to the paramiko.Channel interface
 
@@ -492,21 +1926,149 @@ class SSHCallWrapper(object):
     def recv_exit_status(self):
         return self.command.wait()
 
+    def shutdown_write(self):
+        self.command.stdin.close()
+
     def close(self):
         return self.command.wait()
 
 
+class _ChunkReader(object):
+    """Read-only file-like object over an iterator of bytestrings
+
+    Used to feed a streamed Command's output to ``tarfile``.
+    """
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        result = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return result
+
+
+class OutputBuffer(object):
+    """Collects the output of one stream of a Command
+
+    :param max_size: Maximum number of bytes to keep (None for no limit).
+                     When it is exceeded, the oldest output is discarded.
+    :param stream_queue: If given, all chunks are also put in this queue,
+                         followed by None when the output ends.
+    :param spill_size: If more than this many bytes are written (and
+                       ``max_size`` is None), the output is moved to
+                       a temporary file.
+                       DEFAULT means the module's SPILL_SIZE, None disables.
+    :param on_first_write: Function called (with no arguments) when
+                           the first data is written
+    """
+    def __init__(self, max_size=None, stream_queue=None, spill_size=DEFAULT,
+                 on_first_write=None):
+        if spill_size is DEFAULT:
+            spill_size = SPILL_SIZE
+        self.on_first_write = on_first_write
+        self.max_size = max_size
+        self.stream_queue = stream_queue
+        self.spill_size = spill_size
+        self.chunks = collections.deque()
+        self.file = None
+        self.size = 0
+        self.total_size = 0
+        self.first_write_time = None
+
+    def write(self, data):
+        """Add a chunk of output
+
+        ``data`` may be any bytes-like object, such as a memoryview of
+        a reused buffer. It is only copied if it needs to be kept in memory.
+        """
+        if not self.total_size and data:
+            self.first_write_time = time.time()
+            if self.on_first_write is not None:
+                self.on_first_write()
+        self.total_size += len(data)
+        if self.stream_queue is not None:
+            self.stream_queue.put(_as_bytes(data))
+        if self.max_size == 0:
+            return
+        self.size += len(data)
+        if self.file is not None:
+            self.file.write(data)
+            return
+        self.chunks.append(_as_bytes(data))
+        if (self.max_size is None and self.spill_size is not None and
+                self.size > self.spill_size):
+            self.file = tempfile.TemporaryFile(prefix='multihost_output.')
+            self.file.writelines(self.chunks)
+            self.chunks.clear()
+        if self.max_size is not None:
+            while self.size > self.max_size:
+                excess = self.size - self.max_size
+                first = self.chunks[0]
+                if len(first) <= excess:
+                    self.chunks.popleft()
+                    self.size -= len(first)
+                else:
+                    self.chunks[0] = first[excess:]
+                    self.size -= excess
+
+    def close(self):
+        if self.stream_queue is not None:
+            self.stream_queue.put(None)
+
+    @property
+    def truncated(self):
+        """True if some of the output was discarded"""
+        return self.size < self.total_size
+
+    def getvalue(self):
+        if self.file is not None:
+            self.file.flush()
+            self.file.seek(0)
+            return self.file.read()
+        return b''.join(self.chunks)
+
+    def open(self):
+        """Return a new read-only file-like object with the output"""
+        if self.file is not None:
+            self.file.flush()
+            mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if sys.version_info < (3, ):
+                # Python 2's mmap has no file-like read() without a size
+                try:
+                    return io.BytesIO(mapped[:])
+                finally:
+                    mapped.close()
+            return mapped
+        return io.BytesIO(self.getvalue())
+
+
 class SSHCommand(Command):
     """Command implementation for ParamikoTransport and OpenSSHTranspport"""
     def __init__(self, ssh, argv, logger_name, log_stdout=True,
-                 collect_output=True, encoding='utf-8', get_logger=None):
+                 collect_output=True, encoding='utf-8', get_logger=None,
+                 stream=False, max_output=None, spill_size=DEFAULT):
         super(SSHCommand, self).__init__(argv, logger_name,
                                          log_stdout=log_stdout,
                                          get_logger=get_logger,
                                          encoding=encoding)
-        self._stdout_lines = []
-        self._stderr_lines = []
+        if stream:
+            self._stdout_queue = queue.Queue(STREAM_QUEUE_SIZE)
+        self._stdout = OutputBuffer(max_output, self._stdout_queue,
+                                    spill_size=spill_size,
+                                    on_first_write=self._on_first_output)
+        self._stderr = OutputBuffer(max_output, spill_size=spill_size,
+                                    on_first_write=self._on_first_output)
         self.running_threads = set()
+        self._output_done = None
+        self._output_error = None
 
         self._ssh = ssh
 
@@ -522,47 +2084,525 @@ class SSHCommand(Command):
             else:
                 return io.TextIOWrapper(file, encoding=encoding)
         self.stdin = self._ssh.makefile('wb')
-        stdout = self._ssh.makefile('rb')
-        stderr = self._ssh.makefile_stderr('rb')
 
-        if collect_output:
-            self._start_pipe_thread(self._stdout_lines, stdout, 'out',
+        if not collect_output:
+            self._stdout.close()
+        elif reactor.have_selectors and not stream:
+            self._start_reactor_reading(log_stdout)
+        else:
+            # A streamed command's reader may need to block until
+            # the caller consumes the output, so it gets its own threads
+            stdout = self._ssh.makefile('rb')
+            stderr = self._ssh.makefile_stderr('rb')
+            self._start_pipe_thread(self._stdout, stdout, 'out',
                                     log_stdout)
-            self._start_pipe_thread(self._stderr_lines, stderr, 'err', True)
+            self._start_pipe_thread(self._stderr, stderr, 'err', True)
 
     def _end_process(self):
         self.stdin.close()
+        # Let the remote process see the end of its input
+        self._ssh.shutdown_write()
+
+        if self._stdout_queue is not None:
+            # Discard any streamed output the caller did not consume,
+            # so the reader thread doesn't block on a full queue
+            for chunk in self.iter_stdout():
+                pass
 
         while self.running_threads:
             self.running_threads.pop().join()
-
-        self.stdout_bytes = b''.join(self._stdout_lines)
-        self.stderr_bytes = b''.join(self._stderr_lines)
+        if self._output_done is not None:
+            self._output_done.wait()
+        if self._output_error is not None:
+            # The output is incomplete; don't wait for a process
+            # that may be blocked writing it
+            if isinstance(self._ssh, SSHCallWrapper):
+                self._ssh.command.kill()
+            self._ssh.close()
+            raise self._output_error
+
+        for name, output in ('stdout', self._stdout), ('stderr', self._stderr):
+            if output.truncated:
+                self.log.debug('Kept only last %s of %s bytes of %s',
+                               output.size, output.total_size, name)
 
         self.returncode = self._ssh.recv_exit_status()
         self._ssh.close()
 
-    def _start_pipe_thread(self, result_list, stream, name, do_log=True):
-        """Start a thread that copies lines from ``stream`` to ``result_list``
+    def _start_pipe_thread(self, output, stream, name, do_log=True):
+        """Start a thread that copies output from ``stream`` to ``output``
 
-        If do_log is true, also logs the lines under ``name``
+        If do_log is true (and the logger is enabled for DEBUG),
+        the output is read line by line, and the lines are logged under
+        ``name``.
+        Otherwise it is read in chunks into a reused buffer:
+
+        * with ``readinto1`` (pipes of the ``ssh`` process), which returns
+          whatever is available;
+        * with ``readinto`` (e.g. Paramiko's channel files), which waits
+          until the buffer is full. This is only used if the output is not
+          streamed, so the chunks are not needed until the command ends.
 
         The thread is added to ``self.running_threads``.
         """
         log = self.get_logger(self.logger_name)
+        do_log = do_log and _debug_enabled(log)
+        if do_log:
+            readinto = None
+        elif hasattr(stream, 'readinto1'):
+            readinto = stream.readinto1
+        elif output.stream_queue is None and hasattr(stream, 'readinto'):
+            readinto = stream.readinto
+        else:
+            readinto = None
 
         def read_stream():
-            for line in stream:
-                if do_log:
-                    log.debug(line.rstrip(b'\n').decode('utf-8',
-                                                        errors='replace'))
-                result_list.append(line)
+            if readinto is None:
+                for line in stream:
+                    if do_log:
+                        log.debug(line.rstrip(b'\n').decode('utf-8',
+                                                            errors='replace'))
+                    output.write(line)
+            else:
+                # No need to split lines: read into a reused buffer
+                buffer = bytearray(READ_SIZE)
+                view = memoryview(buffer)
+                while True:
+                    size = readinto(buffer)
+                    if not size:
+                        break
+                    output.write(view[:size])
+            output.close()
 
         thread = threading.Thread(target=read_stream)
         self.running_threads.add(thread)
         thread.start()
         return thread
 
+    def _start_reactor_reading(self, log_stdout):
+        """Have the process-wide Reactor read the output
+
+        ``self._output_done`` is set when both streams are closed,
+        or when reading fails (then ``self._output_error`` is set as well).
+        """
+        log = self.get_logger(self.logger_name)
+        self._output_done = threading.Event()
+        outputs = {
+            'stdout': (self._stdout, _get_line_logger(log, log_stdout)),
+            'stderr': (self._stderr, _get_line_logger(log)),
+        }
+        the_reactor = reactor.get_reactor()
+
+        def end_stream(name):
+            output, line_logger = outputs.pop(name)
+            output.close()
+            if line_logger:
+                line_logger.flush()
+            if not outputs:
+                self._output_done.set()
+
+        readers = _get_output_readers(self._ssh)
+
+        def on_error(exception):
+            # Called from the reactor when reading (or watching) fails;
+            # stop reading and wake up _end_process
+            if self._output_error is None:
+                self._output_error = exception
+            try:
+                for fd, read in readers:
+                    try:
+                        the_reactor.remove_reader(fd)
+                    except (KeyError, ValueError, OSError):
+                        pass
+                for name in list(outputs):
+                    end_stream(name)
+            finally:
+                self._output_done.set()
+
+        def make_callback(fd, read):
+            def on_readable():
+                chunks = read()
+                eof = False
+                for name, data in chunks:
+                    if not data:
+                        eof = True
+                    if name not in outputs:
+                        continue
+                    if data:
+                        output, line_logger = outputs[name]
+                        output.write(data)
+                        if line_logger:
+                            line_logger.write(data)
+                    else:
+                        end_stream(name)
+                if eof:
+                    the_reactor.remove_reader(fd)
+            return on_readable
+
+        for fd, read in readers:
+            the_reactor.add_reader(fd, make_callback(fd, read), on_error)
+
+
+def _get_output_readers(ssh):
+    """Get non-blocking readers for output of a channel or SSHCallWrapper
+
+    Returns a list of ``(fd, read)`` pairs. When ``fd`` is readable,
+    ``read()`` returns a list of ``(name, data)`` pairs without blocking.
+    The name is 'stdout' or 'stderr'; empty data means the end of the stream.
+    Once ``read()`` signals the end of a stream, ``fd`` should not be watched
+    any more.
+
+    The data may be a memoryview of a buffer that is reused by the next
+    ``read()`` call, so it must be processed (or copied) before that.
+    """
+    if isinstance(ssh, SSHCallWrapper):
+        process = ssh.command
+
+        def pipe_reader(fd, name):
+            if hasattr(os, 'readv'):
+                buffer = bytearray(READ_SIZE)
+                view = memoryview(buffer)
+
+                def read():
+                    return [(name, view[:os.readv(fd, [buffer])])]
+            else:
+                def read():
+                    return [(name, os.read(fd, READ_SIZE))]
+            return fd, read
+
+        return [pipe_reader(process.stdout.fileno(), 'stdout'),
+                pipe_reader(process.stderr.fileno(), 'stderr')]
+    else:
+        def read():
+            # Check EOF first: any data received before EOF is read below
+            eof = ssh.eof_received or ssh.closed
+            chunks = []
+            while ssh.recv_ready():
+                chunks.append(('stdout', ssh.recv(READ_SIZE)))
+            while ssh.recv_stderr_ready():
+                chunks.append(('stderr', ssh.recv_stderr(READ_SIZE)))
+            if eof:
+                chunks.extend([('stdout', b''), ('stderr', b'')])
+            return chunks
+
+        return [(ssh.fileno(), read)]
+
+
+def _debug_enabled(log):
+    """Return true if the logger would emit DEBUG messages
+
+    Loggers that are not from the logging module are assumed to do so.
+    """
+    is_enabled_for = getattr(log, 'isEnabledFor', None)
+    return is_enabled_for is None or is_enabled_for(logging.DEBUG)
+
+
+def _get_line_logger(log, enabled=True):
+    """Return a _LineLogger for command output, or None if not logging
+
+    Output is not split into lines (let alone decoded) if the logger
+    is not enabled for DEBUG when the command starts.
+    """
+    if enabled and _debug_enabled(log):
+        return _LineLogger(log)
+    return None
+
+
+class _LineLogger(object):
+    """Logs output given in arbitrary chunks line by line, at DEBUG level"""
+    def __init__(self, log):
+        self.log = log
+        self.partial_line = b''
+
+    def write(self, data):
+        lines = (self.partial_line + _as_bytes(data)).split(b'\n')
+        self.partial_line = lines.pop()
+        for line in lines:
+            self.log.debug(line.decode('utf-8', errors='replace'))
+
+    def flush(self):
+        if self.partial_line:
+            self.log.debug(self.partial_line.decode('utf-8', errors='replace'))
+            self.partial_line = b''
+
+
+class PersistentShell(object):
+    """A long-lived shell on the remote host, running one command at a time
+
+    Starting a shell for each command costs a new channel (or a new ``ssh``
+    process) per command. A PersistentShell starts one ``bash`` and feeds it
+    command scripts one after another. Each script runs in a subshell (so
+    ``cd``, ``set -e`` or ``exit`` don't affect the next command), and is
+    followed by a marker unique to this shell, printed to both stdout and
+    stderr. The marker lets the output and exit code of each command be
+    separated from the next.
+
+    Use Transport.get_persistent_shell to get an instance.
+    """
+    def __init__(self, transport, init_script=b''):
+        self.transport = transport
+        self.log = transport.log
+        self.closed = False
+        self.marker = ('__pytest_multihost_%s__' % uuid.uuid4().hex).encode(
+            'ascii')
+        self._lock = threading.Lock()
+        self._command = None
+
+        self.log.info('START PERSISTENT SHELL')
+        self._ssh = transport.open_shell_channel()
+        self._ssh.invoke_shell()
+        self._stdin = self._ssh.makefile('wb')
+        self._threads = [
+            self._start_pipe_thread('stdout'),
+            self._start_pipe_thread('stderr'),
+        ]
+
+        if init_script:
+            init = self.run(init_script, '<persistent shell setup>',
+                            in_subshell=False)
+            init.wait(raiseonerr=False)
+
+    def run(self, script, argv, log_stdout=True, encoding='utf-8',
+            in_subshell=True, max_output=None, spill_size=DEFAULT,
+            on_start=None):
+        """Run the given script and wait until it finishes
+
+        :param script: Bytestring with the shell script to run. It should not
+                       read from the shell's standard input.
+        :param argv: The command this script is intended to run (used for
+                     logging only)
+        :param log_stdout: If false, the stdout will not be logged
+        :param encoding: Encoding for the resulting Command's ``stdout_text``
+                         and ``stderr_text``.
+        :param in_subshell: If false, the script is run directly in the
+                            persistent shell, so it can e.g. set variables
+                            for all subsequent commands.
+        :param max_output: Maximum number of bytes of each output stream to
+                           keep in memory (None for no limit)
+        :param spill_size: Number of bytes of each output stream to keep in
+                           memory before using a temporary file
+        :param on_start: If given, called with the new Command just before
+                         the script is sent to the shell (e.g. to add
+                         callbacks that should see the command run)
+
+        Returns a finished PersistentShellCommand;
+        call its ``wait()`` method to check the exit code.
+        """
+        logger_name = self.transport.get_next_command_logger_name()
+        self.log.info('RUN %s', argv)
+        command = PersistentShellCommand(
+            argv, logger_name, log_stdout=log_stdout,
+            get_logger=self.transport.host.config.get_logger,
+            encoding=encoding, max_output=max_output, spill_size=spill_size)
+        if in_subshell:
+            script = b'(\n' + script + b'\n) </dev/null\n'
+        else:
+            script = script + b'\n'
+        script += b"printf '%%s %%d\\n' %s \"$?\"\n" % self.marker
+        script += b"printf '%%s\\n' %s >&2\n" % self.marker
+
+        with self._lock:
+            if self.closed:
+                raise RuntimeError('Persistent shell is closed')
+            if on_start is not None:
+                on_start(command)
+            self._command = command
+            try:
+                self._stdin.write(script)
+                self._stdin.flush()
+            except Exception:
+                self._command = None
+                self.close()
+                raise
+            command._finished.wait()
+            self._command = None
+        return command
+
+    def close(self):
+        """Stop the shell"""
+        if not self.closed:
+            self.closed = True
+            self.log.info('STOP PERSISTENT SHELL')
+            try:
+                self._stdin.close()
+            except (IOError, OSError, EOFError):
+                pass
+
+    def _get_chunk_reader(self, name):
+        """Return a function that reads the next chunk of the named stream
+
+        The function blocks until some data is available (not until
+        a whole chunk is), and returns an empty bytestring at the end.
+        """
+        if isinstance(self._ssh, SSHCallWrapper):
+            if name == 'stdout':
+                fd = self._ssh.makefile('rb').fileno()
+            else:
+                fd = self._ssh.makefile_stderr('rb').fileno()
+            return lambda: os.read(fd, READ_SIZE)
+        elif name == 'stdout':
+            return lambda: self._ssh.recv(READ_SIZE)
+        else:
+            return lambda: self._ssh.recv_stderr(READ_SIZE)
+
+    def _start_pipe_thread(self, name):
+        """Start a thread that dispatches output of a stream to commands
+
+        The output is given to the currently running command; the marker
+        (and the rest of its line) ends the current command's output on the
+        stream.
+        The output is read in chunks, not lines. Only a marker-length tail
+        of each chunk is kept, in case the marker is split between chunks.
+        """
+        marker = self.marker
+        read = self._get_chunk_reader(name)
+
+        def read_stream():
+            pending = b''
+            # True if the marker was found, but not the end of its line
+            in_marker_line = False
+            while True:
+                chunk = read()
+                if not chunk:
+                    break
+                pending += chunk
+                while pending:
+                    command = self._command
+                    if in_marker_line:
+                        end = pending.find(b'\n')
+                        if end < 0:
+                            break
+                        rest = pending[:end].strip()
+                        pending = pending[end + 1:]
+                        in_marker_line = False
+                        if command is not None:
+                            returncode = int(rest) if rest else None
+                            command._end_stream(name, returncode)
+                        continue
+                    index = pending.find(marker)
+                    if index >= 0:
+                        data = pending[:index]
+                        pending = pending[index + len(marker):]
+                        in_marker_line = True
+                    else:
+                        keep = len(marker) - 1
+                        data = pending[:-keep]
+                        pending = pending[-keep:]
+                    if data and command is not None:
+                        command._add_output(name, data)
+                    if index < 0:
+                        break
+            self.closed = True
+            command = self._command
+            if command is not None:
+                if pending and not in_marker_line:
+                    command._add_output(name, pending)
+                command._end_stream(name, self._ssh.recv_exit_status())
+
+        thread = threading.Thread(target=read_stream)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class PersistentShellCommand(Command):
+    """Command run in a PersistentShell
+
+    The output is provided by the shell's reader threads.
+    """
+    def __init__(self, argv, logger_name, log_stdout=True,
+                 encoding='utf-8', get_logger=None, max_output=None,
+                 spill_size=DEFAULT):
+        super(PersistentShellCommand, self).__init__(argv, logger_name,
+                                                     log_stdout=log_stdout,
+                                                     get_logger=get_logger,
+                                                     encoding=encoding)
+        self.log_stdout = log_stdout
+        self.stdin = None
+        self._line_loggers = {
+            'stdout': _get_line_logger(self.log, log_stdout),
+            'stderr': _get_line_logger(self.log),
+        }
+        self._stdout = OutputBuffer(max_output, spill_size=spill_size,
+                                    on_first_write=self._on_first_output)
+        self._stderr = OutputBuffer(max_output, spill_size=spill_size,
+                                    on_first_write=self._on_first_output)
+        self._open_streams = set(['stdout', 'stderr'])
+        self._finished = threading.Event()
+        self.log.debug('RUN %s', argv)
+
+    def _add_output(self, name, data):
+        line_logger = self._line_loggers[name]
+        if line_logger:
+            line_logger.write(data)
+        getattr(self, '_' + name).write(data)
+
+    def _end_stream(self, name, returncode):
+        line_logger = self._line_loggers[name]
+        if line_logger:
+            line_logger.flush()
+        if name == 'stdout':
+            self.returncode = returncode
+        self._open_streams.discard(name)
+        if not self._open_streams:
+            self._finished.set()
+
+    def _end_process(self):
+        self._finished.wait()
+
+
+class ReplayCommand(Command):
+    """Command whose output is read from a cassette (see ReplayTransport)
+
+    The recorded command is looked up, using everything written to
+    ``stdin``, when the command is waited for or its output is iterated over.
+    """
+    def __init__(self, transport, op, argv, logger_name, log_stdout=True,
+                 encoding='utf-8', get_logger=None, stream=False,
+                 max_output=None, spill_size=DEFAULT):
+        super(ReplayCommand, self).__init__(argv, logger_name,
+                                            log_stdout=log_stdout,
+                                            get_logger=get_logger,
+                                            encoding=encoding)
+        self.transport = transport
+        self.op = op
+        self.log_stdout = log_stdout
+        self.stdin = _StdinRecorder()
+        if stream:
+            self._stdout_queue = queue.Queue()
+        self._stdout = OutputBuffer(max_output, self._stdout_queue,
+                                    spill_size=spill_size,
+                                    on_first_write=self._on_first_output)
+        self._stderr = OutputBuffer(max_output, spill_size=spill_size,
+                                    on_first_write=self._on_first_output)
+        self._replayed = False
+        self.log.debug('RUN %s', argv)
+
+    def _replay(self):
+        if self._replayed:
+            return
+        self._replayed = True
+        entry = self.transport.cassette.replay(
+            self.transport.host, self.op, [self.stdin.sha256.hexdigest()])
+        for name, output in ('stdout', self._stdout), ('stderr', self._stderr):
+            data = cassette.unpack(entry[name])
+            line_logger = _get_line_logger(
+                self.log, name == 'stderr' or self.log_stdout)
+            if data and line_logger:
+                line_logger.write(data)
+                line_logger.flush()
+            output.write(data)
+            output.close()
+        self.returncode = entry['returncode']
+
+    def iter_stdout(self):
+        if self._stdout_queue is not None:
+            self._replay()
+        return super(ReplayCommand, self).iter_stdout()
+
+    def _end_process(self):
+        self._replay()
+
 
 if (
     not have_paramiko or
@@ -571,3 +2611,13 @@ if (
     SSHTransport = OpenSSHTransport
 else:
     SSHTransport = ParamikoTransport
+
+# Transports that can be selected with the "transport" key of a host.
+# (RecordingTransport and ReplayTransport are not listed: they need
+# a cassette, and are selected with the cassette_mode config key.)
+transport_classes = {
+    'ssh': SSHTransport,
+    'paramiko': ParamikoTransport,
+    'openssh': OpenSSHTransport,
+    'local': LocalTransport,
+}
@@ -4,8 +4,17 @@
 # See COPYING for license
 #
 
+import os
 import tempfile
 import shutil
+import threading
+
+
+def get_cache_dir():
+    """Return the directory for per-user caches of pytest-multihost"""
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'pytest-multihost')
 
 
 def check_config_dict_empty(dct, name):
@@ -15,6 +24,29 @@ def check_config_dict_empty(dct, name):
                          (name, ', '.join(dct)))
 
 
+# Keys allowed in "ssh_tuning" configuration dicts
+SSH_TUNING_KEYS = (
+    'compression',
+    'window_size',
+    'max_packet_size',
+    'ciphers',
+    'options',
+)
+
+
+def check_ssh_tuning(dct, name):
+    """Ensure that a "ssh_tuning" configuration dict has only known keys
+
+    Returns a copy of the dict.
+    """
+    dct = dict(dct or {})
+    extra = set(dct) - set(SSH_TUNING_KEYS)
+    if extra:
+        raise ValueError('Unknown ssh_tuning keys for %s: %s' %
+                         (name, ', '.join(sorted(extra))))
+    return dct
+
+
 def shell_quote(bytestring):
     """Quotes a bytestring for the Bash shell"""
     return b"'" + bytestring.replace(b"'", b"'\\''") + b"'"
@@ -27,3 +59,36 @@ class TempDir(object):
 
     def __del__(self):
         shutil.rmtree(self.path)
+
+
+def run_in_parallel(function, items, max_workers):
+    """Call ``function`` on each of ``items`` using a pool of threads
+
+    At most ``max_workers`` calls run at the same time.
+
+    Returns a list of ``(result, exception)`` pairs in the order of ``items``.
+    For calls that raised, ``result`` is None; otherwise ``exception`` is None.
+    """
+    items = list(items)
+    results = [(None, None)] * len(items)
+    indices = iter(range(len(items)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                index = next(indices, None)
+            if index is None:
+                return
+            try:
+                results[index] = function(items[index]), None
+            except Exception as e:
+                results[index] = None, e
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(max_workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
@@ -0,0 +1,112 @@
+#
+# Copyright (C) 2014 pytest-multihost contributors. See COPYING for license
+#
+
+import contextlib
+import getpass
+import sys
+from subprocess import CalledProcessError
+
+import pytest
+
+import pytest_multihost
+import pytest_multihost.transport
+from pytest_multihost.config import Config
+
+try:
+    from paramiko import AuthenticationException
+except ImportError:
+    class AuthenticationException(Exception):
+        """Never raised"""
+
+
+collect_ignore = []
+
+# The asyncio interface (and its tests, which use async/await syntax)
+# needs Python 3.5+
+if sys.version_info < (3, 5):
+    collect_ignore.append('test_localhost_async.py')
+
+
+def get_conf_dict():
+    return {
+        'ssh_username': getpass.getuser(),
+        'domains': [
+            {
+                'name': 'localdomain',
+                'hosts': [
+                    {
+                        'name': 'localhost',
+                        'external_hostname': 'localhost',
+                        'ip': '127.0.0.1',
+                        'role': 'local',
+                    },
+                    {
+                        'name': 'localhost',
+                        'external_hostname': 'localhost',
+                        'ip': '127.0.0.1',
+                        'username': '__nonexisting_test_username__',
+                        'role': 'badusername',
+                    },
+                    {
+                        'name': 'localhost',
+                        'external_hostname': 'localhost',
+                        'ip': '127.0.0.1',
+                        'username': 'root',
+                        'password': 'BAD PASSWORD',
+                        'role': 'badpassword',
+                    },
+                ],
+            },
+        ],
+    }
+
+@pytest.fixture(scope='class', params=['paramiko', 'openssh', 'local'])
+def transport_class(request):
+    if request.param == 'paramiko':
+        return pytest_multihost.transport.ParamikoTransport
+    elif request.param == 'openssh':
+        return pytest_multihost.transport.OpenSSHTransport
+    elif request.param == 'local':
+        return pytest_multihost.transport.LocalTransport
+    else:
+        raise ValueError('bad transport_class')
+
+@pytest.fixture(scope='class')
+def multihost(request, transport_class):
+    conf = get_conf_dict()
+    mh = pytest_multihost.make_multihost_fixture(
+        request,
+        descriptions=[
+            {
+                'hosts': {
+                    'local': 1,
+                },
+            },
+        ],
+        _config=Config.from_dict(conf),
+    )
+    assert conf == get_conf_dict()
+    mh.host = mh.config.domains[0].hosts[0]
+    mh.host.transport_class = transport_class
+    assert isinstance(mh.host.transport, transport_class)
+    return mh.install()
+
+@contextlib.contextmanager
+def _first_command(host):
+    """If managed command fails, prints a message to help debugging"""
+    try:
+        # Run dummy command first; this should catch spurious SSH messages.
+        host.run_command(['echo', 'hello', 'world'])
+        # Now, run the actual command
+        yield
+    except (AuthenticationException, CalledProcessError):
+        print (
+            'Cannot login to %s using default SSH key (%s), user %s. '
+            'You might want to add your own key '
+            'to ~/.ssh/authorized_keys.'
+            'Or, run py.test with -m "not needs_ssh"') % (
+                host.external_hostname,
+                host.ssh_key_filename,
+                getpass.getuser())
+        raise
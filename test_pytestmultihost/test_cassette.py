@@ -0,0 +1,64 @@
+#
+# Copyright (C) 2014 pytest-multihost contributors. See COPYING for license
+#
+
+import hashlib
+
+import pytest
+
+from pytest_multihost import cassette
+from pytest_multihost import transport
+
+
+class FakeHost(object):
+    hostname = 'host.test'
+
+
+def test_pack_unpack():
+    value = [b'text', b'\xff\x00', 'str', 3, None, [b'a', True]]
+    packed = cassette.pack(value)
+    assert packed[:2] == [{'text': 'text'}, {'base64': '/wA='}]
+    assert cassette.unpack(packed) == (
+        b'text', b'\xff\x00', 'str', 3, None, (b'a', True))
+
+
+def test_record_replay(tmpdir):
+    filename = str(tmpdir.join('sub', 'cassette.jsonl'))
+    host = FakeHost()
+    recording = cassette.Cassette(filename, 'record')
+    recording.record(host, 'file_exists', ['/a'], result=False)
+    recording.record(host, 'file_exists', ['/a'], result=True)
+    recording.record(host, 'get_file_contents', ['/a'], result=b'data')
+
+    replay = cassette.Cassette(filename, 'replay')
+    assert replay.replay(host, 'get_file_contents', ['/a'])['result'] == {
+        'text': 'data'}
+    # Identical operations are replayed in order
+    assert replay.replay(host, 'file_exists', ['/a'])['result'] is False
+    assert replay.replay(host, 'file_exists', ['/a'])['result'] is True
+    with pytest.raises(LookupError):
+        replay.replay(host, 'file_exists', ['/a'])
+    with pytest.raises(LookupError):
+        replay.replay(host, 'file_exists', ['/b'])
+
+
+def test_get_cassette(tmpdir):
+    filename = str(tmpdir.join('cassette.jsonl'))
+    recording = cassette.get_cassette(filename, 'record')
+    assert cassette.get_cassette(filename, 'record') is recording
+    replay = cassette.get_cassette(filename, 'replay')
+    assert replay.mode == 'replay'
+    with pytest.raises(ValueError):
+        cassette.Cassette(filename, 'rewind')
+    with pytest.raises(ValueError):
+        cassette.get_cassette(None, 'replay')
+
+
+def test_stdin_recorder():
+    recorder = transport._StdinRecorder()
+    buffer = bytearray(b'input\n')
+    recorder.write(memoryview(buffer)[:3])
+    recorder.write(b'ut\n')
+    assert recorder.stored_data == b'input\n'
+    expected = hashlib.sha256(b'input\n').hexdigest()
+    assert recorder.sha256.hexdigest() == expected
@@ -2,68 +2,26 @@
 # Copyright (C) 2014 pytest-multihost contributors. See COPYING for license
 #
 
-import getpass
+import logging
+import threading
 import pytest
 from subprocess import CalledProcessError
-import contextlib
 import sys
 import os
 
 import pytest_multihost
 import pytest_multihost.transport
-from pytest_multihost.config import Config
-
-try:
-    from paramiko import AuthenticationException
-except ImportError:
-    class AuthenticationException(Exception):
-        """Never raised"""
-
-def get_conf_dict():
-    return {
-        'ssh_username': getpass.getuser(),
-        'domains': [
-            {
-                'name': 'localdomain',
-                'hosts': [
-                    {
-                        'name': 'localhost',
-                        'external_hostname': 'localhost',
-                        'ip': '127.0.0.1',
-                        'role': 'local',
-                    },
-                    {
-                        'name': 'localhost',
-                        'external_hostname': 'localhost',
-                        'ip': '127.0.0.1',
-                        'username': '__nonexisting_test_username__',
-                        'role': 'badusername',
-                    },
-                    {
-                        'name': 'localhost',
-                        'external_hostname': 'localhost',
-                        'ip': '127.0.0.1',
-                        'username': 'root',
-                        'password': 'BAD PASSWORD',
-                        'role': 'badpassword',
-                    },
-                ],
-            },
-        ],
-    }
+import pytest_multihost.reactor
+from pytest_multihost.config import Config, MultihostError
+from pytest_multihost.metrics import Metrics
+
+from conftest import AuthenticationException, get_conf_dict, _first_command
 
-@pytest.fixture(scope='class', params=['paramiko', 'openssh'])
-def transport_class(request):
-    if request.param == 'paramiko':
-        return pytest_multihost.transport.ParamikoTransport
-    elif request.param == 'openssh':
-        return pytest_multihost.transport.OpenSSHTransport
-    else:
-        raise ValueError('bad transport_class')
 
 @pytest.fixture(scope='class')
-def multihost(request, transport_class):
+def multihost_persistent(request, transport_class):
     conf = get_conf_dict()
+    conf['persistent_shell'] = True
     mh = pytest_multihost.make_multihost_fixture(
         request,
         descriptions=[
@@ -75,10 +33,8 @@ def multihost(request, transport_class):
         ],
         _config=Config.from_dict(conf),
     )
-    assert conf == get_conf_dict()
     mh.host = mh.config.domains[0].hosts[0]
     mh.host.transport_class = transport_class
-    assert isinstance(mh.host.transport, transport_class)
     return mh.install()
 
 @pytest.fixture(scope='class')
@@ -118,26 +74,6 @@ def multihost_badpassword(request, transport_class):
     return mh.install()
 
 
-@contextlib.contextmanager
-def _first_command(host):
-    """If managed command fails, prints a message to help debugging"""
-    try:
-        # Run dummy command first; this should catch spurious SSH messages.
-        host.run_command(['echo', 'hello', 'world'])
-        # Now, run the actual command
-        yield
-    except (AuthenticationException, CalledProcessError):
-        print (
-            'Cannot login to %s using default SSH key (%s), user %s. '
-            'You might want to add your own key '
-            'to ~/.ssh/authorized_keys.'
-            'Or, run py.test with -m "not needs_ssh"') % (
-                host.external_hostname,
-                host.ssh_key_filename,
-                getpass.getuser())
-        raise
-
-
 @pytest.mark.needs_ssh
 class TestLocalhost(object):
     def test_echo(self, multihost):
@@ -146,6 +82,20 @@ class TestLocalhost(object):
             echo = host.run_command(['echo', 'hello', 'world'])
         assert echo.stdout_text == 'hello world\n'
 
+    def test_ssh_tuning(self, multihost, monkeypatch):
+        host = multihost.host
+        monkeypatch.setattr(host, 'ssh_tuning', dict(
+            compression=True, window_size=2 ** 22, max_packet_size=2 ** 15,
+            ciphers=['aes256-ctr', 'aes128-ctr'],
+            options={'ConnectTimeout': 10}))
+        host.reset_connection()
+        try:
+            echo = host.run_command(['echo', 'tuned'], set_env=False)
+            assert echo.stdout_text == 'tuned\n'
+        finally:
+            monkeypatch.undo()
+            host.reset_connection()
+
     def test_put_get_file_contents(self, multihost, tmpdir):
         host = multihost.host
         filename = str(tmpdir.join('test.txt'))
@@ -157,6 +107,278 @@ class TestLocalhost(object):
         result = host.get_file_contents(filename, encoding='utf-8')
         assert result == 'test'
 
+    def test_put_get_file(self, multihost, tmpdir):
+        host = multihost.host
+        testbytes = bytes(bytearray(range(256))) * 100
+        local_filename = str(tmpdir.join('local.bin'))
+        remote_filename = str(tmpdir.join('remote.bin'))
+        copy_filename = str(tmpdir.join('copy.bin'))
+        with open(local_filename, 'wb') as f:
+            f.write(testbytes)
+        with _first_command(host):
+            host.transport.put_file(local_filename, remote_filename)
+        host.transport.get_file(remote_filename, copy_filename)
+        with open(copy_filename, 'rb') as f:
+            assert f.read() == testbytes
+
+    def test_put_get_file_special_characters(self, multihost, tmpdir):
+        host = multihost.host
+        # Quotes, spaces and glob characters (which sftp would expand)
+        name = 'a b"c\'d\\e*f?g[h]'
+        tmpdir.join(name).write('content')
+        tmpdir.join('a bxc').write('decoy')
+        with _first_command(host):
+            host.transport.put_file(str(tmpdir.join(name)),
+                                    str(tmpdir.join('remote ' + name)))
+        host.transport.get_file(str(tmpdir.join('remote ' + name)),
+                                str(tmpdir.join('copy ' + name)))
+        assert tmpdir.join('copy ' + name).read() == 'content'
+        assert tmpdir.join('a bxc').read() == 'decoy'
+        assert len(tmpdir.listdir()) == 4
+        # Older sftp versions expand glob characters even in quotes
+        assert pytest_multihost.transport._sftp_quote('/a b/c*d?[e]') == (
+            '/a\\ b/c\\*d\\?\\[e]')
+
+    @pytest.mark.parametrize('pipelining', [True, False])
+    def test_put_get_file_sftp_options(self, multihost, tmpdir, monkeypatch,
+                                       pipelining):
+        host = multihost.host
+        monkeypatch.setattr(host.config, 'sftp_pipelining', pipelining)
+        monkeypatch.setattr(host.config, 'sftp_chunk_size', 1000)
+        monkeypatch.setattr(host.config, 'sftp_max_requests', 4)
+        testbytes = os.urandom(100 * 1000 + 1)
+        local_filename = str(tmpdir.join('local.bin'))
+        remote_filename = str(tmpdir.join('remote.bin'))
+        copy_filename = str(tmpdir.join('copy.bin'))
+        with open(local_filename, 'wb') as f:
+            f.write(testbytes)
+        with _first_command(host):
+            host.transport.put_file(local_filename, remote_filename)
+        host.transport.get_file(remote_filename, copy_filename)
+        with open(copy_filename, 'rb') as f:
+            assert f.read() == testbytes
+        assert host.get_file_contents(remote_filename) == testbytes
+
+    def test_get_file_nonexisting(self, multihost, tmpdir):
+        host = multihost.host
+        with _first_command(host):
+            with pytest.raises(IOError):
+                host.transport.get_file(str(tmpdir.join('nonexisting')),
+                                        str(tmpdir.join('copy')))
+
+    @pytest.mark.parametrize('compress', [False, True])
+    def test_put_get_dir(self, multihost, tmpdir, compress):
+        host = multihost.host
+        source = tmpdir.join('source')
+        source.join('sub', 'deep').ensure(dir=True)
+        source.join('sub', 'deep', 'file.txt').write('deep')
+        source.join('script.sh').write('#!/bin/sh\n')
+        source.join('script.sh').chmod(0o755)
+        source.join('link').mksymlinkto('script.sh')
+        remote = str(tmpdir.join('remote'))
+        with _first_command(host):
+            host.put_dir(str(source), remote, compress=compress)
+        assert host.get_file_contents(
+            os.path.join(remote, 'sub', 'deep', 'file.txt')) == b'deep'
+
+        copy = tmpdir.join('copy')
+        host.get_dir(remote, str(copy), compress=compress)
+        assert copy.join('sub', 'deep', 'file.txt').read() == 'deep'
+        assert os.readlink(str(copy.join('link'))) == 'script.sh'
+        assert os.stat(str(copy.join('script.sh'))).st_mode & 0o777 == 0o755
+
+    def test_sync_dir(self, multihost, tmpdir, monkeypatch):
+        host = multihost.host
+        source = tmpdir.join('source')
+        source.join('sub').ensure(dir=True)
+        source.join('sub', 'a.txt').write('a')
+        source.join('b.txt').write('b')
+        source.join('run.sh').write('#!/bin/sh')
+        source.join('run.sh').chmod(0o750)
+        remote = str(tmpdir.join('remote'))
+        cache_file = str(tmpdir.join('cache.json'))
+        with _first_command(host):
+            copied = host.sync_dir(str(source), remote, cache_file=cache_file)
+        assert copied == ['b.txt', 'run.sh', 'sub/a.txt']
+        assert host.get_file_contents(os.path.join(remote, 'sub', 'a.txt')) \
+            == b'a'
+        # Copies get the mode and mtime of the local files
+        remote_stat = os.stat(os.path.join(remote, 'run.sh'))
+        assert remote_stat.st_mode & 0o777 == 0o750
+        assert remote_stat.st_mtime == source.join('run.sh').mtime()
+
+        # Remote files are not hashed again if they are unchanged
+        commands = []
+        start_shell = host.transport.start_shell
+
+        def logging_start_shell(argv, *args, **kwargs):
+            commands.append(argv[0])
+            return start_shell(argv, *args, **kwargs)
+        monkeypatch.setattr(host.transport, 'start_shell',
+                            logging_start_shell)
+        assert host.sync_dir(str(source), remote, cache_file=cache_file) == []
+        assert 'sha256sum' not in commands
+
+        # Remote files modified by others are hashed again
+        with open(os.path.join(remote, 'b.txt'), 'w') as f:
+            f.write('remote')
+        source.join('sub', 'a.txt').remove()
+        del commands[:]
+        copied = host.sync_dir(str(source), remote, delete=True,
+                               cache_file=cache_file)
+        assert copied == ['b.txt']
+        assert 'sha256sum' in commands
+        # Permissions, mtimes and removals are done in a single batch
+        assert commands.count('batch') == 2
+        assert host.get_file_contents(os.path.join(remote, 'b.txt')) \
+            == b'b'
+        assert not host.transport.file_exists(
+            os.path.join(remote, 'sub', 'a.txt'))
+
+    def test_mkdir_recursive(self, multihost, tmpdir):
+        host = multihost.host
+        path = str(tmpdir.join('a', 'b', 'c'))
+        with _first_command(host):
+            host.transport.mkdir_recursive(path)
+        assert os.path.isdir(path)
+        host.transport.mkdir_recursive(path)
+
+    def test_mkdir_recursive_without_shell(self, multihost, tmpdir,
+                                           monkeypatch):
+        host = multihost.host
+        path = str(tmpdir.join('a', 'b', 'c'))
+
+        def no_shell(*args, **kwargs):
+            raise AssertionError('shell used')
+        with _first_command(host):
+            monkeypatch.setattr(host, 'posix_shell', False)
+            monkeypatch.setattr(host.transport, 'start_shell', no_shell)
+            host.transport.mkdir_recursive(path)
+        assert os.path.isdir(path)
+
+    def test_file_batch(self, multihost, tmpdir):
+        host = multihost.host
+        tmpdir.join('file').write('x')
+        with _first_command(host):
+            with host.transport.batch() as batch:
+                batch.mkdir(str(tmpdir.join('dir')))
+                batch.chmod(str(tmpdir.join('dir')), 0o700)
+                batch.rename_file(str(tmpdir.join('file')),
+                                  str(tmpdir.join('renamed')))
+                exists = batch.file_exists(str(tmpdir.join('renamed')))
+                missing = batch.file_exists(str(tmpdir.join('file')))
+        assert exists.value is True
+        assert missing.value is False
+        assert os.stat(str(tmpdir.join('dir'))).st_mode & 0o777 == 0o700
+
+        with pytest.raises(IOError):
+            with host.transport.batch() as batch:
+                batch.remove_file(str(tmpdir.join('nonexisting')))
+                exists = batch.file_exists(str(tmpdir.join('renamed')))
+        assert exists.value is None
+
+    def test_get_dir_nonexisting(self, multihost, tmpdir):
+        host = multihost.host
+        with _first_command(host):
+            with pytest.raises(IOError):
+                host.get_dir(str(tmpdir.join('nonexisting')),
+                             str(tmpdir.join('copy')))
+
+    def test_put_file_contents_skip_if_same(self, multihost, tmpdir):
+        host = multihost.host
+        filename = str(tmpdir.join('config.txt'))
+        with _first_command(host):
+            host.put_file_contents(filename, 'config', skip_if_same=True)
+        assert host.get_file_contents(filename) == b'config'
+
+        # Skipped uploads leave the file (and its mtime) alone
+        os.utime(filename, (1000, 1000))
+        host.put_file_contents(filename, 'config', skip_if_same=True)
+        assert os.stat(filename).st_mtime == 1000
+        host.put_file_contents(filename, 'config', skip_if_same=True)
+        assert os.stat(filename).st_mtime == 1000
+
+        host.put_file_contents(filename, 'changed', skip_if_same=True)
+        assert host.get_file_contents(filename) == b'changed'
+
+    def test_put_file_skip_if_same(self, multihost, tmpdir):
+        host = multihost.host
+        local_filename = str(tmpdir.join('local.txt'))
+        remote_filename = str(tmpdir.join('remote.txt'))
+        tmpdir.join('local.txt').write('content')
+        with _first_command(host):
+            host.transport.put_file(local_filename, remote_filename,
+                                    skip_if_same=True)
+        os.utime(remote_filename, (1000, 1000))
+        host.transport.put_file(local_filename, remote_filename,
+                                skip_if_same=True)
+        assert os.stat(remote_filename).st_mtime == 1000
+        host.transport.put_file(local_filename, remote_filename)
+        assert os.stat(remote_filename).st_mtime != 1000
+
+    def test_skip_if_same_upload_without_stat(self, multihost, tmpdir,
+                                              monkeypatch):
+        host = multihost.host
+        filename = str(tmpdir.join('config.txt'))
+        local_filename = str(tmpdir.join('local.txt'))
+        remote_filename = str(tmpdir.join('remote.txt'))
+        tmpdir.join('local.txt').write('content')
+        stats = []
+        get_file_signature = host.transport.get_file_signature
+
+        def logging_get_file_signature(filename):
+            stats.append(filename)
+            return get_file_signature(filename)
+
+        with _first_command(host):
+            monkeypatch.setattr(host.transport, 'get_file_signature',
+                                logging_get_file_signature)
+            host.put_file_contents(filename, 'config', skip_if_same=True)
+            host.transport.put_file(local_filename, remote_filename,
+                                    skip_if_same=True)
+        local = isinstance(host.transport,
+                           pytest_multihost.transport.LocalTransport)
+        if not local:
+            # The uploads set the mtime, so they need not stat the files
+            assert stats == []
+        del stats[:]
+
+        # The remembered signatures match; no checksums are needed
+        def fail(filename):
+            raise AssertionError('checksum computed')
+        monkeypatch.setattr(host.transport, 'get_file_sha256', fail)
+        host.put_file_contents(filename, 'config', skip_if_same=True)
+        host.transport.put_file(local_filename, remote_filename,
+                                skip_if_same=True)
+        assert stats == [filename, remote_filename]
+
+        # If the signature changed, the stat result is remembered again
+        # after the checksum matches, without another stat
+        os.utime(filename, (1000, 1000))
+        del stats[:]
+        monkeypatch.undo()
+        monkeypatch.setattr(host.transport, 'get_file_signature',
+                            logging_get_file_signature)
+        host.put_file_contents(filename, 'config', skip_if_same=True)
+        assert stats == [filename]
+        assert os.stat(filename).st_mtime == 1000
+        monkeypatch.setattr(host.transport, 'get_file_sha256', fail)
+        host.put_file_contents(filename, 'config', skip_if_same=True)
+        assert stats == [filename, filename]
+
+    def test_put_file_contents_verify(self, multihost, tmpdir):
+        host = multihost.host
+        filename = str(tmpdir.join('test.txt'))
+        testbytes = bytes(bytearray(range(256))) * 100
+        with _first_command(host):
+            host.put_file_contents(filename, testbytes, encoding=None,
+                                   verify=True)
+        with open(filename, 'rb') as f:
+            assert f.read() == testbytes
+        with pytest.raises(IOError):
+            host.transport.verify_file_contents(filename, b'other')
+        assert host.transport.get_file_sha256(filename + '.missing') is None
+
     def test_get_file_contents_nonexisting(self, multihost, tmpdir):
         host = multihost.host
         filename = str(tmpdir.join('test.txt'))
@@ -330,10 +552,417 @@ class TestLocalhost(object):
             with pytest.raises(CalledProcessError):
                 false.wait()
 
+    def test_stream_output(self, multihost):
+        host = multihost.host
+        with _first_command(host):
+            cmd = host.run_command(['seq', '1', '1000'], bg=True,
+                                   stream=True, max_output=0)
+        with cmd:
+            lines = list(cmd.iter_stdout_lines())
+        assert lines == [str(i).encode('ascii') + b'\n'
+                         for i in range(1, 1001)]
+        assert cmd.stdout_bytes == b''
+
+    def test_stream_requires_bg(self, multihost):
+        host = multihost.host
+        with pytest.raises(ValueError):
+            host.run_command(['true'], stream=True)
+
+    def test_max_output(self, multihost):
+        host = multihost.host
+        with _first_command(host):
+            cmd = host.run_command(['seq', '1', '1000'], max_output=9)
+        assert cmd.stdout_text == '999\n1000\n'
+
+    def test_spill_output(self, multihost):
+        host = multihost.host
+        expected = b''.join(str(i).encode('ascii') + b'\n'
+                            for i in range(1, 10001))
+        with _first_command(host):
+            cmd = host.run_command(['seq', '1', '10000'], spill_size=1000,
+                                   log_stdout=False)
+        assert cmd.stdout_file.read() == expected
+        assert cmd.stdout_bytes == expected
+
+    @pytest.mark.skipif(not pytest_multihost.reactor.have_selectors,
+                        reason='needs the selectors module')
+    def test_background_commands_share_reader(self, multihost):
+        host = multihost.host
+        with _first_command(host):
+            thread_count = threading.active_count()
+        commands = [host.run_command('sleep 0.2; echo %s' % i, bg=True)
+                    for i in range(20)]
+        assert threading.active_count() <= thread_count + 1
+        for i, command in enumerate(commands):
+            command.wait()
+            assert command.stdout_text == '%s\n' % i
+
+    def test_run_on_hosts(self, multihost):
+        host = multihost.host
+        with _first_command(host):
+            results = multihost.config.run_on_hosts(['echo', 'hello'])
+        assert list(results) == [host]
+        assert results[host].stdout_text == 'hello\n'
+
+    def test_run_on_hosts_error(self, multihost):
+        host = multihost.host
+        domain = multihost.config.domains[0]
+        with _first_command(host):
+            with pytest.raises(MultihostError) as excinfo:
+                domain.run_on_hosts('echo out; echo boom >&2; exit 2')
+        assert list(excinfo.value.errors) == [host]
+        assert isinstance(excinfo.value.errors[host], CalledProcessError)
+        # The failed Command is kept, and the message has its error output
+        command = excinfo.value.results[host]
+        assert command.returncode == 2
+        assert command.stdout_text == 'out\n'
+        assert 'exit status 2' in str(excinfo.value)
+        assert 'boom' in str(excinfo.value)
+
+        results = domain.run_on_hosts(['false'], raiseonerr=False)
+        assert results[host].returncode == 1
+
+    def test_put_file_to_hosts(self, multihost, tmpdir):
+        host = multihost.host
+        local_filename = str(tmpdir.join('local.bin'))
+        remote_filename = str(tmpdir.join('remote.bin'))
+        with open(local_filename, 'wb') as f:
+            f.write(b'broadcast')
+        with _first_command(host):
+            results = multihost.config.put_file_to_hosts(local_filename,
+                                                         remote_filename)
+        assert results == {host: True}
+        assert host.get_file_contents(remote_filename) == b'broadcast'
+
+        domain = multihost.config.domains[0]
+        results = domain.put_file_to_hosts(local_filename, remote_filename)
+        assert results == {host: False}
+
+    def test_metrics(self, multihost, tmpdir):
+        host = multihost.host
+        metrics = Metrics()
+        filename = str(tmpdir.join('file'))
+        host.reset_connection()
+        multihost.config.add_listener(metrics)
+        try:
+            with _first_command(host):
+                host.run_command(['echo', 'hello'])
+            host.put_file_contents(filename, 'contents')
+            host.get_file_contents(filename)
+            host.reset_connection()
+        finally:
+            multihost.config.remove_listener(metrics)
+        data = metrics.to_dict()
+        operations = dict(((op['kind'], op['name']), op)
+                          for op in data['operations'])
+        assert operations['command', 'echo']['count'] == 2
+        assert operations['command', 'echo']['bytes_in'] >= 12
+        assert operations['command', 'echo']['mean_time_to_first_byte'] > 0
+        assert operations['put', 'put_file_contents']['bytes_out'] == 8
+        assert operations['get', 'get_file_contents']['bytes_in'] == 8
+        assert operations['connect', host.transport_class.__name__][
+            'count'] == 1
+        assert list(data['hosts']) == [host.hostname]
+
+    def test_listener(self, multihost, tmpdir):
+        host = multihost.host
+        filename = str(tmpdir.join('file'))
+        events = []
+
+        class Listener(object):
+            def on_connect(self, host, transport, duration):
+                events.append(('connect', transport))
+
+            def on_command_start(self, host, command):
+                events.append(('command_start', command.argv))
+
+            def on_command_output(self, host, command, time_to_first_byte):
+                assert time_to_first_byte >= 0
+                events.append(('command_output', command.argv))
+
+            def on_command_end(self, host, command, duration,
+                               bytes_in, bytes_out):
+                assert bytes_in >= len('hi\n')
+                assert bytes_out > 0
+                events.append(('command_end', command.argv))
+
+            def on_transfer_end(self, host, kind, name, path, duration, size):
+                events.append((kind, name, path, size))
+
+        listener = Listener()
+        host.reset_connection()
+        multihost.config.add_listener(listener)
+        try:
+            with _first_command(host):
+                transport = host.transport
+            host.put_file_contents(filename, 'contents')
+            host.run_command(['echo', 'hi'])
+        finally:
+            multihost.config.remove_listener(listener)
+        host.run_command(['echo', 'hi'])
+        assert events[0] == ('connect', transport)
+        assert ('put', 'put_file_contents', filename, 8) in events
+        command_events = [e for e in events
+                          if e[0].startswith('command_') and
+                          e[1] == ['echo', 'hi']]
+        assert command_events == [
+            ('command_start', ['echo', 'hi']),
+            ('command_output', ['echo', 'hi']),
+            ('command_end', ['echo', 'hi']),
+        ]
+
+    def test_output_logging(self, multihost, caplog, monkeypatch):
+        host = multihost.host
+        with _first_command(host):
+            with caplog.at_level(logging.DEBUG, logger=host.logger_name):
+                host.run_command('echo logged-line')
+        assert 'logged-line' in caplog.messages
+
+        # With DEBUG disabled, output is not split into lines for logging
+        monkeypatch.setattr(pytest_multihost.transport, '_LineLogger', None)
+        caplog.clear()
+        with caplog.at_level(logging.INFO, logger=host.logger_name):
+            cmd = host.run_command('echo not-logged')
+        assert cmd.stdout_text == 'not-logged\n'
+        assert 'not-logged' not in caplog.messages
+
+    @pytest.mark.parametrize('failure', ['read', 'register'])
+    def test_output_read_error(self, multihost, monkeypatch, failure):
+        host = multihost.host
+        get_readers = pytest_multihost.transport._get_output_readers
+
+        def fail():
+            raise IOError('simulated read error')
+
+        def failing_readers(ssh):
+            if failure == 'read':
+                return [(fd, fail) for fd, read in get_readers(ssh)]
+            else:
+                # Not an open file descriptor
+                return [(2 ** 20, fail)]
+
+        with _first_command(host):
+            monkeypatch.setattr(pytest_multihost.transport,
+                                '_get_output_readers', failing_readers)
+            if pytest_multihost.reactor.have_selectors:
+                with pytest.raises(EnvironmentError):
+                    host.run_command(['echo', 'hello'])
+        monkeypatch.undo()
+        # The reactor still works
+        echo = host.run_command(['echo', 'still alive'])
+        assert echo.stdout_text == 'still alive\n'
+
+    def test_unlogged_output_in_reader_threads(self, multihost, monkeypatch,
+                                               caplog):
+        host = multihost.host
+        writes = []
+        original_write = pytest_multihost.transport.OutputBuffer.write
+
+        def counting_write(self, data):
+            writes.append(len(data))
+            return original_write(self, data)
+
+        with _first_command(host):
+            # Use a thread per stream (as without selectors)
+            monkeypatch.setattr(pytest_multihost.reactor, 'have_selectors',
+                                False)
+            monkeypatch.setattr(pytest_multihost.transport.OutputBuffer,
+                                'write', counting_write)
+            with caplog.at_level(logging.INFO, logger=host.logger_name):
+                cmd = host.run_command('seq 20000')
+        monkeypatch.undo()
+        expected = ''.join('%s\n' % i for i in range(1, 20001))
+        assert cmd.stdout_text == expected
+        # Output is read in chunks, not lines
+        assert 0 < len(writes) < 2000
+
+    def test_unlogged_output(self, multihost, caplog):
+        host = multihost.host
+        with _first_command(host):
+            with caplog.at_level(logging.INFO, logger=host.logger_name):
+                cmd = host.run_command(['echo', 'hi'], log_stdout=False)
+        # The chunks read into a reused buffer are copied out as bytes
+        assert cmd.stdout_bytes == b'hi\n'
+        assert type(cmd.stdout_bytes) is bytes
+
+    def test_connect_all(self, multihost):
+        host = multihost.host
+        host.reset_connection()
+        with _first_command(host):
+            times = multihost.config.connect_all()
+        assert list(times) == [host]
+        assert times[host] >= 0
+        assert isinstance(host.transport, host.transport_class)
+
+
+@pytest.mark.needs_ssh
+class TestLocalhostPersistentShell(object):
+    def test_echo(self, multihost_persistent):
+        host = multihost_persistent.host
+        with _first_command(host):
+            echo = host.run_command(['echo', 'hello', 'world'])
+        assert echo.stdout_text == 'hello world\n'
+        assert echo.returncode == 0
+
+    def test_listener(self, multihost_persistent):
+        host = multihost_persistent.host
+        events = []
+
+        class Listener(object):
+            def on_command_start(self, host, command):
+                events.append(('command_start', command.returncode))
+
+            def on_command_output(self, host, command, time_to_first_byte):
+                events.append(('command_output', command.returncode))
+
+            def on_command_end(self, host, command, duration,
+                               bytes_in, bytes_out):
+                events.append(('command_end', command.returncode))
+
+        with _first_command(host):
+            host.run_command(['true'])
+        listener = Listener()
+        multihost_persistent.config.add_listener(listener)
+        try:
+            host.run_command('echo hi; sleep 0.5')
+        finally:
+            multihost_persistent.config.remove_listener(listener)
+        # The events arrive while the command runs, not after it ends
+        assert events == [
+            ('command_start', None),
+            ('command_output', None),
+            ('command_end', 0),
+        ]
+
+    def test_output_without_newline(self, multihost_persistent):
+        host = multihost_persistent.host
+        with _first_command(host):
+            cmd = host.run_command('printf out; printf err >&2')
+        assert cmd.stdout_text == 'out'
+        assert cmd.stderr_text.endswith('err')
+
+    def test_returncode(self, multihost_persistent):
+        host = multihost_persistent.host
+        with _first_command(host):
+            cmd = host.run_command('exit 3', raiseonerr=False)
+        assert cmd.returncode == 3
+        with pytest.raises(CalledProcessError):
+            host.run_command(['false'])
+        echo = host.run_command(['echo', 'still alive'])
+        assert echo.stdout_text == 'still alive\n'
+
+    def test_cwd_not_shared(self, multihost_persistent, tmpdir):
+        host = multihost_persistent.host
+        with _first_command(host):
+            before = host.run_command(['pwd'])
+        pwd = host.run_command(['pwd'], cwd=str(tmpdir))
+        assert pwd.stdout_text == str(tmpdir) + '\n'
+        after = host.run_command(['pwd'])
+        assert after.stdout_text == before.stdout_text
+
+    def test_piping_input(self, multihost_persistent):
+        host = multihost_persistent.host
+        with _first_command(host):
+            b64 = host.run_command(['base64'], stdin_text='test')
+        assert b64.stdout_text == 'dGVzdA==' + '\n'
+
+    def test_large_output_without_newlines(self, multihost_persistent):
+        host = multihost_persistent.host
+        size = 3 * pytest_multihost.transport.READ_SIZE + 7
+        with _first_command(host):
+            cmd = host.run_command(
+                "head -c %d /dev/zero | tr '\\0' x" % size)
+        assert cmd.stdout_bytes == b'x' * size
+        echo = host.run_command(['echo', 'next'])
+        assert echo.stdout_text == 'next\n'
+
+    def test_marker_split_between_chunks(self, multihost_persistent,
+                                         monkeypatch):
+        host = multihost_persistent.host
+        # Read in tiny chunks, so the marker is always split between them.
+        # (Readers pick up the new size after their current read returns,
+        # so the first command's output is still read in big chunks.)
+        monkeypatch.setattr(pytest_multihost.transport, 'READ_SIZE', 3)
+        with _first_command(host):
+            cmd = host.run_command('printf abc; echo def >&2; exit 4',
+                                   raiseonerr=False)
+        assert cmd.stdout_bytes == b'abc'
+        assert cmd.stderr_text.endswith('def\n')
+        assert cmd.returncode == 4
+
+
+@pytest.mark.needs_ssh
+class TestRecordReplay(object):
+    def get_host(self, tmpdir, transport_class, mode, persistent_shell=False):
+        conf = get_conf_dict()
+        conf['test_dir'] = str(tmpdir)
+        conf['persistent_shell'] = persistent_shell
+        conf['cassette'] = str(tmpdir.join('cassette.jsonl'))
+        conf['cassette_mode'] = mode
+        host = Config.from_dict(conf).domains[0].hosts[0]
+        host.recorded_transport_class = transport_class
+        return host
+
+    def run_operations(self, host, tmpdir):
+        filename = str(tmpdir.join('file.txt'))
+        results = []
+        with _first_command(host):
+            results.append(host.run_command(['echo', 'hello']).stdout_text)
+        cmd = host.run_command('echo err >&2; exit 3', raiseonerr=False)
+        results.append((cmd.returncode, cmd.stderr_text.endswith('err\n')))
+        b64 = host.run_command(['base64'], stdin_text='test')
+        results.append(b64.stdout_text)
+        with host.run_command(['seq', '3'], bg=True, stream=True) as cmd:
+            results.append(list(cmd.iter_stdout_lines()))
+        host.put_file_contents(filename, 'contents')
+        results.append(host.get_file_contents(filename))
+        results.append(host.transport.file_exists(filename + '.missing'))
+        with pytest.raises(IOError):
+            host.get_file_contents(filename + '.missing')
+        local_filename = str(tmpdir.join('local.txt'))
+        host.transport.get_file(filename, local_filename)
+        with open(local_filename) as f:
+            results.append(f.read())
+        host.transport.remove_file(filename)
+        return results
+
+    @pytest.mark.parametrize('persistent_shell', [False, True])
+    def test_record_replay(self, tmpdir, transport_class, persistent_shell):
+        host = self.get_host(tmpdir, transport_class, 'record',
+                             persistent_shell)
+        assert isinstance(host.transport,
+                          pytest_multihost.transport.RecordingTransport)
+        assert isinstance(host.transport.recorded_transport, transport_class)
+        recorded = self.run_operations(host, tmpdir)
+        host.reset_connection()
+        assert recorded == [
+            'hello\n',
+            (3, True),
+            'dGVzdA==\n',
+            [b'1\n', b'2\n', b'3\n'],
+            b'contents',
+            False,
+            'contents',
+        ]
+
+        host = self.get_host(tmpdir, transport_class, 'replay',
+                             persistent_shell)
+        assert isinstance(host.transport,
+                          pytest_multihost.transport.ReplayTransport)
+        assert self.run_operations(host, tmpdir) == recorded
+        assert not tmpdir.join('file.txt').check()
+
+        with pytest.raises(LookupError):
+            host.run_command(['echo', 'not recorded'])
 
 
 @pytest.mark.needs_ssh
 class TestLocalhostBadConnection(object):
+    @pytest.fixture(autouse=True)
+    def skip_local(self, transport_class):
+        if transport_class == pytest_multihost.transport.LocalTransport:
+            pytest.skip('LocalTransport does not authenticate')
+
     def test_reset(self, multihost):
         host = multihost.host
         with _first_command(host):
@@ -347,7 +976,7 @@ class TestLocalhostBadConnection(object):
 
         host.reset_connection()
         with pytest.raises((AuthenticationException, RuntimeError)):
-            echo = host.run_command(['echo', 'hello', 'world'])
+            host.run_command(['echo', 'hello', 'world'])
 
 
     def test_baduser(self, multihost_baduser, tmpdir):
@@ -356,9 +985,9 @@ class TestLocalhostBadConnection(object):
             # Avoid the OpenSSH password prompt
             return
         with pytest.raises(AuthenticationException):
-            echo = host.run_command(['echo', 'hello', 'world'])
+            host.run_command(['echo', 'hello', 'world'])
 
     def test_badpassword(self, multihost_badpassword, tmpdir):
         host = multihost_badpassword.host
         with pytest.raises((AuthenticationException, RuntimeError)):
-            echo = host.run_command(['echo', 'hello', 'world'])
+            host.run_command(['echo', 'hello', 'world'])
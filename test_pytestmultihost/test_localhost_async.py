@@ -0,0 +1,53 @@
+#
+# Copyright (C) 2014 pytest-multihost contributors. See COPYING for license
+#
+
+# Tests of the asyncio interface; this module needs Python 3.5+
+# (see conftest.py)
+
+import asyncio
+
+import pytest
+
+from conftest import _first_command
+
+
+def run_coroutine(coroutine):
+    """Run a coroutine in a new event loop (asyncio.run needs Python 3.7)"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+@pytest.mark.needs_ssh
+class TestLocalhostAsync(object):
+    def test_run_command_async(self, multihost):
+        host = multihost.host
+
+        async def run_commands():
+            return await asyncio.gather(
+                host.run_command_async(['echo', 'one']),
+                host.run_command_async('echo two >&2'),
+                host.run_command_async(['false'], raiseonerr=False),
+            )
+
+        with _first_command(host):
+            one, two, false = run_coroutine(run_commands())
+        assert one.stdout_text == 'one\n'
+        assert two.stderr_text.endswith('two\n')
+        assert false.returncode != 0
+
+    def test_file_contents_async(self, multihost, tmpdir):
+        host = multihost.host
+        filename = str(tmpdir.join('test.txt'))
+
+        async def put_and_get():
+            await host.put_file_contents_async(filename, 'test')
+            return await host.get_file_contents_async(filename)
+
+        with _first_command(host):
+            assert run_coroutine(put_and_get()) == b'test'
@@ -0,0 +1,66 @@
+#
+# Copyright (C) 2014 pytest-multihost contributors. See COPYING for license
+#
+
+import logging
+import threading
+
+from pytest_multihost import logs
+
+
+class FakeHost(object):
+    logger_name = 'test_logs.host'
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.records.append(record.getMessage())
+        self.threads.add(threading.current_thread().name)
+
+
+def test_log_queue():
+    parent = logging.getLogger('test_logs')
+    parent_handler = ListHandler()
+    parent.addHandler(parent_handler)
+    queue_handler = ListHandler()
+    log_queue = logs.LogQueue()
+    log_queue.add_handler(queue_handler)
+    log_queue.add_logger('test_logs.host')
+    log = logging.getLogger('test_logs.host.cmd1')
+    log.setLevel(logging.DEBUG)
+    try:
+        log.debug('queued %s', 1)
+        assert parent_handler.records == []
+        log_queue.start()
+        log.debug('queued %s', 2)
+    finally:
+        log_queue.stop()
+        parent.removeHandler(parent_handler)
+        log.setLevel(logging.NOTSET)
+    assert queue_handler.records == ['queued 1', 'queued 2']
+    # Records are propagated to ancestors in the background thread
+    assert parent_handler.records == ['queued 1', 'queued 2']
+    assert parent_handler.threads == set(['pytest-multihost-logging'])
+    assert logging.getLogger('test_logs.host').propagate
+
+
+def test_host_log_file(tmpdir):
+    filename = str(tmpdir.join('logs', 'host.log'))
+    handler = logs.add_host_log_file(FakeHost(), filename)
+    logger = logging.getLogger('test_logs.host')
+    try:
+        logging.getLogger('test_logs.host.cmd1').debug('output line')
+        logging.getLogger('test_logs.other').warning('not for this host')
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(logging.NOTSET)
+        handler.close()
+    with open(filename) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 1
+    assert lines[0].endswith('DEBUG test_logs.host.cmd1: output line')
@@ -0,0 +1,51 @@
+#
+# Copyright (C) 2014 pytest-multihost contributors. See COPYING for license
+#
+
+import hashlib
+
+from pytest_multihost import manifest
+
+
+def test_local_manifest(tmpdir):
+    tmpdir.join('sub').ensure(dir=True)
+    tmpdir.join('sub', 'file.txt').write('content')
+    tmpdir.join('link').mksymlinkto(tmpdir.join('sub'))
+    cache = manifest.HashCache(str(tmpdir.join('cache.json')))
+    result = manifest.get_local_manifest(str(tmpdir), cache)
+    assert list(result) == ['sub/file.txt']
+    size, mtime, sha256 = result['sub/file.txt']
+    assert size == len('content')
+    assert sha256 == hashlib.sha256(b'content').hexdigest()
+
+
+def test_hash_cache(tmpdir, monkeypatch):
+    path = tmpdir.join('file.txt')
+    path.write('content')
+    cache_file = str(tmpdir.join('cache', 'sha256.json'))
+    cache = manifest.HashCache(cache_file)
+    expected = hashlib.sha256(b'content').hexdigest()
+    assert cache.get_sha256(str(path)) == expected
+    cache.save()
+
+    # A new cache reads the digest from the file instead of hashing
+    def fail(path):
+        raise AssertionError('file hashed again')
+    monkeypatch.setattr(manifest, 'file_sha256', fail)
+    cache = manifest.HashCache(cache_file)
+    assert cache.get_sha256(str(path)) == expected
+
+    # Modified files are hashed again
+    monkeypatch.undo()
+    path.write('modified')
+    expected = hashlib.sha256(b'modified').hexdigest()
+    assert cache.get_sha256(str(path)) == expected
+
+
+def test_mtime_format():
+    assert manifest.parse_mtime('1700000000.1234567890') == \
+        1700000000123456789
+    assert manifest.parse_mtime('1700000000') == 1700000000 * 10 ** 9
+    assert manifest.format_mtime(1700000000000000001) == \
+        '1700000000.000000001'
+    assert manifest.parse_mtime(manifest.format_mtime(123456789)) == 123456789
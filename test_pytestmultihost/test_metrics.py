@@ -0,0 +1,75 @@
+#
+# Copyright (C) 2014 pytest-multihost contributors. See COPYING for license
+#
+
+import csv
+import json
+
+from pytest_multihost.metrics import Metrics
+
+
+def make_metrics():
+    metrics = Metrics()
+    metrics.record('host1', 'command', 'echo', 0.002, first_byte=0.001,
+                   bytes_in=6, bytes_out=20)
+    metrics.record('host1', 'command', 'echo', 0.2, first_byte=0.1,
+                   bytes_in=6, bytes_out=20)
+    metrics.record('host1', 'put', 'put_file', 100, bytes_out=1000)
+    metrics.record('host2', 'connect', 'ParamikoTransport', 0.5)
+    return metrics
+
+
+def test_aggregation():
+    data = make_metrics().to_dict()
+    assert data['hosts'] == {
+        'host1': {'count': 3, 'total_time': 100.202,
+                  'bytes_in': 12, 'bytes_out': 1040},
+        'host2': {'count': 1, 'total_time': 0.5,
+                  'bytes_in': 0, 'bytes_out': 0},
+    }
+    echo, put, connect = data['operations']
+    assert (echo['host'], echo['kind'], echo['name']) == (
+        'host1', 'command', 'echo')
+    assert echo['count'] == 2
+    assert echo['min_time'] == 0.002
+    assert echo['max_time'] == 0.2
+    assert abs(echo['mean_time_to_first_byte'] - 0.0505) < 1e-9
+    assert echo['histogram']['<=0.005'] == 1
+    assert echo['histogram']['<=0.5'] == 1
+    assert sum(echo['histogram'].values()) == 2
+    assert put['histogram']['>60'] == 1
+    assert put['mean_time_to_first_byte'] is None
+
+
+def test_write_json(tmpdir):
+    filename = str(tmpdir.join('metrics.json'))
+    make_metrics().write(filename)
+    with open(filename) as f:
+        data = json.load(f)
+    assert len(data['operations']) == 3
+
+
+def test_write_csv(tmpdir):
+    filename = str(tmpdir.join('metrics.csv'))
+    make_metrics().write(filename)
+    with open(filename) as f:
+        rows = list(csv.DictReader(f))
+    assert [row['name'] for row in rows] == [
+        'echo', 'put_file', 'ParamikoTransport']
+    assert rows[0]['count'] == '2'
+    assert rows[0]['<=0.005'] == '1'
+
+
+def test_slowest():
+    metrics = Metrics(keep_slowest=2)
+    metrics.context = 'test_a'
+    metrics.record('host1', 'command', 'sleep', 3, detail='sleep 3')
+    metrics.record('host1', 'command', 'echo', 0.1)
+    metrics.context = 'test_b'
+    metrics.record('host2', 'get', 'get_file', 5, detail='get_file /a')
+    assert [(op.duration, op.host, op.detail, op.context)
+            for op in metrics.slowest] == [
+        (5, 'host2', 'get_file /a', 'test_b'),
+        (3, 'host1', 'sleep 3', 'test_a'),
+    ]
+    assert Metrics().slowest == []
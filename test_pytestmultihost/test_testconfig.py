@@ -5,9 +5,15 @@
 #
 
 import json
+import socket
+import sys
+import time
 import copy
 
+import pytest
+
 from pytest_multihost import config
+from pytest_multihost import plugin
 
 DEFAULT_OUTPUT_DICT = {
     "test_dir": "/root/multihost_tests",
@@ -15,6 +21,11 @@ DEFAULT_OUTPUT_DICT = {
     "ssh_password": None,
     'ssh_username': 'root',
     'ipv6': False,
+    'persistent_shell': False,
+    'sftp_pipelining': True,
+    'sftp_chunk_size': 32768,
+    'sftp_max_requests': None,
+    'ssh_tuning': {},
     "domains": [],
 }
 
@@ -238,3 +249,235 @@ class TestComplexConfig(CheckConfig):
 
         assert conf.domains[2].hosts[0].host_type == 'windows'
         assert conf.domains[2].hosts[0].test_dir == conf.windows_test_dir
+
+
+class TestSSHTuningConfig(CheckConfig):
+    extra_input_dict = dict(
+        ssh_tuning=dict(compression=False, options={'ConnectTimeout': 5}),
+        domains=[
+            dict(name='adomain.test',
+                 ssh_tuning=dict(compression=True, window_size=2 ** 24),
+                 hosts=[
+                     dict(name='master', ip='192.0.2.1',
+                          ssh_tuning=dict(ciphers=['aes128-ctr'],
+                                          options={'IPQoS': 'throughput'})),
+                     dict(name='replica', ip='192.0.2.2', role='replica'),
+                 ]),
+        ],
+    )
+    extra_output_dict = dict(
+        ssh_tuning=dict(compression=False, options={'ConnectTimeout': 5}),
+        domains=[
+            dict(
+                type='default',
+                name='adomain.test',
+                ssh_tuning=dict(compression=True, window_size=2 ** 24),
+                hosts=[
+                    dict(
+                        name='master.adomain.test',
+                        ip='192.0.2.1',
+                        external_hostname='master.adomain.test',
+                        role='master',
+                        ssh_tuning=dict(ciphers=['aes128-ctr'],
+                                        options={'IPQoS': 'throughput'}),
+                    ),
+                    dict(
+                        name='replica.adomain.test',
+                        ip='192.0.2.2',
+                        external_hostname='replica.adomain.test',
+                        role='replica',
+                    ),
+                ],
+            ),
+        ],
+    )
+
+    def check_config(self, conf):
+        master, replica = conf.domains[0].hosts
+        assert master.effective_ssh_tuning == dict(
+            compression=True, window_size=2 ** 24, ciphers=['aes128-ctr'],
+            options={'ConnectTimeout': 5, 'IPQoS': 'throughput'})
+        assert replica.effective_ssh_tuning == dict(
+            compression=True, window_size=2 ** 24,
+            options={'ConnectTimeout': 5})
+
+
+def test_unknown_ssh_tuning_key():
+    with pytest.raises(ValueError):
+        config.Config.from_dict(extend_dict(
+            DEFAULT_INPUT_DICT, ssh_tuning={'bogus': True}))
+
+
+def test_transport_key():
+    from pytest_multihost import transport
+    dct = extend_dict(DEFAULT_INPUT_DICT, domains=[
+        dict(name='adomain.test', hosts=[
+            dict(name='master', ip='192.0.2.1', transport='local'),
+            dict(name='replica', ip='192.0.2.2', role='replica'),
+        ]),
+    ])
+    conf = config.Config.from_dict(dct)
+    master, replica = conf.domains[0].hosts
+    assert master.transport_class is transport.LocalTransport
+    assert replica.transport_class is transport.SSHTransport
+    assert conf.to_dict()['domains'][0]['hosts'][0]['transport'] == 'local'
+    assert 'transport' not in conf.to_dict()['domains'][0]['hosts'][1]
+
+    dct['domains'][0]['hosts'][0]['transport'] = 'bogus'
+    with pytest.raises(ValueError):
+        config.Config.from_dict(dct)
+
+    # Replaying needs a cassette, so it is not selectable per host
+    dct['domains'][0]['hosts'][0]['transport'] = 'replay'
+    with pytest.raises(ValueError):
+        config.Config.from_dict(dct)
+
+
+def test_cassette_mode():
+    from pytest_multihost import transport
+    dct = extend_dict(DEFAULT_INPUT_DICT, domains=[
+        dict(name='adomain.test', hosts=[
+            dict(name='master', ip='192.0.2.1', transport='local'),
+        ]),
+    ], cassette='cassette.jsonl', cassette_mode='record')
+    conf = config.Config.from_dict(dct)
+    [master] = conf.domains[0].hosts
+    assert master.transport_class is transport.RecordingTransport
+    assert master.recorded_transport_class is transport.LocalTransport
+    # The cassette is not saved, so a config loaded from the saved one
+    # does not truncate the recording
+    saved = conf.to_dict()
+    assert 'cassette' not in saved
+    assert 'cassette_mode' not in saved
+    [master] = config.Config.from_dict(saved).domains[0].hosts
+    assert master.transport_class is transport.LocalTransport
+
+    dct['cassette_mode'] = 'replay'
+    conf = config.Config.from_dict(dct)
+    [master] = conf.domains[0].hosts
+    assert master.transport_class is transport.ReplayTransport
+
+    dct['cassette_mode'] = 'bogus'
+    with pytest.raises(ValueError):
+        config.Config.from_dict(dct)
+
+    dct['cassette_mode'] = 'record'
+    del dct['cassette']
+    with pytest.raises(ValueError):
+        config.Config.from_dict(dct)
+
+
+def test_load_config_file(tmpdir, monkeypatch):
+    conffile = tmpdir.join('config.json')
+    conffile.write(json.dumps(dict(DEFAULT_INPUT_DICT, test_dir='/a')))
+    cache_file = str(tmpdir.join('cache', 'config.json'))
+    confdict = plugin.load_config_file(str(conffile), cache_file=cache_file)
+    assert confdict == dict(DEFAULT_INPUT_DICT, test_dir='/a')
+
+    # An unchanged file is not parsed again
+    def fail(contents):
+        raise AssertionError('config parsed again')
+    monkeypatch.setattr(plugin, 'parse_config', fail)
+    assert plugin.load_config_file(
+        str(conffile), cache_file=cache_file) == confdict
+
+    # A changed file is
+    monkeypatch.undo()
+    conffile.write(json.dumps(dict(DEFAULT_INPUT_DICT, test_dir='/b')))
+    confdict = plugin.load_config_file(str(conffile), cache_file=cache_file)
+    assert confdict['test_dir'] == '/b'
+
+    conffile.write('{not valid')
+    with pytest.raises(ValueError):
+        plugin.load_config_file(str(conffile), cache_file=cache_file)
+
+
+def test_load_config_file_credentials(tmpdir):
+    conffile = tmpdir.join('config.json')
+    cache_file = tmpdir.join('cache', 'config-current.json')
+    old_file = tmpdir.join('cache', 'config-old.json')
+    conffile.write(json.dumps(dict(DEFAULT_INPUT_DICT, test_dir='/a')))
+    plugin.load_config_file(str(conffile), cache_file=str(cache_file))
+    assert cache_file.check()
+
+    # Configurations with credentials are not cached (and neither is
+    # anything that was cached for the file before)
+    domains = [dict(name='adomain.test', hosts=[
+        dict(name='master', ip='192.0.2.1', password='host-secret'),
+    ])]
+    for confdict in (dict(DEFAULT_INPUT_DICT, ssh_password='secret'),
+                     dict(DEFAULT_INPUT_DICT, ssh_key_filename='/key'),
+                     dict(DEFAULT_INPUT_DICT, domains=domains)):
+        conffile.write(json.dumps(confdict))
+        assert plugin.load_config_file(
+            str(conffile), cache_file=str(cache_file)) == confdict
+        assert not cache_file.check()
+
+    # Old cache files are removed when a configuration is cached
+    old_file.write('{}')
+    old_file.setmtime(time.time() - plugin.CONFIG_CACHE_MAX_AGE - 10)
+    conffile.write(json.dumps(DEFAULT_INPUT_DICT))
+    plugin.load_config_file(str(conffile), cache_file=str(cache_file))
+    assert cache_file.check()
+    assert not old_file.check()
+
+
+def test_parse_config_errors(monkeypatch):
+    pytest.importorskip('yaml')
+    # With PyYAML, the YAML error is reported, and PyYAML is not blamed
+    with pytest.raises(ValueError) as excinfo:
+        plugin.parse_config(b'domains: [')
+    assert 'PyYAML' not in str(excinfo.value)
+    assert str(excinfo.value)
+
+    # Without it, the JSON error mentions that PyYAML is missing
+    monkeypatch.setitem(sys.modules, 'yaml', None)
+    assert plugin.parse_config(b'{"a": 1}') == ({'a': 1}, 'json')
+    with pytest.raises(ValueError) as excinfo:
+        plugin.parse_config(b'domains: []')
+    assert 'PyYAML is not installed' in str(excinfo.value)
+
+
+def test_lazy_ip_resolution(monkeypatch):
+    from pytest_multihost import host as host_module
+    lookups = []
+
+    def gethostbyname(name):
+        lookups.append(name)
+        if name.startswith('bad'):
+            raise socket.gaierror('not found')
+        return '192.0.2.%s' % len(lookups)
+
+    monkeypatch.setattr(host_module.socket, 'gethostbyname', gethostbyname)
+    monkeypatch.setattr(host_module, '_ip_cache', {})
+    dct = extend_dict(DEFAULT_INPUT_DICT, domains=[
+        dict(name='lazy.test', hosts=[
+            dict(name='master', role='master'),
+            dict(name='replica', role='replica', ip='192.0.2.99'),
+            dict(name='bad', role='client'),
+        ]),
+    ])
+    conf = config.Config.from_dict(dct)
+    master, replica, bad = conf.domains[0].hosts
+    assert lookups == []
+    assert replica.ip == '192.0.2.99'
+    assert master.ip == '192.0.2.1'
+    with pytest.raises(RuntimeError):
+        bad.ip
+    assert lookups == ['master.lazy.test', 'bad.lazy.test']
+
+    # Addresses are cached for the whole process
+    conf = config.Config.from_dict(dct)
+    ips = conf.resolve_ips(conf.domains[0].hosts[:2])
+    assert list(ips.values()) == ['192.0.2.1', '192.0.2.99']
+    assert lookups == ['master.lazy.test', 'bad.lazy.test']
+    with pytest.raises(config.MultihostError):
+        conf.resolve_ips()
+
+    # ... until they expire
+    monkeypatch.setattr(host_module, '_ip_cache', {})
+    monkeypatch.setattr(host_module, 'IP_CACHE_TTL', 0)
+    conf = config.Config.from_dict(dct)
+    assert conf.domains[0].hosts[0].ip == '192.0.2.4'
+    conf = config.Config.from_dict(dct)
+    assert conf.domains[0].hosts[0].ip == '192.0.2.5'